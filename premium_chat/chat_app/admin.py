@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from .models import (
@@ -12,7 +12,7 @@ class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ['session_id_short', 'title', 'user', 'message_count', 'created_at', 'updated_at', 'is_active']
     list_filter = ['is_active', 'created_at', 'user']
     search_fields = ['session_id', 'title', 'user__username']
-    readonly_fields = ['id', 'session_id', 'created_at', 'updated_at', 'message_count']
+    readonly_fields = ['id', 'session_id', 'created_at', 'updated_at', 'message_count', 'summary_until', 'summary_updated_at']
     list_per_page = 50
     
     def session_id_short(self, obj):
@@ -33,7 +33,7 @@ class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ['id_short', 'session_title', 'message_type', 'content_preview', 'provider_used', 'response_time', 'created_at']
     list_filter = ['message_type', 'provider_used', 'created_at', 'is_favorite']
     search_fields = ['content', 'session__title', 'session__session_id']
-    readonly_fields = ['id', 'created_at', 'updated_at']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'attempt_timeline_table']
     list_per_page = 100
     
     fieldsets = (
@@ -44,6 +44,10 @@ class ChatMessageAdmin(admin.ModelAdmin):
             'fields': ('provider_used', 'model_used', 'response_time', 'attempt_number', 'tokens_used'),
             'classes': ('collapse',)
         }),
+        ('Хронология попыток', {
+            'fields': ('attempt_timeline_table',),
+            'classes': ('collapse',)
+        }),
         ('Временные метки', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
@@ -64,6 +68,23 @@ class ChatMessageAdmin(admin.ModelAdmin):
         return mark_safe(f'<span title="{content}">{preview}</span>')
     content_preview.short_description = "Содержимое"
     
+    def attempt_timeline_table(self, obj):
+        if not obj.attempt_timeline:
+            return "—"
+        rows = format_html_join(
+            '',
+            '<tr><td>{}</td><td>{}</td><td>{} мс</td><td>+{} мс</td><td>{}</td></tr>',
+            ((index, provider, duration, start, outcome)
+             for index, (provider, start, duration, outcome) in enumerate(obj.attempt_timeline, 1))
+        )
+        wasted = sum(duration for _, _, duration, outcome in obj.attempt_timeline if outcome != 'success')
+        return format_html(
+            '<table><tr><th>#</th><th>Провайдер</th><th>Длительность</th><th>Старт</th><th>Исход</th></tr>{}</table>'
+            '<p>Потрачено на неудачные попытки: {} мс</p>',
+            rows, wasted
+        )
+    attempt_timeline_table.short_description = "Попытки"
+    
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('session')
 
@@ -0,0 +1,84 @@
+import logging
+from typing import List, Optional
+from .redis_client import get_async_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingContext:
+    """Данные одного запроса для выбора провайдера
+
+    Создается на каждый запрос и передается явно: в общем GPTService ничего
+    из этого не хранится, поэтому запросы разных пользователей не влияют друг на друга.
+    """
+
+    def __init__(self, session_id: str = None, user_id: int = None, preferred_provider: str = None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.preferred_provider = preferred_provider  # Провайдер, выбранный в самом запросе
+        self.start_provider = None  # С кого начинать перебор (заполняет GPTService)
+
+
+class ProviderAffinity:
+    """Последний удачный провайдер по сессии чата и по пользователю (Redis)
+
+    Запрос начинает перебор с провайдера, который последним ответил в этой сессии,
+    а для новой сессии - с последнего удачного провайдера пользователя. Записи общие
+    для всех процессов и живут ttl секунд с последнего успеха.
+    """
+
+    KEY_PREFIX = 'gpt_affinity'
+
+    def __init__(self, enabled: bool = True, ttl: int = 604800):
+        self.enabled = enabled
+        self.ttl = ttl
+
+    def _keys(self, routing: RoutingContext) -> List[str]:
+        """Ключи в порядке приоритета: сначала сессия, потом пользователь"""
+        keys = []
+        if routing.session_id:
+            keys.append(f"{self.KEY_PREFIX}:session:{routing.session_id}")
+        if routing.user_id is not None:
+            keys.append(f"{self.KEY_PREFIX}:user:{routing.user_id}")
+        return keys
+
+    async def resolve(self, routing: RoutingContext) -> Optional[str]:
+        """Определить стартового провайдера: выбор в запросе, иначе сессия, иначе пользователь"""
+        if routing.preferred_provider:
+            routing.start_provider = routing.preferred_provider
+            return routing.start_provider
+
+        keys = self._keys(routing)
+        if not self.enabled or not keys:
+            return None
+        try:
+            values = await get_async_redis().mget(keys)
+        except Exception as e:
+            logger.warning("[AFFINITY] Не удалось прочитать провайдера сессии: %s", e)
+            return None
+        routing.start_provider = next((value.decode() for value in values if value), None)
+        return routing.start_provider
+
+    async def remember(self, routing: RoutingContext, provider_name: str):
+        """Запомнить провайдера, который ответил на запрос"""
+        keys = self._keys(routing)
+        if not self.enabled or not keys:
+            return
+        try:
+            pipe = get_async_redis().pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, provider_name, ex=self.ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("[AFFINITY] Не удалось сохранить провайдера сессии: %s", e)
+
+    def set(self, routing: RoutingContext, provider_name: str) -> bool:
+        """Назначить провайдера сессии/пользователю вручную (синхронно, для API)"""
+        keys = self._keys(routing)
+        if not self.enabled or not keys:
+            return False
+        pipe = get_sync_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, provider_name, ex=self.ttl)
+        pipe.execute()
+        return True
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+from .priority import PRIORITIES, priority_rank
+
+logger = logging.getLogger(__name__)
+
+
+class LimiterOverloaded(Exception):
+    """Очередь ожидания переполнена или слот не освободился за отведенное время"""
+
+
+class _Waiter:
+    __slots__ = ('loop', 'future', 'granted', 'evicted')
+
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+        self.granted = False  # Слот уже передан этому ожидающему
+        self.evicted = False  # Вытеснен из очереди запросом с более высоким приоритетом
+
+
+class ConcurrencyLimiter:
+    """Ограничение числа одновременных операций по ключу с ограниченной очередью
+
+    Работает поверх нескольких event loop сразу (get_response_sync создает свой loop
+    на каждый запрос), поэтому вместо asyncio.Semaphore счетчики защищены
+    threading.Lock, а ожидающие будятся через call_soon_threadsafe.
+
+    Очередь учитывает приоритет запроса (см. priority.PRIORITIES): освободившийся слот
+    получает самый приоритетный ожидающий (внутри приоритета - FIFO). Доля shares[priority]
+    ограничивает, какую часть лимита и очереди может занять приоритет, поэтому низкие
+    приоритеты не вытесняют высокие. При переполненной очереди новый запрос вытесняет
+    самый свежий ожидающий запрос более низкого приоритета.
+    """
+
+    def __init__(self, limit: int, limits: Dict[str, int] = None, max_queue: int = 100,
+                 queue_timeout: float = 10.0, name: str = 'limiter', shares: Dict[str, float] = None):
+        self.limit = limit  # Лимит по умолчанию для любого ключа
+        self.limits = limits or {}  # Индивидуальные лимиты по ключам
+        self.max_queue = max_queue  # Максимум ожидающих на ключ
+        self.queue_timeout = queue_timeout
+        self.name = name
+        self.shares = shares or {}  # Доля лимита и очереди по приоритетам (по умолчанию 1.0)
+
+        self._active = defaultdict(int)
+        self._waiters = defaultdict(lambda: [deque() for _ in PRIORITIES])
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.rejected_by_priority = defaultdict(int)
+
+    def _limit(self, key: str) -> int:
+        return self.limits.get(key, self.limit)
+
+    def _share(self, rank: int, total: int) -> int:
+        """Сколько из total доступно приоритету (не меньше 1)"""
+        share = self.shares.get(PRIORITIES[rank], 1.0)
+        return max(1, min(total, int(total * share)))
+
+    def _waiting(self, key: str) -> int:
+        return sum(len(queue) for queue in self._waiters[key]) if key in self._waiters else 0
+
+    def _has_capacity(self, key: str, rank: int) -> bool:
+        """Можно занять слот сразу: есть место в доле приоритета и нет ожидающих не ниже его"""
+        if self._active[key] >= self._share(rank, self._limit(key)):
+            return False
+        return key not in self._waiters or not any(self._waiters[key][:rank + 1])
+
+    def has_capacity(self, key: str = '*', priority: str = None) -> bool:
+        """Есть ли свободный слот для запроса с таким приоритетом (без ожидания)"""
+        with self._lock:
+            return self._has_capacity(key, priority_rank(priority))
+
+    def _reject(self, rank: int):
+        self.rejected += 1
+        self.rejected_by_priority[PRIORITIES[rank]] += 1
+
+    def _evict_lower(self, key: str, rank: int):
+        """Вытеснить самого свежего ожидающего с приоритетом ниже rank (под self._lock)"""
+        queues = self._waiters[key]
+        for lower in range(len(PRIORITIES) - 1, rank, -1):
+            if queues[lower]:
+                victim = queues[lower].pop()
+                victim.evicted = True
+                self._reject(lower)
+                return victim
+        return None
+
+    async def acquire(self, key: str = '*', timeout: float = None, priority: str = None):
+        """Занять слот. Бросает LimiterOverloaded, если очередь полна или ожидание истекло"""
+        loop = asyncio.get_running_loop()
+        rank = priority_rank(priority)
+        victim = None
+        with self._lock:
+            if self._has_capacity(key, rank):
+                self._active[key] += 1
+                return
+            queues = self._waiters[key]
+            if len(queues[rank]) >= self._share(rank, self.max_queue):
+                self._reject(rank)
+                raise LimiterOverloaded(f"{self.name}: очередь {key} для {PRIORITIES[rank]} переполнена")
+            if self._waiting(key) >= self.max_queue:
+                victim = self._evict_lower(key, rank)
+                if victim is None:
+                    self._reject(rank)
+                    raise LimiterOverloaded(f"{self.name}: очередь {key} переполнена ({self.max_queue})")
+            waiter = _Waiter(loop, loop.create_future())
+            queues[rank].append(waiter)
+
+        if victim is not None:
+            logger.info("[PRIORITY] %s: запрос %s вытеснил из очереди %s запрос с более низким приоритетом", self.name, PRIORITIES[rank], key)
+            self._wake_waiter(victim, LimiterOverloaded(f"{self.name}: вытеснен из очереди {key} более приоритетным запросом"))
+
+        wait_timeout = self.queue_timeout if timeout is None else max(min(timeout, self.queue_timeout), 0)
+        try:
+            await asyncio.wait_for(waiter.future, wait_timeout)
+        except BaseException as e:
+            with self._lock:
+                granted = waiter.granted
+                if not granted and not waiter.evicted:
+                    self._waiters[key][rank].remove(waiter)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self._reject(rank)
+            if granted:
+                # Слот успели передать, но он уже не нужен - отдаем следующему
+                self.release(key)
+            if isinstance(e, asyncio.TimeoutError):
+                raise LimiterOverloaded(f"{self.name}: {key} не освободился за {wait_timeout:.1f}с")
+            raise
+
+    def _next_waiter(self, key: str):
+        """Самый приоритетный ожидающий, которому можно передать освобождающийся слот (под self._lock)"""
+        if key not in self._waiters:
+            return None
+        # Передача слота не меняет _active: после освобождения занято будет _active - 1
+        active_after = self._active[key] - 1
+        for rank, queue in enumerate(self._waiters[key]):
+            if queue and active_after < self._share(rank, self._limit(key)):
+                return queue.popleft()
+        return None
+
+    def release(self, key: str = '*'):
+        """Освободить слот (или передать его самому приоритетному ожидающему)"""
+        with self._lock:
+            waiter = self._next_waiter(key)
+            if waiter is None:
+                self._active[key] = max(self._active[key] - 1, 0)
+                return
+            waiter.granted = True
+
+        if not self._wake_waiter(waiter):
+            # Event loop ожидающего уже закрыт - слот переходит дальше
+            self.release(key)
+
+    def _wake_waiter(self, waiter: _Waiter, error: Exception = None) -> bool:
+        try:
+            waiter.loop.call_soon_threadsafe(self._wake, waiter.future, error)
+            return True
+        except RuntimeError:
+            return False
+
+    @staticmethod
+    def _wake(future: asyncio.Future, error: Exception = None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(True)
+
+    @asynccontextmanager
+    async def slot(self, key: str = '*', timeout: float = None, priority: str = None):
+        await self.acquire(key, timeout, priority)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Текущая загрузка для API и логов"""
+        with self._lock:
+            keys = {key for key in self._active if self._active[key]} | {key for key in self._waiters if self._waiting(key)}
+            return {
+                "rejected": self.rejected,
+                "rejected_by_priority": dict(self.rejected_by_priority),
+                "slots": {
+                    key: {
+                        "active": self._active[key],
+                        "waiting": self._waiting(key),
+                        "waiting_by_priority": {
+                            PRIORITIES[rank]: len(queue)
+                            for rank, queue in enumerate(self._waiters[key]) if queue
+                        },
+                        "limit": self._limit(key),
+                    }
+                    for key in sorted(keys)
+                },
+            }
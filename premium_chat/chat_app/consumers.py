@@ -5,7 +5,11 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from .models import ChatSession, ChatMessage
-from .gpt_service import gpt_service
+from .history import load_conversation_history
+from .summarizer import summarizer
+from .generation import run_generation, get_generation_result
+from .priority import get_user_priority
+from .rate_limit import rate_limiter
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +28,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
-        logger.info(f"WebSocket connected for session {self.session_id}")
+        logger.info("WebSocket connected for session %s", self.session_id)
     
     async def disconnect(self, close_code):
         """Отключение от WebSocket"""
@@ -33,7 +37,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
-        logger.info(f"WebSocket disconnected for session {self.session_id}")
+        logger.info("WebSocket disconnected for session %s", self.session_id)
     
     async def receive(self, text_data):
         """Получение сообщения от клиента"""
@@ -51,7 +55,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except json.JSONDecodeError:
             await self.send_error("Неверный формат JSON")
         except Exception as e:
-            logger.error(f"Ошибка в receive: {str(e)}")
+            logger.error("Ошибка в receive: %s", str(e))
             await self.send_error("Внутренняя ошибка сервера")
     
     async def handle_chat_message(self, data):
@@ -61,7 +65,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("Пустое сообщение")
             return
         
+        # Срок ответа проверяем так же, как ChatRequestSerializer для REST API
+        timeout = data.get('timeout')
+        if timeout is not None:
+            try:
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                timeout = None
+            if timeout is None or not 5 <= timeout <= 300:
+                await self.send_error("timeout должен быть числом от 5 до 300 секунд")
+                return
+        
         try:
+            # Лимит частоты запросов - до записи в БД и обращения к провайдерам
+            priority = await self.get_request_priority()
+            client = self.scope.get('client') or [None]
+            allowed, retry_after = await rate_limiter.check('chat', priority, self.scope.get('user'), client[0], self.session_id)
+            if not allowed:
+                await self.send_error("Слишком много запросов. Попробуйте позже.", retry_after=retry_after)
+                return
+            
             # Получаем или создаем сессию
             session = await self.get_or_create_session()
             
@@ -91,10 +114,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
             
             # Получаем историю разговора
-            conversation_history = await self.get_conversation_history(session)
+            conversation_history = await self.get_conversation_history(session, exclude_id=user_message.id)
             
-            # Получаем ответ от GPT асинхронно
-            gpt_response = await gpt_service.get_response_async(message, conversation_history)
+            # Получаем ответ от GPT: по умолчанию потоково, фрагментами ai_chunk
+            use_cache = data.get('use_cache', True)
+            if data.get('stream', True):
+                gpt_response = await self.stream_gpt_response(message, conversation_history, use_cache, session.summary, timeout, priority)
+            else:
+                gpt_response = await get_generation_result({
+                    'message': message,
+                    'conversation_history': conversation_history,
+                    'use_cache': use_cache,
+                    'summary': session.summary,
+                    'timeout': timeout,
+                    'priority': priority,
+                    **self.get_routing_kwargs(),
+                })
             
             # Убираем индикатор печати
             await self.channel_layer.group_send(
@@ -114,9 +149,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     gpt_response.get('provider_used', ''),
                     gpt_response.get('model_used', ''),
                     gpt_response.get('response_time'),
-                    gpt_response.get('attempt_number')
+                    gpt_response.get('attempt_number'),
+                    gpt_response.get('attempt_timeline', [])
                 )
                 
+                # Сворачиваем старую часть разговора в фоне
+                summarizer.schedule(session)
+                
                 # Отправляем ответ ассистента
                 await self.channel_layer.group_send(
                     self.room_group_name,
@@ -144,7 +183,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 )
                 
         except Exception as e:
-            logger.error(f"Ошибка в handle_chat_message: {str(e)}")
+            logger.error("Ошибка в handle_chat_message: %s", str(e))
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
@@ -154,6 +193,47 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
             )
     
+    def get_routing_kwargs(self):
+        """Сессия и пользователь для выбора стартового провайдера (последний удачный в сессии)"""
+        user = self.scope.get('user')
+        return {
+            'session_id': self.session_id,
+            'user_id': user.pk if user is not None and user.is_authenticated else None,
+        }
+    
+    async def stream_gpt_response(self, message, conversation_history, use_cache=True, summary=None, timeout=None, priority=None):
+        """Транслировать потоковый ответ GPT в группу и вернуть итоговый результат"""
+        gpt_response = None
+        gpt_kwargs = {
+            'message': message,
+            'conversation_history': conversation_history,
+            'use_cache': use_cache,
+            'summary': summary,
+            'timeout': timeout,
+            'priority': priority,
+            **self.get_routing_kwargs(),
+        }
+        async for event in run_generation(gpt_kwargs):
+            if event['type'] == 'chunk':
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'ai_chunk',
+                        'content': event['content']
+                    }
+                )
+            elif event['type'] == 'reset':
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'ai_stream_reset'
+                    }
+                )
+            elif event['type'] == 'done':
+                gpt_response = event['result']
+        
+        return gpt_response or {'success': False, 'error': 'Пустой поток ответа'}
+    
     async def handle_typing_start(self):
         """Обработка начала печати пользователем"""
         await self.channel_layer.group_send(
@@ -187,6 +267,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': event['message']
         }))
     
+    async def ai_chunk(self, event):
+        """Отправка очередного фрагмента потокового ответа ИИ"""
+        await self.send(text_data=json.dumps({
+            'type': 'ai_chunk',
+            'content': event['content']
+        }))
+    
+    async def ai_stream_reset(self, event):
+        """Провайдер оборвал ответ - клиент сбрасывает накопленные фрагменты"""
+        await self.send(text_data=json.dumps({
+            'type': 'ai_stream_reset'
+        }))
+    
+    async def image_job(self, event):
+        """Состояние задания генерации изображения (image_jobs.ImageJobRunner)"""
+        await self.send(text_data=json.dumps({
+            'type': 'image_job',
+            'job': event['job']
+        }))
+    
     async def ai_error(self, event):
         """Отправка ошибки ИИ"""
         await self.send(text_data=json.dumps({
@@ -220,12 +320,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }))
     
     # Вспомогательные методы
-    async def send_error(self, error_message):
-        """Отправка ошибки клиенту"""
-        await self.send(text_data=json.dumps({
+    async def send_error(self, error_message, retry_after=None):
+        """Отправка ошибки клиенту (retry_after - через сколько секунд можно повторить)"""
+        payload = {
             'type': 'error',
             'error': error_message
-        }))
+        }
+        if retry_after is not None:
+            payload['retry_after'] = round(retry_after, 1)
+        await self.send(text_data=json.dumps(payload))
     
     @database_sync_to_async
     def get_or_create_session(self):
@@ -241,7 +344,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         return session
     
     @database_sync_to_async
-    def save_message(self, session, message_type, content, raw_content='', provider='', model='', response_time=None, attempt_number=None):
+    def save_message(self, session, message_type, content, raw_content='', provider='', model='', response_time=None, attempt_number=None, attempt_timeline=None):
         """Сохранить сообщение в базе данных"""
         return ChatMessage.objects.create(
             session=session,
@@ -251,22 +354,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             provider_used=provider,
             model_used=model,
             response_time=response_time,
-            attempt_number=attempt_number
+            attempt_number=attempt_number,
+            attempt_timeline=attempt_timeline or []
         )
     
     @database_sync_to_async
-    def get_conversation_history(self, session, max_messages=50):
-        """Получить историю разговора"""
-        messages = session.messages.order_by('created_at')[:max_messages * 2]  # x2 для user+assistant пар
-        
-        history = []
-        for msg in messages:
-            if msg.message_type == 'user':
-                history.append({
-                    'message': msg.content,
-                    'response': None
-                })
-            elif msg.message_type == 'assistant' and history:
-                history[-1]['response'] = msg.content
-        
-        return history
+    def get_request_priority(self):
+        """Приоритет запросов пользователя соединения (премиум / пользователь / аноним)"""
+        return get_user_priority(self.scope.get("user"))
+    
+    @database_sync_to_async
+    def get_conversation_history(self, session, max_messages=50, exclude_id=None):
+        """Получить историю разговора (последние сообщения)"""
+        return load_conversation_history(session, max_messages, exclude_id)
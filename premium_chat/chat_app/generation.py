@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Dict, Any
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .gpt_service import GPTService, aget_gpt_service
+from .redis_client import get_async_redis, get_sync_redis
+from .metrics import metric_series
+from .priority import PRIORITIES, PRIORITY_USER
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_KEY = 'gpt_jobs:queue'
+
+
+def _queue_key(priority: str = None) -> str:
+    """Отдельная очередь на каждый приоритет: воркеры разбирают их по порядку PRIORITIES"""
+    return f"{JOB_QUEUE_KEY}:{priority if priority in PRIORITIES else PRIORITY_USER}"
+
+# Тип сообщения channel layer, в котором воркер присылает события генерации
+EVENT_MESSAGE_TYPE = 'gpt.event'
+
+
+def worker_mode_enabled() -> bool:
+    """Генерация вынесена в отдельные процессы run_gpt_worker"""
+    return getattr(settings, 'GPT_WORKER_MODE', False)
+
+
+def job_queue_depths() -> Dict[str, float]:
+    """Длина очередей заданий по приоритетам для метрики gpt_job_queue_depth"""
+    pipe = get_sync_redis().pipeline(transaction=False)
+    for priority in PRIORITIES:
+        pipe.llen(_queue_key(priority))
+    return {
+        metric_series('gpt_job_queue_depth', {'priority': priority}): depth
+        for priority, depth in zip(PRIORITIES, pipe.execute())
+    }
+
+
+async def run_generation(gpt_kwargs: Dict[str, Any], stream: bool = True):
+    """Выполнить генерацию и отдавать события в формате GPTService.stream_response
+
+    В обычном режиме GPTService вызывается прямо в этом процессе. В режиме
+    GPT_WORKER_MODE задание кладется в очередь Redis, а события приходят
+    от воркера через channel layer.
+
+    Args:
+        gpt_kwargs: Аргументы get_response_async / stream_response
+        stream: Нужны ли фрагменты ответа (иначе только итоговое событие done)
+    """
+    if not worker_mode_enabled():
+        gpt_service = await aget_gpt_service()
+        if stream:
+            async for event in gpt_service.stream_response(**gpt_kwargs):
+                yield event
+        else:
+            yield {"type": "done", "result": await gpt_service.get_response_async(**gpt_kwargs)}
+        return
+
+    async for event in _run_remote(gpt_kwargs, stream):
+        yield event
+
+
+async def get_generation_result(gpt_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Итоговый результат генерации без потоковых фрагментов"""
+    result = None
+    async for event in run_generation(gpt_kwargs, stream=False):
+        if event.get("type") == "done":
+            result = event["result"]
+    return result or {"success": False, "error": "Пустой ответ генерации"}
+
+
+async def _run_remote(gpt_kwargs: Dict[str, Any], stream: bool):
+    """Поставить задание в очередь воркеров и дождаться его событий"""
+    channel_layer = get_channel_layer()
+    reply_channel = await channel_layer.new_channel('gpt_reply')
+
+    # Клиент ждет не дольше срока запроса плюс времени в очереди. Сервис здесь не создается:
+    # в режиме воркеров веб-процессу g4f не нужен
+    timeout = min(gpt_kwargs.get('timeout') or getattr(settings, 'GPT_REQUEST_TIMEOUT', 60),
+                  getattr(settings, 'GPT_REQUEST_TIMEOUT_MAX', 300))
+    wait_budget = timeout + getattr(settings, 'GPT_JOB_QUEUE_TIMEOUT', 30)
+
+    job = {
+        "id": uuid.uuid4().hex,
+        "kwargs": gpt_kwargs,
+        "stream": stream,
+        "reply_channel": reply_channel,
+        "expires_at": time.time() + wait_budget,
+    }
+
+    priority = gpt_kwargs.get('priority')
+    queue_key = _queue_key(priority)
+    # Низкие приоритеты могут занять только свою долю очереди и отсекаются первыми
+    share = (getattr(settings, 'GPT_PRIORITY_SHARES', None) or {}).get(priority, 1.0)
+    queue_max = max(1, int(getattr(settings, 'GPT_JOB_QUEUE_MAX', 1000) * share))
+
+    try:
+        redis = get_async_redis()
+        queued = await redis.llen(queue_key)
+        if queued >= queue_max:
+            logger.warning("[JOBS] Очередь генерации %s переполнена (%s), запрос отклонен", queue_key, queued)
+            yield {"type": "done", "result": GPTService._build_overloaded_result()}
+            return
+        await redis.rpush(queue_key, json.dumps(job, ensure_ascii=False, default=str))
+    except Exception as e:
+        logger.error("[JOBS] Не удалось поставить задание в очередь: %s", e)
+        yield {"type": "done", "result": GPTService._build_overloaded_result()}
+        return
+
+    logger.info("[JOBS] Задание %s поставлено в очередь (в очереди было %s)", job['id'], queued)
+
+    deadline = time.monotonic() + wait_budget
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning("[JOBS] Задание %s: воркер не ответил за %.0fс", job['id'], wait_budget)
+            yield {"type": "done", "result": GPTService._build_timeout_result()}
+            return
+
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(reply_channel), timeout=remaining)
+        except asyncio.TimeoutError:
+            continue
+
+        event = message.get("event") or {}
+        yield event
+        if event.get("type") == "done":
+            return
+
+
+class GenerationWorker:
+    """Воркер генерации: забирает задания из Redis и выполняет их через GPTService
+
+    Каждое задание обрабатывается в отдельной задаче asyncio, одновременно - не больше concurrency.
+    Очереди приоритетов опрашиваются по порядку, поэтому премиум задания берутся первыми.
+    События отправляются в reply_channel задания через channel layer.
+    """
+
+    def __init__(self, concurrency: int = 16, poll_timeout: int = 5):
+        self.concurrency = concurrency
+        self.poll_timeout = poll_timeout  # BLPOP ждет не дольше, чтобы вовремя заметить остановку
+        self.channel_layer = get_channel_layer()
+        self._stopping = False
+        self.processed = 0
+
+    def stop(self):
+        self._stopping = True
+
+    async def run(self):
+        # Воркер только генерирует - создаем сервис (и импортируем g4f) сразу, а не на первом задании
+        await aget_gpt_service()
+        logger.info("[WORKER] Воркер генерации запущен, параллельно заданий: %s", self.concurrency)
+        await asyncio.gather(*(self._consume(index) for index in range(self.concurrency)))
+        logger.info("[WORKER] Воркер остановлен, обработано заданий: %s", self.processed)
+
+    async def _consume(self, index: int):
+        redis = get_async_redis()
+        queue_keys = [_queue_key(priority) for priority in PRIORITIES]
+        while not self._stopping:
+            try:
+                # BLPOP проверяет ключи по порядку - задание с высшим приоритетом забирается первым
+                item = await redis.blpop(queue_keys, timeout=self.poll_timeout)
+            except Exception as e:
+                logger.error("[WORKER] Ошибка чтения очереди: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not item:
+                continue
+
+            try:
+                job = json.loads(item[1])
+            except ValueError:
+                logger.error("[WORKER] Некорректное задание в очереди: %r", item[1][:200])
+                continue
+
+            await self.process(job)
+
+    async def process(self, job: Dict[str, Any]):
+        """Выполнить одно задание и отправить события клиенту"""
+        reply_channel = job["reply_channel"]
+        if time.time() > job.get("expires_at", 0):
+            # Клиент уже перестал ждать - не тратим лимиты провайдеров
+            logger.warning("[WORKER] Задание %s устарело, пропускаем", job['id'])
+            return
+
+        logger.info("[WORKER] Выполняем задание %s", job['id'])
+        kwargs = job["kwargs"]
+        gpt_service = await aget_gpt_service()
+        # Срок запроса считаем от момента, когда воркер взял задание, но не дольше ожидания клиента
+        remaining = job["expires_at"] - time.time()
+        kwargs["timeout"] = min(kwargs.get("timeout") or gpt_service.request_timeout, remaining)
+
+        try:
+            if job.get("stream"):
+                async for event in gpt_service.stream_response(**kwargs):
+                    await self._send(reply_channel, event)
+            else:
+                result = await gpt_service.get_response_async(**kwargs)
+                await self._send(reply_channel, {"type": "done", "result": result})
+        except Exception as e:
+            logger.error("[WORKER] Ошибка выполнения задания %s: %s", job['id'], e)
+            await self._send(reply_channel, {"type": "done", "result": {
+                "success": False,
+                "error": str(e),
+                "response": "Критическая ошибка при обработке запроса. Попробуйте позже."
+            }})
+        self.processed += 1
+
+    async def _send(self, reply_channel: str, event: Dict[str, Any]):
+        try:
+            await self.channel_layer.send(reply_channel, {"type": EVENT_MESSAGE_TYPE, "event": event})
+        except Exception as e:
+            logger.warning("[WORKER] Не удалось отправить событие в %s: %s", reply_channel, e)
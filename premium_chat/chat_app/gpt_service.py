@@ -1,15 +1,38 @@
-import g4f
 import asyncio
+import inspect
 import logging
 import random
+import re
+import threading
 import time
 from typing import Optional, Dict, Any, List
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from .provider_health import ProviderScoreboard, CircuitBreaker
+from .provider_state import ProviderStateSync
+from .affinity import ProviderAffinity, RoutingContext
+from .response_cache import ResponseCache
+from .singleflight import SingleFlight
+from .tokens import MESSAGE_OVERHEAD, message_tokens
+from .concurrency import ConcurrencyLimiter, LimiterOverloaded
+from .priority import priority_rank
+from .metrics import metrics, metric_series
+from .timeline import AttemptTimeline
+from .resolution import ResolutionTable
+from .vision import VisionPreprocessor
 
 logger = logging.getLogger(__name__)
 
+# g4f импортируется только внутри методов: модуль подключают views и generation, а процессам,
+# которые ничего не генерируют (админка, миграции, статика), тяжелый импорт не нужен
+
 class GPTService:
-    """Сервис для работы с GPT через библиотеку g4f"""
+    """Сервис для работы с GPT через библиотеку g4f (общий экземпляр - get_gpt_service())"""
+    
+    # Классы ошибок, после которых провайдер временно пропускается
+    RATE_LIMIT_ERRORS = ('rate_limit', 'unavailable')
+    # Провайдер пропущен, потому что не успевал в срок запроса
+    DEADLINE_SKIPS = ('too_slow', 'deadline')
     
     def __init__(self):
         # ПРОВЕРЕННЫЕ РАБОЧИЕ ПРОВАЙДЕРЫ (протестировано 2025-07-05, 16 из 90)
@@ -113,17 +136,132 @@ class GPTService:
             'Free2GPT',           # Отправляет ответы на китайском языке!!!
         ]
         
-        self.current_provider = 'Chatai'  # Самый быстрый
-        self.default_model = g4f.models.default
+        # Карта моделей для vision провайдеров
+        self.vision_model_map = {
+            # ЕДИНСТВЕННЫЙ ПРОВЕРЕННЫЙ VISION ПРОВАЙДЕР (протестировано с реальным изображением)
+            'PollinationsAI': 'gpt-4o',              # ✅ ПРОТЕСТИРОВАНО - РАБОТАЕТ отлично!
+        }
+        
+        # Имена провайдеров и моделей -> объекты g4f один раз при старте: в попытке запроса
+        # только обращение к словарю, а опечатки в списках выше видны в логе сразу
+        configured = (self.fast_providers + self.medium_providers + self.slow_providers + self.vision_providers
+                      + self.image_providers + self.no_vision_providers + list(self.vision_model_map)
+                      + self.blocked_vision_providers + self.blocked_providers)
+        self.resolution = ResolutionTable(
+            configured,
+            expected_missing=self.blocked_vision_providers + self.blocked_providers,
+        )
+        self.default_model = self.resolution.default_model
         
         # Настройки прокси - отключаем по умолчанию
         self.proxy = "http://95.164.200.12:9459"
         self.use_proxy = False  # Прямое соединение работает лучше
         
-        # Статистика провайдеров
-        self.provider_stats = {}
         self.max_retries = 3
         
+        # Гонка провайдеров: первые race_width провайдеров запускаются параллельно,
+        # каждый следующий - через race_hedge_delay секунд, если ответа еще нет
+        self.race_enabled = getattr(settings, 'GPT_RACE_ENABLED', True)
+        self.race_width = getattr(settings, 'GPT_RACE_WIDTH', 2)
+        self.race_hedge_delay = getattr(settings, 'GPT_RACE_HEDGE_DELAY', 1.5)
+        
+        # Живая статистика провайдеров (EWMA задержки и исходов). Ручные замеры по тирам
+        # используются только как стартовая оценка, дальше порядок определяет статистика
+        latency_priors = {}
+        for tier_providers, prior in ((self.slow_providers, 15.0), (self.vision_providers, 9.0),
+                                      (self.medium_providers, 5.0), (self.fast_providers, 2.0)):
+            latency_priors.update({p: prior for p in tier_providers})
+        self.scoreboard = ProviderScoreboard(
+            alpha=getattr(settings, 'GPT_SCOREBOARD_ALPHA', 0.2),
+            priors=latency_priors,
+            latency_half_life=getattr(settings, 'GPT_LATENCY_HALF_LIFE', 600.0),
+        )
+        # Провайдер с оценкой задержки больше срока запроса все равно получает пробный
+        # запрос не чаще раза в slow_probe_interval секунд - так его оценка обновляется
+        self.slow_probe_interval = getattr(settings, 'GPT_SLOW_PROBE_INTERVAL', 60.0)
+        self._slow_probes = {}  # Провайдер -> time.monotonic() последнего пробного запроса
+        
+        # Circuit breaker на весь процесс: провайдеры с rate limit / блокировкой
+        # пропускаются без запроса, пока не истечет cooldown
+        self.circuit_breaker = CircuitBreaker(
+            cooldowns=getattr(settings, 'GPT_CIRCUIT_COOLDOWNS', None),
+            failure_threshold=getattr(settings, 'GPT_CIRCUIT_FAILURE_THRESHOLD', 3),
+        )
+        
+        # Статистика и цепи провайдеров общие для всех процессов: фоновый поток синхронизирует их
+        # через Redis, а запросы читают только локальную копию
+        self.provider_state = ProviderStateSync(
+            self.scoreboard,
+            self.circuit_breaker,
+            enabled=getattr(settings, 'GPT_SHARED_STATE_ENABLED', True),
+            interval=getattr(settings, 'GPT_SHARED_STATE_INTERVAL', 2),
+            stale_after=getattr(settings, 'GPT_SHARED_STATE_STALE_AFTER', 300),
+        )
+        
+        # С какого провайдера начинать: последний удачный в сессии / у пользователя.
+        # Хранится в Redis по сессии, а не в сервисе, чтобы запросы не сбивали друг другу выбор
+        self.affinity = ProviderAffinity(
+            enabled=getattr(settings, 'GPT_AFFINITY_ENABLED', True),
+            ttl=getattr(settings, 'GPT_AFFINITY_TTL', 604800),
+        )
+        
+        # Кэш ответов в Redis для одинаковых запросов (история + модель)
+        self.response_cache = ResponseCache(
+            enabled=getattr(settings, 'GPT_CACHE_ENABLED', True),
+            ttl=getattr(settings, 'GPT_CACHE_TTL', 3600),
+            max_entries=getattr(settings, 'GPT_CACHE_MAX_ENTRIES', 10000),
+        )
+        
+        # Изображения для vision уменьшаются и пережимаются один раз до первой попытки
+        self.vision_preprocessor = VisionPreprocessor(
+            enabled=getattr(settings, 'VISION_PREPROCESS_ENABLED', True),
+            max_side=getattr(settings, 'VISION_IMAGE_MAX_SIDE', 1536),
+            quality=getattr(settings, 'VISION_IMAGE_QUALITY', 85),
+            cache_ttl=getattr(settings, 'VISION_IMAGE_CACHE_TTL', 3600),
+        )
+        
+        # Бюджет токенов истории по моделям: в запрос уходят только последние сообщения, которые в него помещаются
+        self.history_token_budgets = getattr(settings, 'GPT_HISTORY_TOKEN_BUDGETS', {'default': 3000})
+        
+        # Ограничение нагрузки: общее число запросов к провайдерам в работе и одновременные
+        # вызовы каждого провайдера. Лишние запросы ждут в ограниченной очереди по приоритетам:
+        # премиум обслуживается первым, анонимные запросы занимают меньшую долю слотов и отсекаются первыми
+        priority_shares = getattr(settings, 'GPT_PRIORITY_SHARES', None)
+        self.request_limiter = ConcurrencyLimiter(
+            limit=getattr(settings, 'GPT_MAX_IN_FLIGHT', 32),
+            max_queue=getattr(settings, 'GPT_QUEUE_SIZE', 100),
+            queue_timeout=getattr(settings, 'GPT_QUEUE_TIMEOUT', 10),
+            name='requests',
+            shares=priority_shares,
+        )
+        self.provider_limiter = ConcurrencyLimiter(
+            limit=getattr(settings, 'GPT_PROVIDER_CONCURRENCY', 4),
+            limits=getattr(settings, 'GPT_PROVIDER_CONCURRENCY_LIMITS', None),
+            max_queue=getattr(settings, 'GPT_PROVIDER_QUEUE_SIZE', 8),
+            queue_timeout=getattr(settings, 'GPT_PROVIDER_QUEUE_TIMEOUT', 2),
+            name='providers',
+            shares=priority_shares,
+        )
+        
+        # Сроки: на весь запрос (по умолчанию и максимум) и на одну попытку
+        self.request_timeout = getattr(settings, 'GPT_REQUEST_TIMEOUT', 60)
+        self.max_request_timeout = getattr(settings, 'GPT_REQUEST_TIMEOUT_MAX', 300)
+        self.attempt_timeout = getattr(settings, 'GPT_ATTEMPT_TIMEOUT', 120)
+        
+        # Объединение одинаковых запросов, выполняющихся одновременно (в том числе в разных процессах)
+        self.single_flight = SingleFlight(
+            enabled=getattr(settings, 'GPT_SINGLEFLIGHT_ENABLED', True),
+            lock_ttl=getattr(settings, 'GPT_SINGLEFLIGHT_LOCK_TTL', 180),
+            wait_timeout=getattr(settings, 'GPT_SINGLEFLIGHT_WAIT_TIMEOUT', 180),
+        )
+        
+        metrics.register_gauge('gpt_limiters', self._limiter_gauges)
+        
+    @property
+    def provider_stats(self) -> Dict[str, int]:
+        """Успешные ответы по провайдерам (все процессы, с задержкой синхронизации)"""
+        return dict(self.provider_state.successes)
+    
     def get_all_providers(self) -> List[str]:
         """Получить список всех провайдеров (по кругу, в правильном порядке)"""
         # Возвращает список: быстрые + средние + медленные (без дубликатов, в порядке обхода)
@@ -135,40 +273,223 @@ class GPTService:
                 seen.add(p)
         return ordered
         
-    def trim_history(self, history: list, max_length: int = 50000) -> list:
-        """Обрезка истории разговора - МИНИМАЛЬНАЯ обрезка только при критической длине"""
+    def trim_history(self, history: list, max_tokens: int) -> list:
+        """Обрезка истории разговора по бюджету токенов
+        
+        Идем от новых пар (сообщение + ответ) к старым за один проход и оставляем
+        столько последних пар, сколько помещается в max_tokens. Для сообщений из БД
+        используются сохраненные счетчики (message_tokens / response_tokens).
+        """
         if not history:
-            return history
+            return []
+        
+        used = 0
+        start = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            item = history[index]
+            cost = 0
+            for text_key, tokens_key in (("message", "message_tokens"), ("response", "response_tokens")):
+                if item.get(text_key):
+                    tokens = item.get(tokens_key)
+                    cost += tokens + MESSAGE_OVERHEAD if tokens is not None else message_tokens(item[text_key])
+            if used + cost > max_tokens:
+                break
+            used += cost
+            start = index
+        
+        if start:
+            logger.info("[HISTORY] Бюджет %s токенов: отброшено %s старых пар из %s, осталось ~%s токенов", max_tokens, start, len(history), used)
+        return history[start:]
+    
+    def _get_history_budget(self, model_to_use) -> int:
+        """Бюджет токенов истории для модели"""
+        model_name = getattr(model_to_use, 'name', None) or str(model_to_use)
+        return self.history_token_budgets.get(model_name, self.history_token_budgets.get('default', 3000))
+    
+    def _prepare_history(self, message: str, conversation_history: list, model_to_use, image_data: str = None, summary: str = None) -> list:
+        """Обрезать историю под бюджет модели (с учетом текущего сообщения и краткого содержания) и собрать chat_history"""
+        if conversation_history:
+            budget = self._get_history_budget(model_to_use) - message_tokens(message)
+            if summary:
+                budget -= message_tokens(summary)
+            conversation_history = self.trim_history(conversation_history, max(budget, 0))
+        return self._build_chat_history(message, conversation_history, image_data, summary)
+    
+    async def get_response_async(self, message: str, conversation_history: list = None, model: str = None, providers: list = None, image_data: str = None, use_cache: bool = True, summary: str = None, timeout: float = None, priority: str = None, session_id: str = None, user_id: int = None, preferred_provider: str = None) -> Dict[str, Any]:
+        """Асинхронное получение ответа от GPT с множественными попытками
+        
+        use_cache=False отключает кэш ответов для этого запроса (нужен новый ответ).
+        summary - краткое содержание старой части разговора (ChatSession.summary).
+        timeout - общий срок на запрос в секундах (все попытки вместе), по умолчанию GPT_REQUEST_TIMEOUT.
+        priority - приоритет запроса (priority.PRIORITIES): очередь, доля слотов и выбор провайдеров.
+        session_id / user_id - для привязки к последнему удачному провайдеру сессии (affinity.ProviderAffinity).
+        preferred_provider - провайдер, с которого начать этот запрос.
+        """
+        deadline = self._make_deadline(timeout)
+        
+        routing = RoutingContext(session_id, user_id, preferred_provider)
+        await self.affinity.resolve(routing)
+        final_providers_list, model_to_use, open_circuits = self._plan_providers(model, providers, image_data, priority, routing.start_provider)
+        if image_data:
+            image_data = await self.vision_preprocessor.aprepare(image_data)
+        chat_history = self._prepare_history(message, conversation_history, model_to_use, image_data, summary)
+        
+        cache_key = self._get_cache_key(chat_history, model_to_use, image_data, use_cache, providers, preferred_provider)
+        if cache_key:
+            cached = await self._get_cached_response(cache_key)
+            if cached:
+                return cached
+        
+        # Одинаковый запрос уже выполняется (здесь или в другом процессе) - ждем его результат
+        flight = None
+        if cache_key:
+            flight, shared = await self.single_flight.join(cache_key, timeout=self._remaining(deadline))
+            if shared:
+                metrics.inc('gpt_requests_total', {'result': 'coalesced'})
+                return shared
+        
+        try:
+            async with self.request_limiter.slot(timeout=self._remaining(deadline), priority=priority):
+                timeline = AttemptTimeline()
+                result = await self._dispatch_providers(message, chat_history, final_providers_list, model_to_use, open_circuits, image_data, cache_key, deadline, priority, timeline)
+                result["attempt_timeline"] = timeline.entries
+                if result.get("success"):
+                    await self.affinity.remember(routing, result["provider_used"])
+        except LimiterOverloaded as e:
+            logger.warning("[OVERLOAD] Запрос отклонен: %s", e)
+            result = self._build_overloaded_result()
+        except BaseException:
+            if flight:
+                await asyncio.shield(flight.abort())
+            raise
+        
+        self._record_request(result)
+        if flight:
+            await flight.finish(result)
+        return result
+    
+    async def _dispatch_providers(self, message: str, chat_history: list, final_providers_list: list, model_to_use, open_circuits: list, image_data: str = None, cache_key: str = None, deadline: float = None, priority: str = None, timeline: AttemptTimeline = None) -> Dict[str, Any]:
+        """Перебор провайдеров (гонка + последовательные попытки) до первого успешного ответа"""
+        total_providers = len(set(final_providers_list))
+        
+        # Строки горячего пути - с ленивым форматированием: при выборочной записи (LOG_SAMPLE_RATES)
+        # отброшенные сообщения не форматируются
+        logger.info("[START] Начинаем обработку сообщения: '%.50s...'", message)
+        logger.info("[HISTORY] История содержит %d сообщений", len(chat_history))
+        logger.info("[MODEL] Используем модель: %s", model_to_use)
+        logger.info("[IMAGE] Изображение: %s", 'Да' if image_data else 'Нет')
+        logger.info("[PROVIDERS] Будем пробовать %d провайдеров циклически", len(final_providers_list))
+        
+        rate_limited_count = len(open_circuits)  # Провайдеры с rate limit в этом запросе
+        
+        outcomes = []  # Классы ошибок всех попыток
+        
+        # Гонка: первые race_width провайдеров стартуют почти одновременно (с hedge-задержкой)
+        start_index = 0
+        if self.race_enabled and not image_data and self.race_width > 1 and total_providers > 1:
+            race_candidates = final_providers_list[:min(self.race_width, total_providers)]
+            logger.info("[RACE] Запускаем гонку провайдеров: %s (hedge %sс)", race_candidates, self.race_hedge_delay)
+            
+            winner, failures = await self._race_providers(race_candidates, chat_history, model_to_use, image_data, deadline, priority, timeline)
+            if winner:
+                return await self._finish_success(winner, message, chat_history, cache_key)
+            
+            rate_limited_count += sum(1 for _, error_class in failures if error_class in self.RATE_LIMIT_ERRORS)
+            outcomes.extend(error_class for _, error_class in failures)
+            start_index = len(race_candidates)
+        
+        for attempt in range(start_index, len(final_providers_list)):
+            provider_name = final_providers_list[attempt]
+            
+            if deadline is not None and self._remaining(deadline) <= 0:
+                break
+            
+            # Пропускаем провайдеров, цепь которых разомкнулась во время этого запроса
+            if self.circuit_breaker.is_open(provider_name):
+                logger.info("[SKIP] Пропускаем %s - цепь разомкнута", provider_name)
+                continue
+                
+            logger.info("[ATTEMPT] Попытка %d/%d: %s", attempt + 1, len(final_providers_list), provider_name)
             
-        # Увеличиваем лимиты во много раз!
-        if len(history) > 100:  # Максимум 100 сообщений в истории (было 6)
-            history = history[-100:]
+            result, error_class = await self._attempt_provider(provider_name, chat_history, model_to_use, image_data, attempt, deadline, priority, timeline)
+            if result:
+                return await self._finish_success(result, message, chat_history, cache_key)
+            
+            outcomes.append(error_class)
+            if error_class in self.RATE_LIMIT_ERRORS:
+                # НЕ делаем паузу - сразу переходим к следующему провайдеру
+                rate_limited_count += 1
+            elif error_class == 'connection':
+                await asyncio.sleep(0.1)  # Очень короткая пауза только для сетевых проблем
         
-        # Проверяем общую длину - критический лимит
-        current_length = sum(len(str(message.get("content", ""))) for message in history)
+        if deadline is not None and self._remaining(deadline) <= 0:
+            return self._build_timeout_result(len(outcomes))
         
-        # Только если КРИТИЧЕСКИ длинно, удаляем старые сообщения
-        while history and current_length > max_length:
-            removed_message = history.pop(0)
-            current_length -= len(str(removed_message.get("content", "")))
+        if outcomes and all(outcome in self.DEADLINE_SKIPS for outcome in outcomes):
+            # Ни один провайдер не успевал в срок запроса - это таймаут, а не отказ провайдеров
+            return self._build_timeout_result(len(outcomes))
         
-        return history
+        if outcomes and all(outcome == 'busy' for outcome in outcomes):
+            # Провайдеры не отказали, просто все заняты нашими же запросами
+            logger.warning("[OVERLOAD] Все провайдеры заняты, запрос не выполнен")
+            return self._build_overloaded_result()
+        
+        return self._build_failure_result(image_data, len(final_providers_list), rate_limited_count)
+    
+    def _make_deadline(self, timeout: float = None) -> float:
+        """Абсолютный срок запроса по time.monotonic() (не зависит от event loop)"""
+        timeout = self.request_timeout if not timeout else min(timeout, self.max_request_timeout)
+        return time.monotonic() + timeout
     
-    async def get_response_async(self, message: str, conversation_history: list = None, model: str = None, providers: list = None, image_data: str = None) -> Dict[str, Any]:
-        """Асинхронное получение ответа от GPT с множественными попытками"""
+    def _remaining(self, deadline: float = None) -> float:
+        """Сколько секунд осталось до срока запроса"""
+        if deadline is None:
+            return self.attempt_timeout
+        return max(deadline - time.monotonic(), 0)
+    
+    def _get_cache_key(self, chat_history: list, model_to_use, image_data: str = None, use_cache: bool = True, providers: list = None, preferred_provider: str = None) -> Optional[str]:
+        """Ключ кэша ответов (он же ключ single-flight) или None, если кэш для запроса не применяется
         
-        # Карта моделей для vision провайдеров
-        self.vision_model_map = {
-            # ЕДИНСТВЕННЫЙ ПРОВЕРЕННЫЙ VISION ПРОВАЙДЕР (протестировано с реальным изображением)
-            'PollinationsAI': 'gpt-4o',              # ✅ ПРОТЕСТИРОВАНО - РАБОТАЕТ отлично!
-        }
+        Явно запрошенные провайдеры входят в ключ; провайдер из привязки сессии - нет,
+        он только меняет порядок перебора.
+        """
+        if not use_cache or image_data or not self.response_cache.enabled:
+            return None
+        return self.response_cache.make_key(chat_history, model_to_use, providers, preferred_provider)
+    
+    async def _get_cached_response(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Достать готовый ответ из кэша"""
+        start_time = time.time()
+        cached = await self.response_cache.aget(cache_key)
+        metrics.inc('gpt_cache_lookups_total', {'result': 'hit' if cached else 'miss'})
+        if not cached:
+            return None
+        metrics.inc('gpt_requests_total', {'result': 'cached'})
         
+        logger.info("[CACHE] Ответ найден в кэше (провайдер %s), запрос к провайдерам не нужен", cached.get('provider_used'))
+        cached = dict(cached)
+        cached["cached"] = True
+        cached["response_time"] = round(time.time() - start_time, 3)
+        return cached
+    
+    async def _finish_success(self, result: Dict[str, Any], message: str, chat_history: list, cache_key: str = None) -> Dict[str, Any]:
+        """Сформировать успешный ответ и положить его в кэш"""
+        response = self._build_success_result(result, message, chat_history)
+        if cache_key:
+            await self.response_cache.aset(cache_key, response)
+        return response
+    
+    def _build_chat_history(self, message: str, conversation_history: list = None, image_data: str = None, summary: str = None) -> list:
+        """Собрать историю разговора и текущее сообщение в формате g4f"""
         # Подготавливаем историю разговора
         chat_history = []
         
-        # Добавляем ВСЮ историю разговора (БЕЗ ОГРАНИЧЕНИЙ!)
+        # Старая часть разговора передается кратким содержанием
+        if summary:
+            chat_history.append({"role": "system", "content": f"Краткое содержание предыдущей части разговора:\n{summary}"})
+        
+        # История уже обрезана по бюджету токенов (см. _prepare_history)
         if conversation_history:
-            # Берем ВСЕ сообщения из истории
             for msg in conversation_history:  
                 if msg.get("message"):
                     user_content = str(msg.get("message", ""))
@@ -209,19 +530,29 @@ class GPTService:
                 ]
             }
             chat_history.append(current_message)
-            logger.info(f"[VISION] Добавлено сообщение с изображением. Текст: '{message[:100] if message else 'Нет текста'}'")
-            logger.info(f"[VISION] Формат изображения: {'data URL' if image_data.startswith('data:') else 'base64'}")
+            logger.info("[VISION] Добавлено сообщение с изображением. Текст: '%s'", message[:100] if message else 'Нет текста')
+            logger.info("[VISION] Формат изображения: %s", 'data URL' if image_data.startswith('data:') else 'base64')
         else:
             # Обычное текстовое сообщение
             chat_history.append({"role": "user", "content": str(message)})
         
+        return chat_history
+    
+    def _plan_providers(self, model: str = None, providers: list = None, image_data: str = None, priority: str = None, start_provider: str = None):
+        """Составить упорядоченный список попыток для запроса
+        
+        start_provider - провайдер сессии (RoutingContext.start_provider), с него начинается перебор.
+        
+        Returns:
+            Кортеж (список провайдеров для попыток, модель, провайдеры с разомкнутой цепью)
+        """
         # Определяем список провайдеров для использования
         if image_data:
             # ДЛЯ ИЗОБРАЖЕНИЙ ВСЕГДА ИСПОЛЬЗУЕМ ТОЛЬКО VISION ПРОВАЙДЕРЫ! (приоритет выше всего)
             providers_to_try = self.vision_providers
             model_to_use = 'gpt-4o'  # Лучшая модель для vision от OpenAI
-            logger.info(f"[VISION] Обнаружено изображение! Принудительно используем ТОЛЬКО vision провайдеры: {providers_to_try}")
-            logger.info(f"[VISION] Модель для vision: {model_to_use}")
+            logger.info("[VISION] Обнаружено изображение! Принудительно используем ТОЛЬКО vision провайдеры: %s", providers_to_try)
+            logger.info("[VISION] Модель для vision: %s", model_to_use)
         elif providers:
             # Конкретная модель с несколькими провайдерами (только для текста)
             providers_to_try = providers
@@ -235,15 +566,30 @@ class GPTService:
             providers_to_try = self.working_providers  # Только быстрые и средние провайдеры
             model_to_use = 'gpt-4'  # Базовая модель для авто режима
         
+        self.provider_state.ensure_started()
+        
         # Исключаем проблематичные провайдеры из всех случаев
         providers_to_try = [p for p in providers_to_try if p not in self.problematic_providers]
-        logger.info(f"[SAFETY] Исключены проблематичные провайдеры: {self.problematic_providers}")
-        logger.info(f"[FINAL] Итоговый список провайдеров: {providers_to_try}")
+        logger.info("[SAFETY] Исключены проблематичные провайдеры: %s", self.problematic_providers)
+        
+        # Упорядочиваем по живой статистике: быстрые и надежные провайдеры - первыми
+        providers_to_try = self.scoreboard.rank(providers_to_try)
+        logger.info("[FINAL] Итоговый список провайдеров: %s", providers_to_try)
         
-        # Начинаем с текущего провайдера, затем идем по кругу
+        # Начинаем с провайдера сессии, затем идем по рейтингу
+        if start_provider in providers_to_try:
+            providers_to_try.remove(start_provider)
+            providers_to_try.insert(0, start_provider)
+        
+        # Быстрые провайдеры из начала рейтинга в первую очередь достаются премиум запросам:
+        # остальные сначала идут к провайдерам, у которых есть свободные слоты для их приоритета
+        if priority_rank(priority) > 0:
+            free = [p for p in providers_to_try if self.provider_limiter.has_capacity(p, priority)]
+            if free and len(free) < len(providers_to_try):
+                busy = [p for p in providers_to_try if p not in free]
+                providers_to_try = free + busy
+                logger.info("[PRIORITY] Запрос %s: занятые провайдеры перенесены в конец: %s", priority or 'user', busy)
         current_index = 0
-        if self.current_provider in providers_to_try:
-            current_index = providers_to_try.index(self.current_provider)
         
         # Создаем циклический список провайдеров (можем пройти несколько кругов)
         final_providers_list = []
@@ -263,161 +609,511 @@ class GPTService:
         # Ограничиваем общее количество попыток
         final_providers_list = final_providers_list[:30]  # Максимум 30 попыток
         
-        logger.info(f"[START] Начинаем обработку сообщения: '{message[:50]}...'")
-        logger.info(f"[HISTORY] История содержит {len(chat_history)} сообщений")
-        logger.info(f"[MODEL] Используем модель: {model_to_use}")
-        logger.info(f"[IMAGE] Изображение: {'Да' if image_data else 'Нет'}")
-        logger.info(f"[PROVIDERS] Будем пробовать {len(final_providers_list)} провайдеров циклически")
+        # Провайдеры с разомкнутой цепью пропускаются сразу, без запроса
+        open_circuits = [p for p in providers_to_try if self.circuit_breaker.is_open(p)]
+        if open_circuits:
+            logger.info("[CIRCUIT] Пропускаем провайдеров с разомкнутой цепью: %s", open_circuits)
+            final_providers_list = [p for p in final_providers_list if p not in open_circuits]
         
-        rate_limited_providers = set()  # Отслеживаем провайдеров с rate limit
+        return final_providers_list, model_to_use, open_circuits
+    
+    async def _race_providers(self, candidates: list, chat_history: list, model_to_use, image_data: str = None, deadline: float = None, priority: str = None, timeline: AttemptTimeline = None):
+        """Гонка провайдеров: первый непустой ответ побеждает, остальные запросы отменяются
         
-        for attempt, provider_name in enumerate(final_providers_list):
-            try:
-                # Если прошли полный круг по всем провайдерам, сбрасываем rate limit список
-                if attempt > 0 and attempt % total_providers == 0:
-                    logger.info(f"[RESET] Прошли полный круг, сбрасываем rate limit список")
-                    rate_limited_providers.clear()
-                
-                # Пропускаем провайдеров, которые недавно показали rate limit
-                if provider_name in rate_limited_providers:
-                    logger.info(f"[SKIP] Пропускаем {provider_name} - недавно был rate limit")
-                    continue
-                    
-                logger.info(f"[ATTEMPT] Попытка {attempt + 1}/{len(final_providers_list)}: {provider_name}")
-                
-                # ДОПОЛНИТЕЛЬНАЯ ЗАЩИТА: если есть изображение, разрешаем только vision провайдеры
-                if image_data and provider_name not in self.vision_providers:
-                    logger.warning(f"[VISION_SKIP] Пропускаем {provider_name} - не поддерживает vision при наличии изображения")
-                    continue
-                
-                # Получаем провайдера
-                provider = self._get_provider_by_name(provider_name)
-                if not provider:
-                    logger.warning(f"[ERROR] Провайдер {provider_name} не найден в g4f")
-                    continue
-                
-                # Подготавливаем параметры запроса
-                # Для vision провайдеров используем специальные модели
-                final_model_to_use = model_to_use
-                
-                # Если это vision запрос, выбираем лучшую модель для конкретного провайдера
-                if image_data and provider_name in self.vision_model_map:
-                    vision_model = self.vision_model_map[provider_name]
-                    logger.info(f"[VISION] Для провайдера {provider_name} используем модель: {vision_model}")
-                    final_model_to_use = vision_model
-                
-                # Попробуем найти модель в g4f.models
-                if final_model_to_use:
-                    try:
-                        if hasattr(g4f.models, final_model_to_use.replace('-', '_')):
-                            final_model_to_use = getattr(g4f.models, final_model_to_use.replace('-', '_'))
-                        elif hasattr(g4f.models, final_model_to_use):
-                            final_model_to_use = getattr(g4f.models, final_model_to_use)
-                        else:
-                            # Если модель не найдена в g4f.models, используем строку
-                            final_model_to_use = final_model_to_use
-                    except Exception as e:
-                        logger.warning(f"[MODEL] Ошибка при поиске модели {final_model_to_use}: {e}")
-                        # В случае ошибки используем дефолтную модель
-                        final_model_to_use = g4f.models.default
-                else:
-                    final_model_to_use = g4f.models.default
-                
-                request_kwargs = {
-                    "model": final_model_to_use,
-                    "messages": chat_history,
-                    "provider": provider,
-                    "timeout": 120,  # Увеличиваем таймаут до 2 минут!
-                }
+        Каждый следующий провайдер стартует через race_hedge_delay секунд
+        или сразу, как только один из уже запущенных провайдеров упал.
+        
+        Returns:
+            Кортеж (результат победителя или None, список (провайдер, класс ошибки) проигравших)
+        """
+        queue = list(enumerate(candidates))
+        running = {}
+        failures = []
+        
+        try:
+            while queue or running:
+                timeout = None
+                if queue:
+                    attempt, provider_name = queue.pop(0)
+                    logger.info("[RACE] Старт %s (попытка %d)", provider_name, attempt + 1)
+                    task = asyncio.create_task(
+                        self._attempt_provider(provider_name, chat_history, model_to_use, image_data, attempt, deadline, priority, timeline)
+                    )
+                    running[task] = provider_name
+                    if queue:
+                        timeout = self.race_hedge_delay
                 
-                # Добавляем прокси только если включен и попытка > 2
-                if self.use_proxy and self.proxy and attempt > 2:
-                    request_kwargs["proxy"] = self.proxy
-                    logger.info(f"[PROXY] Используем прокси: {self.proxy}")
-                else:
-                    logger.info(f"[DIRECT] Прямое соединение (без прокси)")
+                done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
                 
+                for task in done:
+                    provider_name = running.pop(task)
+                    result, error_class = task.result()
+                    if result:
+                        if running:
+                            logger.info("[RACE] Победил %s, отменяем: %s", provider_name, list(running.values()))
+                        return result, failures
+                    failures.append((provider_name, error_class))
+        finally:
+            # Победитель найден или отменили саму гонку (клиент отключился, истек внешний срок):
+            # оставшиеся запросы останавливаем, чтобы они не держали слоты провайдеров
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running.keys(), return_exceptions=True)
+        
+        logger.warning("[RACE] Ни один участник гонки не ответил: %s", [name for name, _ in failures])
+        return None, failures
+    
+    async def _attempt_provider(self, provider_name: str, chat_history: list, model_to_use, image_data: str = None, attempt: int = 0, deadline: float = None, priority: str = None, timeline: AttemptTimeline = None):
+        """Одна попытка получить ответ от конкретного провайдера (с записью в хронологию запроса)
+        
+        Returns:
+            Кортеж (результат или None, класс ошибки или None)
+        """
+        attempt_started = time.monotonic()
+        outcome = 'cancelled'  # Останется, если попытку отменили (например, проигрыш в гонке)
+        try:
+            result, error_class = await self._call_provider(provider_name, chat_history, model_to_use, image_data, attempt, deadline, priority)
+            outcome = 'success' if result else error_class
+            return result, error_class
+        finally:
+            if timeline is not None:
+                timeline.record(provider_name, attempt_started, outcome)
+    
+    async def _call_provider(self, provider_name: str, chat_history: list, model_to_use, image_data: str = None, attempt: int = 0, deadline: float = None, priority: str = None):
+        """Запрос к провайдеру: лимит слотов, срок попытки, разбор ответа и ошибок"""
+        start_time = time.time()
+        try:
+            request_kwargs, skip_reason = self._prepare_attempt(provider_name, chat_history, model_to_use, image_data, attempt, deadline)
+            if skip_reason:
+                return None, skip_reason
+            
+            # Не больше provider_limiter одновременных запросов к одному провайдеру
+            async with self.provider_limiter.slot(provider_name, timeout=self._remaining(deadline), priority=priority):
                 # Засекаем время
                 start_time = time.time()
                 
-                # Делаем запрос как в примере
-                response = await g4f.ChatCompletion.create_async(**request_kwargs)
+                # Делаем запрос как в примере. g4f передает timeout не всем провайдерам,
+                # поэтому срок попытки ограничиваем и снаружи
+                response = await asyncio.wait_for(
+                    self._g4f().ChatCompletion.create_async(**request_kwargs),
+                    timeout=request_kwargs["timeout"]
+                )
+            
+            end_time = time.time()
+            response_time = round(end_time - start_time, 2)
+            
+            # Проверяем ответ
+            if response and len(str(response).strip()) > 0:
+                logger.info("[SUCCESS] Успех! Провайдер: %s, время: %sс", provider_name, response_time)
+                self._record_outcome(provider_name, 'success', response_time)
+                return {
+                    "response_text": str(response).strip(),
+                    "provider_used": provider_name,
+                    "attempt_number": attempt + 1,
+                    "response_time": response_time,
+                }, None
+            
+            logger.warning("[WARNING] %s вернул пустой ответ", provider_name)
+            self._record_outcome(provider_name, 'empty', response_time)
+            return None, 'empty'
                 
-                end_time = time.time()
-                response_time = round(end_time - start_time, 2)
+        except LimiterOverloaded as e:
+            # Провайдер занят нашими же запросами - это не его ошибка, просто идем дальше
+            logger.info("[BUSY] %s: %s", provider_name, e)
+            self.circuit_breaker.release(provider_name)
+            return None, 'busy'
+        except asyncio.TimeoutError as e:
+            if deadline is not None and self._remaining(deadline) <= 0:
+                # Оборвали мы сами по сроку запроса - провайдера за это не штрафуем
+                logger.warning("[DEADLINE] %s: срок запроса истек во время попытки", provider_name)
+                self.circuit_breaker.release(provider_name)
+                return None, 'deadline'
+            error_class = self._handle_attempt_error(provider_name, e, image_data, time.time() - start_time)
+            return None, error_class
+        except asyncio.CancelledError:
+            logger.info("[CANCEL] %s: запрос отменен", provider_name)
+            self.circuit_breaker.release(provider_name)
+            raise
+        except Exception as e:
+            error_class = self._handle_attempt_error(provider_name, e, image_data, time.time() - start_time)
+            return None, error_class
+    
+    def _prepare_attempt(self, provider_name: str, chat_history: list, model_to_use, image_data: str = None, attempt: int = 0, deadline: float = None):
+        """Проверить провайдера и собрать параметры запроса к g4f
+        
+        Returns:
+            Кортеж (параметры запроса или None, причина пропуска или None)
+        """
+        # ДОПОЛНИТЕЛЬНАЯ ЗАЩИТА: если есть изображение, разрешаем только vision провайдеры
+        if image_data and provider_name not in self.vision_providers:
+            logger.warning("[VISION_SKIP] Пропускаем %s - не поддерживает vision при наличии изображения", provider_name)
+            return None, 'skipped'
+        
+        # Получаем провайдера
+        provider = self._get_provider_by_name(provider_name)
+        if not provider:
+            logger.warning("[ERROR] Провайдер %s не найден в g4f", provider_name)
+            return None, 'not_found'
+        
+        remaining = self._remaining(deadline) if deadline is not None else self.attempt_timeout
+        if remaining <= 0:
+            return None, 'deadline'
+        
+        # Проверяем цепь (в half-open пропускается только один пробный запрос)
+        if not self.circuit_breaker.allow(provider_name):
+            logger.info("[CIRCUIT] %s: цепь разомкнута, пропускаем", provider_name)
+            return None, 'circuit_open'
+        
+        # Проверяем, укладывается ли провайдер в оставшийся срок запроса
+        expected_latency = self.scoreboard.expected_latency(provider_name)
+        if expected_latency > remaining and not self._claim_slow_probe(provider_name):
+            logger.info("[DEADLINE] Пропускаем %s: ожидаемое время %.1fс, осталось %.1fс", provider_name, expected_latency, remaining)
+            self.circuit_breaker.release(provider_name)  # Пробный запрос half-open достанется следующему
+            return None, 'too_slow'
+        
+        # Подготавливаем параметры запроса
+        # Для vision провайдеров используем специальные модели
+        final_model_to_use = model_to_use
+        
+        # Если это vision запрос, выбираем лучшую модель для конкретного провайдера
+        if image_data and provider_name in self.vision_model_map:
+            vision_model = self.vision_model_map[provider_name]
+            logger.info("[VISION] Для провайдера %s используем модель: %s", provider_name, vision_model)
+            final_model_to_use = vision_model
+        
+        # Модель из таблицы g4f.models (неизвестное имя уходит строкой, пустое - модель по умолчанию)
+        final_model_to_use = self.resolution.model(final_model_to_use)
+        
+        request_kwargs = {
+            "model": final_model_to_use,
+            "messages": chat_history,
+            "provider": provider,
+            "timeout": min(self.attempt_timeout, remaining),  # Не дольше оставшегося срока запроса
+        }
+        
+        # Добавляем прокси только если включен и попытка > 2
+        if self.use_proxy and self.proxy and attempt > 2:
+            request_kwargs["proxy"] = self.proxy
+            logger.info("[PROXY] Используем прокси: %s", self.proxy)
+        else:
+            logger.info("[DIRECT] Прямое соединение (без прокси)")
+        
+        return request_kwargs, None
+    
+    def _claim_slow_probe(self, provider_name: str) -> bool:
+        """Разрешить пробный запрос к провайдеру, который не укладывается в срок по оценке"""
+        now = time.monotonic()
+        if now - self._slow_probes.get(provider_name, 0) < self.slow_probe_interval:
+            return False
+        self._slow_probes[provider_name] = now
+        logger.info("[DEADLINE] %s: пробный запрос для обновления оценки задержки", provider_name)
+        return True
+    
+    def _handle_attempt_error(self, provider_name: str, error: Exception, image_data: str = None, latency: float = 0) -> str:
+        """Залогировать ошибку попытки, учесть ее в статистике и вернуть класс ошибки"""
+        error_msg = str(error)
+        if isinstance(error, asyncio.TimeoutError):
+            error_class = 'timeout'
+            logger.warning("[TIMEOUT] %s: превышен таймаут", provider_name)
+        elif isinstance(error, ConnectionError):
+            error_class = 'connection'
+            logger.warning("[CONNECTION] %s: ошибка соединения - %s", provider_name, error_msg)
+        else:
+            error_class = self._classify_error(error_msg, image_data)
+            if error_class == 'proxy':
+                logger.warning("[PROXY] %s: проблема с прокси - %s", provider_name, error_msg)
+            elif error_class == 'connection':
+                logger.warning("[CONNECTION] %s: проблема соединения - %s", provider_name, error_msg)
+            elif error_class == 'rate_limit':
+                logger.warning("[RATE_LIMIT] %s: превышен лимит запросов - %s", provider_name, error_msg)
+            elif error_class == 'blocked':
+                logger.warning("[BLOCKED] %s: заблокирован - %s", provider_name, error_msg)
+            elif error_class == 'unavailable':
+                logger.warning("[RATE_LIMIT] %s: провайдер временно недоступен - %s", provider_name, error_msg)
+            elif error_class == 'vision':
+                logger.warning("[VISION_ERROR] %s: ошибка обработки изображения - %s", provider_name, error_msg)
+            elif error_class == 'vision_unsupported':
+                logger.warning("[VISION_UNSUPPORTED] %s: не поддерживает изображения - %s", provider_name, error_msg)
+            else:
+                logger.warning("[ERROR] %s: %s", provider_name, error_msg)
+        
+        self._record_outcome(provider_name, error_class, latency, error_msg)
+        return error_class
+    
+    async def stream_response(self, message: str, conversation_history: list = None, model: str = None, providers: list = None, image_data: str = None, use_cache: bool = True, summary: str = None, timeout: float = None, priority: str = None, session_id: str = None, user_id: int = None, preferred_provider: str = None):
+        """Потоковое получение ответа от GPT (асинхронный генератор)
+        
+        Провайдеры перебираются последовательно (без гонки): пока не пришел первый
+        фрагмент, ошибка провайдера просто переключает на следующего.
+        
+        Yields:
+            {"type": "chunk", "content": str} - очередной фрагмент текста
+            {"type": "reset"} - провайдер упал посреди ответа, накопленный текст нужно сбросить
+            {"type": "done", "result": dict} - итог в формате get_response_async
+        """
+        deadline = self._make_deadline(timeout)
+        
+        routing = RoutingContext(session_id, user_id, preferred_provider)
+        await self.affinity.resolve(routing)
+        final_providers_list, model_to_use, open_circuits = self._plan_providers(model, providers, image_data, priority, routing.start_provider)
+        if image_data:
+            image_data = await self.vision_preprocessor.aprepare(image_data)
+        chat_history = self._prepare_history(message, conversation_history, model_to_use, image_data, summary)
+        
+        cache_key = self._get_cache_key(chat_history, model_to_use, image_data, use_cache, providers, preferred_provider)
+        if cache_key:
+            cached = await self._get_cached_response(cache_key)
+            if cached:
+                yield {"type": "chunk", "content": cached["raw_response"]}
+                yield {"type": "done", "result": cached}
+                return
+        
+        flight = None
+        if cache_key:
+            flight, shared = await self.single_flight.join(cache_key, timeout=self._remaining(deadline))
+            if shared:
+                metrics.inc('gpt_requests_total', {'result': 'coalesced'})
+                # Ответ получил другой такой же запрос - отдаем его одним фрагментом
+                if shared.get("success"):
+                    yield {"type": "chunk", "content": shared["raw_response"]}
+                yield {"type": "done", "result": shared}
+                return
+        
+        try:
+            try:
+                await self.request_limiter.acquire(timeout=self._remaining(deadline), priority=priority)
+            except LimiterOverloaded as e:
+                logger.warning("[OVERLOAD] Потоковый запрос отклонен: %s", e)
+                result = self._build_overloaded_result()
+                self._record_request(result)
+                if flight:
+                    await flight.finish(result)
+                yield {"type": "done", "result": result}
+                return
+            
+            try:
+                timeline = AttemptTimeline()
+                async for event in self._stream_providers(message, chat_history, final_providers_list, model_to_use, open_circuits, image_data, cache_key, deadline, priority, timeline):
+                    if event["type"] == "done":
+                        event["result"]["attempt_timeline"] = timeline.entries
+                        if event["result"].get("success"):
+                            await self.affinity.remember(routing, event["result"]["provider_used"])
+                        self._record_request(event["result"])
+                        if flight:
+                            await flight.finish(event["result"])
+                    yield event
+            finally:
+                self.request_limiter.release()
+        finally:
+            if flight:
+                # Лидер отменен или упал до результата - ожидающие выполнят запрос сами
+                await asyncio.shield(flight.abort())
+    
+    async def _stream_providers(self, message: str, chat_history: list, final_providers_list: list, model_to_use, open_circuits: list, image_data: str = None, cache_key: str = None, deadline: float = None, priority: str = None, timeline: AttemptTimeline = None):
+        """Последовательный потоковый перебор провайдеров (события как в stream_response)
+        
+        Первый фрагмент ждем не дольше attempt_timeout и оставшегося срока запроса;
+        начатый ответ дочитывается, пока провайдер не замолчит дольше attempt_timeout.
+        """
+        logger.info("[STREAM] Начинаем потоковую обработку: '%.50s...'", message)
+        logger.info("[PROVIDERS] Будем пробовать %d провайдеров последовательно", len(final_providers_list))
+        
+        rate_limited_count = len(open_circuits)
+        if timeline is None:
+            timeline = AttemptTimeline()
+        
+        for attempt, provider_name in enumerate(final_providers_list):
+            if self._remaining(deadline) <= 0:
+                yield {"type": "done", "result": self._build_timeout_result(attempt)}
+                return
+            
+            if self.circuit_breaker.is_open(provider_name):
+                logger.info("[SKIP] Пропускаем %s - цепь разомкнута", provider_name)
+                continue
+            
+            logger.info("[ATTEMPT] Потоковая попытка %d/%d: %s", attempt + 1, len(final_providers_list), provider_name)
+            
+            parts = []
+            start_time = time.time()
+            attempt_started = time.monotonic()
+            try:
+                request_kwargs, skip_reason = self._prepare_attempt(provider_name, chat_history, model_to_use, image_data, attempt, deadline)
+                if skip_reason:
+                    timeline.record(provider_name, attempt_started, skip_reason)
+                    continue
                 
-                # Проверяем ответ
-                if response and len(str(response).strip()) > 0:
-                    response_text = str(response).strip()
-                    
-                    # Применяем форматирование как в ChatGPT
-                    formatted_response = self.format_response(response_text)
-                    
-                    logger.info(f"[SUCCESS] Успех! Провайдер: {provider_name}, время: {response_time}с")
-                    
-                    # Обновляем статистику
-                    self.provider_stats[provider_name] = self.provider_stats.get(provider_name, 0) + 1
-                    self.current_provider = provider_name
-                    
-                    return {
-                        "success": True,
-                        "response": formatted_response,  # Возвращаем отформатированный ответ
-                        "raw_response": response_text,   # Сохраняем оригинал для отладки
-                        "model_used": "gpt-3.5-turbo",
-                        "provider_used": provider_name,
-                        "attempt_number": attempt + 1,
-                        "response_time": response_time,
-                        "proxy_used": self.use_proxy,
-                        "message_length": len(message),
-                        "history_length": len(chat_history)
-                    }
-                else:
-                    logger.warning(f"[WARNING] {provider_name} вернул пустой ответ")
+                async with self.provider_limiter.slot(provider_name, timeout=self._remaining(deadline), priority=priority):
+                    start_time = time.time()
+                    stream = self._stream_provider(request_kwargs)
+                    try:
+                        while True:
+                            # Первый фрагмент ждем не дольше одной попытки: молчащий провайдер
+                            # не должен забирать весь срок запроса у следующих
+                            wait = self.attempt_timeout if parts else min(self.attempt_timeout, self._remaining(deadline))
+                            try:
+                                chunk = await asyncio.wait_for(stream.__anext__(), timeout=wait)
+                            except StopAsyncIteration:
+                                break
+                            parts.append(chunk)
+                            yield {"type": "chunk", "content": chunk}
+                    finally:
+                        await stream.aclose()
                     
-            except asyncio.TimeoutError:
-                logger.warning(f"[TIMEOUT] {provider_name}: превышен таймаут")
+            except LimiterOverloaded as e:
+                logger.info("[BUSY] %s: %s", provider_name, e)
+                self.circuit_breaker.release(provider_name)
+                timeline.record(provider_name, attempt_started, 'busy')
                 continue
-            except ConnectionError as e:
-                logger.warning(f"[CONNECTION] {provider_name}: ошибка соединения - {str(e)}")
+            except asyncio.TimeoutError as e:
+                if not parts and self._remaining(deadline) <= 0:
+                    logger.warning("[DEADLINE] %s: срок запроса истек до первого фрагмента", provider_name)
+                    self.circuit_breaker.release(provider_name)
+                    timeline.record(provider_name, attempt_started, 'deadline')
+                    yield {"type": "done", "result": self._build_timeout_result(attempt + 1)}
+                    return
+                error_class = self._handle_attempt_error(provider_name, e, image_data, time.time() - start_time)
+                timeline.record(provider_name, attempt_started, error_class)
+                if parts:
+                    logger.warning("[STREAM] %s замолчал посреди ответа, переключаемся на следующего провайдера", provider_name)
+                    yield {"type": "reset"}
                 continue
+            except (asyncio.CancelledError, GeneratorExit):
+                # GeneratorExit - потребитель закрыл генератор (aclose) на yield фрагмента
+                logger.info("[CANCEL] %s: потоковый запрос отменен", provider_name)
+                self.circuit_breaker.release(provider_name)
+                timeline.record(provider_name, attempt_started, 'cancelled')
+                raise
             except Exception as e:
-                error_msg = str(e)
-                if "proxy" in error_msg.lower():
-                    logger.warning(f"[PROXY] {provider_name}: проблема с прокси - {error_msg}")
-                elif "connection" in error_msg.lower() or "network" in error_msg.lower():
-                    logger.warning(f"[CONNECTION] {provider_name}: проблема соединения - {error_msg}")
-                elif "rate" in error_msg.lower() or "limit" in error_msg.lower() or "429" in error_msg:
-                    logger.warning(f"[RATE_LIMIT] {provider_name}: превышен лимит запросов - {error_msg}")
-                    # Добавляем провайдера в список с rate limit
-                    rate_limited_providers.add(provider_name)
-                    # НЕ делаем паузу - сразу переходим к следующему провайдеру
-                    continue
-                elif "block" in error_msg.lower() or "forbidden" in error_msg.lower():
-                    logger.warning(f"[BLOCKED] {provider_name}: заблокирован - {error_msg}")
-                elif "available in" in error_msg.lower():
-                    logger.warning(f"[RATE_LIMIT] {provider_name}: провайдер временно недоступен - {error_msg}")
-                    # Добавляем провайдера в список с rate limit
-                    rate_limited_providers.add(provider_name)
-                    # НЕ делаем паузу - сразу переходим к следующему провайдеру
-                    continue
-                elif image_data and ("vision" in error_msg.lower() or "image" in error_msg.lower() or "multimodal" in error_msg.lower()):
-                    logger.warning(f"[VISION_ERROR] {provider_name}: ошибка обработки изображения - {error_msg}")
-                    # Для vision ошибок сразу переходим к следующему провайдеру
-                    continue
-                elif image_data and "unsupported" in error_msg.lower():
-                    logger.warning(f"[VISION_UNSUPPORTED] {provider_name}: не поддерживает изображения - {error_msg}")
-                    continue
-                else:
-                    logger.warning(f"[ERROR] {provider_name}: {error_msg}")
+                error_class = self._handle_attempt_error(provider_name, e, image_data, time.time() - start_time)
+                timeline.record(provider_name, attempt_started, error_class)
+                if error_class in self.RATE_LIMIT_ERRORS:
+                    rate_limited_count += 1
+                if parts:
+                    # Часть ответа уже ушла клиенту - просим сбросить ее и переключаемся
+                    logger.warning("[STREAM] %s оборвал ответ, переключаемся на следующего провайдера", provider_name)
+                    yield {"type": "reset"}
                 continue
             
-            # Минимальная пауза только для сетевых ошибок
-            if "connection" in str(e).lower() or "network" in str(e).lower():
-                await asyncio.sleep(0.1)  # Очень короткая пауза только для сетевых проблем
+            response_time = round(time.time() - start_time, 2)
+            response_text = ''.join(parts).strip()
+            if response_text:
+                logger.info("[SUCCESS] Потоковый ответ! Провайдер: %s, время: %sс", provider_name, response_time)
+                self._record_outcome(provider_name, 'success', response_time)
+                timeline.record(provider_name, attempt_started, 'success')
+                result = {
+                    "response_text": response_text,
+                    "provider_used": provider_name,
+                    "attempt_number": attempt + 1,
+                    "response_time": response_time,
+                }
+                yield {"type": "done", "result": await self._finish_success(result, message, chat_history, cache_key)}
+                return
+            
+            logger.warning("[WARNING] %s вернул пустой ответ", provider_name)
+            self._record_outcome(provider_name, 'empty', response_time)
+            timeline.record(provider_name, attempt_started, 'empty')
         
-        # Если все провайдеры не сработали
+        outcomes = [entry[3] for entry in timeline.entries]
+        if outcomes and all(outcome in self.DEADLINE_SKIPS for outcome in outcomes):
+            yield {"type": "done", "result": self._build_timeout_result(len(outcomes))}
+            return
+        
+        yield {"type": "done", "result": self._build_failure_result(image_data, len(final_providers_list), rate_limited_count)}
+    
+    async def _stream_provider(self, request_kwargs: Dict[str, Any]):
+        """Потоковый запрос к провайдеру через g4f: отдает текстовые фрагменты по мере получения"""
+        try:
+            result = self._g4f().ChatCompletion.create_async(stream=True, **request_kwargs)
+            # В разных версиях g4f потоковый create_async - корутина или сразу асинхронный генератор
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            if "stream" not in str(e).lower():
+                raise
+            # Провайдер не поддерживает stream - получаем ответ целиком одним фрагментом
+            logger.info("[STREAM] Провайдер не поддерживает потоковый режим, запрашиваем ответ целиком")
+            result = await self._g4f().ChatCompletion.create_async(**request_kwargs)
+        
+        if hasattr(result, '__aiter__'):
+            async for chunk in result:
+                # Помимо текста g4f может отдавать служебные объекты (причина остановки и т.п.)
+                if isinstance(chunk, str) and chunk:
+                    yield chunk
+        elif result:
+            yield str(result)
+    
+    def _record_outcome(self, provider_name: str, outcome: str, latency: float, error_msg: str = None):
+        """Учесть исход попытки в статистике провайдеров, circuit breaker и метриках"""
+        self.scoreboard.record(provider_name, outcome, latency)
+        metrics.inc('gpt_provider_attempts_total', {'provider': provider_name})
+        metrics.inc('gpt_provider_outcomes_total', {'provider': provider_name, 'outcome': outcome})
+        metrics.observe('gpt_provider_latency_seconds', latency, {'provider': provider_name})
+        if outcome == 'success':
+            self.circuit_breaker.record_success(provider_name)
+        else:
+            self.circuit_breaker.record_failure(provider_name, outcome, self._parse_retry_after(error_msg))
+    
+    def _record_request(self, result: Dict[str, Any]):
+        """Учесть итог запроса в метриках (исход и число попыток)"""
+        if result.get("success"):
+            outcome, attempts = 'success', result.get("attempt_number")
+        elif result.get("timed_out"):
+            outcome, attempts = 'timeout', result.get("total_attempts")
+        elif result.get("overloaded"):
+            outcome, attempts = 'overloaded', None
+        else:
+            outcome, attempts = 'failed', result.get("total_attempts")
+        metrics.inc('gpt_requests_total', {'result': outcome})
+        if attempts:
+            metrics.observe('gpt_request_attempts', attempts)
+    
+    def _limiter_gauges(self) -> Dict[str, float]:
+        """Загрузка лимитеров процесса для метрик gpt_in_flight / gpt_queue_depth"""
+        gauges = {metric_series('gpt_in_flight', {'limiter': self.request_limiter.name}): 0}
+        for limiter in (self.request_limiter, self.provider_limiter):
+            for key, slot in limiter.snapshot()["slots"].items():
+                labels = {'limiter': limiter.name}
+                if key != '*':
+                    labels['provider'] = key
+                gauges[metric_series('gpt_in_flight', labels)] = slot["active"]
+                for priority, waiting in slot["waiting_by_priority"].items():
+                    gauges[metric_series('gpt_queue_depth', {**labels, 'priority': priority})] = waiting
+        return gauges
+    
+    def _parse_retry_after(self, error_msg: str = None) -> Optional[float]:
+        """Извлечь время ожидания из сообщения провайдера ("available in 30s", "retry after 2 minutes")"""
+        if not error_msg:
+            return None
+        match = re.search(r'(\d+)\s*(s|sec|seconds?|секунд\w*|m|min|minutes?|минут\w*)\b', error_msg.lower())
+        if not match:
+            return None
+        value = int(match.group(1))
+        return value * 60 if match.group(2).startswith(('m', 'мин')) else value
+    
+    def _classify_error(self, error_msg: str, image_data: str = None) -> str:
+        """Определить класс ошибки провайдера по тексту исключения"""
+        lowered = error_msg.lower()
+        if "proxy" in lowered:
+            return 'proxy'
+        if "connection" in lowered or "network" in lowered:
+            return 'connection'
+        if "rate" in lowered or "limit" in lowered or "429" in error_msg:
+            return 'rate_limit'
+        if "block" in lowered or "forbidden" in lowered:
+            return 'blocked'
+        if "available in" in lowered:
+            return 'unavailable'
+        if image_data and ("vision" in lowered or "image" in lowered or "multimodal" in lowered):
+            return 'vision'
+        if image_data and "unsupported" in lowered:
+            return 'vision_unsupported'
+        return 'error'
+    
+    def _build_failure_result(self, image_data: str = None, total_attempts: int = 0, rate_limited_count: int = 0) -> Dict[str, Any]:
+        """Сформировать ответ, когда все провайдеры не сработали"""
         error_type = "vision провайдеры" if image_data else "провайдеры"
-        logger.error(f"[FAILED] Все {error_type} недоступны! Попробовано: {len(final_providers_list)}, rate limited: {len(rate_limited_providers)}")
+        logger.error("[FAILED] Все %s недоступны! Попробовано: %s, rate limited: %s", error_type, total_attempts, rate_limited_count)
         
         error_response = f"Извините, сейчас все AI {error_type} недоступны. Попробуйте позже"
         if image_data:
@@ -428,36 +1124,82 @@ class GPTService:
             "success": False,
             "error": f"Все {error_type} недоступны",
             "response": error_response,
-            "total_attempts": len(final_providers_list),
-            "rate_limited_count": len(rate_limited_providers),
+            "total_attempts": total_attempts,
+            "rate_limited_count": rate_limited_count,
             "provider_stats": self.provider_stats,
             "image_request": bool(image_data)
         }
     
+    @staticmethod
+    def _build_timeout_result(total_attempts: int = 0) -> Dict[str, Any]:
+        """Результат для запроса, срок которого истек раньше, чем пришел ответ"""
+        logger.error("[TIMEOUT] Срок запроса истек, попыток: %s", total_attempts)
+        return {
+            "success": False,
+            "timed_out": True,
+            "error": "Превышено время ожидания ответа",
+            "response": "Провайдеры не успели ответить вовремя. Попробуйте еще раз.",
+            "total_attempts": total_attempts,
+        }
+    
+    @staticmethod
+    def _build_overloaded_result() -> Dict[str, Any]:
+        """Результат для запроса, не дождавшегося очереди (сервис перегружен)"""
+        return {
+            "success": False,
+            "overloaded": True,
+            "error": "Сервис перегружен",
+            "response": "Сейчас слишком много запросов. Попробуйте еще раз через несколько секунд."
+        }
+    
+    def _build_success_result(self, result: Dict[str, Any], message: str, chat_history: list) -> Dict[str, Any]:
+        """Сформировать ответ по результату успешной попытки и обновить статистику"""
+        provider_name = result["provider_used"]
+        response_text = result["response_text"]
+        
+        # Применяем форматирование как в ChatGPT
+        formatted_response = self.format_response(response_text)
+        
+        # Обновляем статистику
+        self.provider_state.record_success(provider_name)
+        
+        return {
+            "success": True,
+            "response": formatted_response,  # Возвращаем отформатированный ответ
+            "raw_response": response_text,   # Сохраняем оригинал для отладки
+            "model_used": "gpt-3.5-turbo",
+            "provider_used": provider_name,
+            "attempt_number": result["attempt_number"],
+            "response_time": result["response_time"],
+            "proxy_used": self.use_proxy,
+            "message_length": len(message),
+            "history_length": len(chat_history)
+        }
+    
+    @staticmethod
+    def _g4f():
+        """Модуль g4f (к моменту вызова уже импортирован при создании ResolutionTable)"""
+        import g4f
+        return g4f
+    
     def _get_provider_by_name(self, provider_name: str):
-        """Получить провайдера по имени"""
-        try:
-            if hasattr(g4f.Provider, provider_name):
-                return getattr(g4f.Provider, provider_name)
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка получения провайдера {provider_name}: {e}")
-            return None
+        """Получить провайдера по имени (из таблицы ResolutionTable)"""
+        return self.resolution.provider(provider_name)
     
-    def get_response_sync(self, message: str, conversation_history: list = None, model: str = None, providers: list = None, image_data: str = None) -> Dict[str, Any]:
+    def get_response_sync(self, message: str, conversation_history: list = None, model: str = None, providers: list = None, image_data: str = None, use_cache: bool = True, summary: str = None, timeout: float = None, priority: str = None, session_id: str = None, user_id: int = None, preferred_provider: str = None) -> Dict[str, Any]:
         """Синхронное получение ответа от GPT"""
         try:
             # Простое выполнение асинхронной функции
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             try:
-                result = loop.run_until_complete(self.get_response_async(message, conversation_history, model, providers, image_data))
+                result = loop.run_until_complete(self.get_response_async(message, conversation_history, model, providers, image_data, use_cache, summary, timeout, priority, session_id, user_id, preferred_provider))
                 return result
             finally:
                 loop.close()
                 
         except Exception as e:
-            logger.error(f"Критическая ошибка: {str(e)}")
+            logger.error("Критическая ошибка: %s", str(e))
             return {
                 "success": False,
                 "error": str(e),
@@ -465,13 +1207,14 @@ class GPTService:
             }
     
     def get_current_provider(self) -> str:
-        """Получить текущего провайдера"""
-        return self.current_provider
+        """Провайдер, с которого начнется запрос без привязки к сессии (лучший по рейтингу)"""
+        ranked = self.scoreboard.rank([p for p in self.working_providers if p not in self.problematic_providers])
+        return next((p for p in ranked if not self.circuit_breaker.is_open(p)), ranked[0] if ranked else None)
     
     def get_provider_info(self) -> Dict[str, Any]:
         """Получить информацию о провайдерах"""
         return {
-            "current": self.current_provider,
+            "current": self.get_current_provider(),
             "model": str(self.default_model),
             "proxy": self.proxy if self.use_proxy else None,
             "proxy_enabled": self.use_proxy,
@@ -479,6 +1222,14 @@ class GPTService:
             "backup_providers": len(self.backup_providers),
             "vision_providers": len(self.vision_providers),
             "provider_stats": self.provider_stats,
+            "provider_scores": self.scoreboard.snapshot(),
+            "circuits": self.circuit_breaker.snapshot(),
+            "cache": self.response_cache.get_stats(),
+            "coalesced_requests": self.single_flight.coalesced,
+            "load": {
+                "requests": self.request_limiter.snapshot(),
+                "providers": self.provider_limiter.snapshot(),
+            },
             "all": self.get_all_providers(),
             "vision_list": self.vision_providers,
             "no_vision_list": self.no_vision_providers,
@@ -602,23 +1353,27 @@ class GPTService:
         
         return formatted_text.strip()
     
-    def change_provider(self, provider_name: str) -> bool:
-        """Изменить текущего провайдера"""
+    def change_provider(self, provider_name: str, session_id: str = None, user_id: int = None) -> bool:
+        """Назначить провайдера сессии и/или пользователю (остальные запросы не затрагиваются)"""
         try:
             all_providers = self.get_all_providers()
-            if provider_name in all_providers:
-                self.current_provider = provider_name
-                logger.info(f"Провайдер изменен на {provider_name}")
-                return True
-            else:
-                logger.warning(f"Провайдер {provider_name} не найден в списке доступных")
+            if provider_name not in all_providers:
+                logger.warning("Провайдер %s не найден в списке доступных", provider_name)
+                return False
+            if not self.affinity.set(RoutingContext(session_id, user_id), provider_name):
+                logger.warning("Провайдер %s не назначен: не указаны сессия или пользователь", provider_name)
                 return False
+            logger.info("Провайдер сессии %s / пользователя %s изменен на %s", session_id, user_id, provider_name)
+            return True
         except Exception as e:
-            logger.error(f"Ошибка при смене провайдера: {e}")
+            logger.error("Ошибка при смене провайдера: %s", e)
             return False
 
     async def generate_image(self, prompt: str, provider_name: str = None) -> Dict[str, Any]:
-        """Генерация изображения из текстового описания
+        """Генерация изображения из текстового описания (один проход по провайдерам)
+        
+        Запросы от пользователей идут через очередь image_jobs: там провайдеры с исчерпанной
+        квотой не опрашиваются повторно до ее сброса.
         
         Args:
             prompt: Текстовое описание изображения для генерации
@@ -627,17 +1382,9 @@ class GPTService:
         Returns:
             Словарь с данными изображения или информацией об ошибке
         """
-        # Если провайдер не указан, используем циклический перебор всех доступных
-        try_all_providers = provider_name is None
-        
-        # Создаём список провайдеров для перебора
-        providers_to_try = []
-        
-        if try_all_providers:
+        if provider_name is None:
             # Пробуем все доступные провайдеры изображений
             providers_to_try = self.image_providers.copy()
-            # Дублируем список для второго прохода на случай неудачи
-            providers_to_try = providers_to_try + providers_to_try
         else:
             # Если указан конкретный провайдер, проверяем его допустимость
             if provider_name not in self.image_providers:
@@ -652,121 +1399,16 @@ class GPTService:
         quota_errors = []
         last_error = None
         
-        logger.info(f"[IMAGE] Начинаем генерацию изображения: '{prompt[:50]}...'")
+        logger.info("[IMAGE] Начинаем генерацию изображения: '%s...'", prompt[:50])
         
         # Перебираем провайдеры до первого успеха
         for current_provider in providers_to_try:
-            try:
-                logger.info(f"[IMAGE] Попытка генерации с провайдером: {current_provider}")
-                
-                # Получаем провайдер
-                provider = self._get_provider_by_name(current_provider)
-                if not provider:
-                    logger.warning(f"[IMAGE] Провайдер {current_provider} не найден в g4f")
-                    continue
-                
-                # Измеряем время выполнения
-                start_time = time.time()
-                
-                # Ограничение по времени
-                timeout_seconds = 60  # 60 секунд максимум
-                
-                # Создаем сообщения для запроса (некоторые провайдеры требуют этот формат)
-                messages = [{"role": "user", "content": prompt}]
-                
-                # Отправляем запрос на генерацию изображения с таймаутом
-                if current_provider == "ImageLabs":
-                    # ImageLabs требует model и messages
-                    image_data = await asyncio.wait_for(
-                        g4f.ChatCompletion.create_async(
-                            model=g4f.models.default,
-                            messages=messages,
-                            provider=provider,
-                            # Дополнительные параметры для генерации изображений
-                            **{"prompt": prompt, "image_model": "sd_xl_base_1.0"}
-                        ),
-                        timeout=timeout_seconds
-                    )
-                elif current_provider == "BlackForestLabs_Flux1Dev":
-                    # BlackForestLabs Flux.1 Dev
-                    image_data = await asyncio.wait_for(
-                        g4f.ChatCompletion.create_async(
-                            model=g4f.models.default,
-                            messages=messages,
-                            provider=provider,
-                            **{"prompt": prompt}
-                        ),
-                        timeout=timeout_seconds
-                    )
-                else:
-                    # Универсальный подход для других провайдеров
-                    image_data = await asyncio.wait_for(
-                        g4f.ChatCompletion.create_async(
-                            model=g4f.models.default,
-                            messages=messages,
-                            provider=provider
-                        ),
-                        timeout=timeout_seconds
-                    )
-                
-                end_time = time.time()
-                response_time = round(end_time - start_time, 2)
-                
-                # Проверяем, что ответ не пустой
-                if not image_data:
-                    logger.warning(f"[IMAGE] Пустой ответ от провайдера {current_provider}")
-                    continue
-                
-                # Проверяем на наличие сообщения о превышении квоты
-                if isinstance(image_data, str) and any(keyword in image_data.lower() for keyword in 
-                                                       ["quota", "квота", "exceeded", "limit", "wait", "ожидание"]):
-                    # Извлекаем время ожидания из сообщения
-                    import re
-                    wait_time_match = re.search(r'(\d+)\s*(s|sec|seconds|секунд)', image_data.lower())
-                    wait_time = wait_time_match.group(1) if wait_time_match else "неизвестно"
-                    
-                    error_msg = f"Квота провайдера {current_provider} исчерпана. Время ожидания: {wait_time} секунд"
-                    logger.warning(f"[IMAGE] {error_msg}")
-                    quota_errors.append(error_msg)
-                    continue
-                
-                # Извлекаем URL изображения из ответа
-                image_url = self._extract_image_url(image_data)
-                
-                logger.info(f"[IMAGE] SUCCESS! Провайдер: {current_provider}, время: {response_time}с")
-                
-                # Возвращаем успешный результат
-                return {
-                    "success": True,
-                    "image_url": image_url,
-                    "image_data": image_data,
-                    "provider": current_provider,
-                    "response_time": response_time,
-                    "prompt": prompt
-                }
-                
-            except asyncio.TimeoutError:
-                logger.warning(f"[IMAGE] Таймаут при генерации изображения с {current_provider}")
-                last_error = f"Превышено время ожидания ответа от {current_provider}"
-                continue
-                
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"[IMAGE] Ошибка при генерации изображения с {current_provider}: {error_msg}")
-                
-                # Проверяем на ошибку квоты
-                if any(keyword in error_msg.lower() for keyword in ["quota", "квота", "exceeded", "gpu quota", "limit"]):
-                    import re
-                    wait_time_match = re.search(r'(\d+)\s*(s|sec|seconds|секунд)', error_msg.lower())
-                    wait_time = wait_time_match.group(1) if wait_time_match else "неизвестно"
-                    
-                    quota_error = f"Квота провайдера {current_provider} исчерпана. Время ожидания: {wait_time} секунд"
-                    quota_errors.append(quota_error)
-                    last_error = quota_error
-                else:
-                    last_error = f"Ошибка провайдера {current_provider}: {error_msg}"
-                
-                continue
+            result = await self.generate_image_attempt(prompt, current_provider)
+            if result["success"]:
+                return result
+            if result.get("quota"):
+                quota_errors.append(result["error"])
+            last_error = result["error"]
         
         # Если все провайдеры не сработали
         if quota_errors:
@@ -784,6 +1426,82 @@ class GPTService:
                 "message": "Не удалось сгенерировать изображение. Пожалуйста, попробуйте другой запрос."
             }
     
+    async def generate_image_attempt(self, prompt: str, provider_name: str, timeout: float = 60) -> Dict[str, Any]:
+        """Одна попытка генерации изображения у конкретного провайдера
+        
+        Returns:
+            При успехе - данные изображения ("success": True). При ошибке - "error", "quota"
+            (провайдер сообщил об исчерпанной квоте) и "retry_after" - через сколько секунд
+            квота сбросится, если провайдер это сообщил
+        """
+        logger.info("[IMAGE] Попытка генерации с провайдером: %s", provider_name)
+        
+        # Получаем провайдер
+        provider = self._get_provider_by_name(provider_name)
+        if not provider:
+            logger.warning("[IMAGE] Провайдер %s не найден в g4f", provider_name)
+            return {"success": False, "error": f"Провайдер {provider_name} не найден", "quota": False, "retry_after": None}
+        
+        # Создаем сообщения для запроса (некоторые провайдеры требуют этот формат)
+        request_kwargs = {
+            "model": self.default_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "provider": provider,
+        }
+        if provider_name == "ImageLabs":
+            # ImageLabs требует model и messages
+            request_kwargs.update({"prompt": prompt, "image_model": "sd_xl_base_1.0"})
+        elif provider_name == "BlackForestLabs_Flux1Dev":
+            # BlackForestLabs Flux.1 Dev
+            request_kwargs["prompt"] = prompt
+        
+        start_time = time.time()
+        try:
+            image_data = await asyncio.wait_for(self._g4f().ChatCompletion.create_async(**request_kwargs), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("[IMAGE] Таймаут при генерации изображения с %s", provider_name)
+            return {"success": False, "error": f"Превышено время ожидания ответа от {provider_name}", "quota": False, "retry_after": None}
+        except Exception as e:
+            error_msg = str(e)
+            logger.error("[IMAGE] Ошибка при генерации изображения с %s: %s", provider_name, error_msg)
+            if any(keyword in error_msg.lower() for keyword in ["quota", "квота", "exceeded", "gpu quota", "limit"]):
+                return self._build_image_quota_result(provider_name, error_msg)
+            return {"success": False, "error": f"Ошибка провайдера {provider_name}: {error_msg}", "quota": False, "retry_after": None}
+        
+        response_time = round(time.time() - start_time, 2)
+        
+        # Проверяем, что ответ не пустой
+        if not image_data:
+            logger.warning("[IMAGE] Пустой ответ от провайдера %s", provider_name)
+            return {"success": False, "error": f"Пустой ответ от провайдера {provider_name}", "quota": False, "retry_after": None}
+        
+        # Проверяем на наличие сообщения о превышении квоты
+        if isinstance(image_data, str) and any(keyword in image_data.lower() for keyword in
+                                               ["quota", "квота", "exceeded", "limit", "wait", "ожидание"]):
+            return self._build_image_quota_result(provider_name, image_data)
+        
+        # Извлекаем URL изображения из ответа
+        image_url = self._extract_image_url(image_data)
+        
+        logger.info("[IMAGE] SUCCESS! Провайдер: %s, время: %sс", provider_name, response_time)
+        
+        return {
+            "success": True,
+            "image_url": image_url,
+            "image_data": image_data,
+            "provider": provider_name,
+            "response_time": response_time,
+            "prompt": prompt
+        }
+    
+    def _build_image_quota_result(self, provider_name: str, message: str) -> Dict[str, Any]:
+        """Результат попытки, на которой провайдер сообщил об исчерпанной квоте"""
+        retry_after = self._parse_retry_after(message)
+        wait_time = f"{retry_after:.0f}" if retry_after is not None else "неизвестно"
+        error_msg = f"Квота провайдера {provider_name} исчерпана. Время ожидания: {wait_time} секунд"
+        logger.warning("[IMAGE] %s", error_msg)
+        return {"success": False, "error": error_msg, "quota": True, "retry_after": retry_after}
+    
     def _extract_image_url(self, text):
         """Универсальная функция для извлечения URL изображения из разных форматов текста"""
         if not text or not isinstance(text, str):
@@ -823,5 +1541,44 @@ class GPTService:
             
         return None
 
-# Создаем глобальный экземпляр сервиса
-gpt_service = GPTService()
+_gpt_service = None
+_gpt_service_lock = threading.Lock()
+
+
+def get_gpt_service() -> GPTService:
+    """Общий экземпляр сервиса: создается (вместе с импортом g4f) при первом обращении"""
+    global _gpt_service
+    if _gpt_service is None:
+        with _gpt_service_lock:
+            if _gpt_service is None:
+                _gpt_service = GPTService()
+    return _gpt_service
+
+
+async def aget_gpt_service() -> GPTService:
+    """get_gpt_service() для асинхронного кода: первое создание (импорт g4f) идет в потоке, а не в event loop"""
+    if _gpt_service is not None:
+        return _gpt_service
+    return await sync_to_async(get_gpt_service, thread_sensitive=False)()
+
+
+def warm_gpt_service():
+    """Создать сервис в фоновом потоке при старте веб-процесса
+    
+    g4f импортируется, а ненайденные провайдеры и модели попадают в лог при запуске,
+    а не на первом запросе. Импорт точки входа при этом не замедляется.
+    """
+    def build():
+        try:
+            get_gpt_service()
+        except Exception:
+            logger.exception("[STARTUP] Не удалось создать GPTService")
+    
+    threading.Thread(target=build, name='gpt-service-warmup', daemon=True).start()
+
+
+def __getattr__(name):
+    # Совместимость со старым `from chat_app.gpt_service import gpt_service`
+    if name == 'gpt_service':
+        return get_gpt_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
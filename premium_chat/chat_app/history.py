@@ -0,0 +1,50 @@
+import logging
+from .models import ChatMessage
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def load_conversation_history(session, max_messages: int = 50, exclude_id=None) -> list:
+    """Последние сообщения сессии в формате conversation_history для GPTService
+
+    Берутся самые новые max_messages пар (user + assistant), от новых к старым.
+    Количество токенов считается один раз и сохраняется в ChatMessage.tokens_used,
+    чтобы GPTService мог обрезать историю по бюджету без повторного подсчета.
+    Сообщения, уже свернутые в краткое содержание сессии, не загружаются.
+
+    Args:
+        session: ChatSession
+        max_messages: Максимум пар сообщений
+        exclude_id: ID сообщения, которое не нужно включать (текущее сообщение пользователя)
+    """
+    messages = session.messages.filter(message_type__in=['user', 'assistant'])
+    if session.summary and session.summary_until:
+        # Все, что старше, уже свернуто в session.summary
+        messages = messages.filter(created_at__gt=session.summary_until)
+    if exclude_id is not None:
+        messages = messages.exclude(id=exclude_id)
+    messages = list(messages.order_by('-created_at')[:max_messages * 2])
+    messages.reverse()
+
+    # Старые сообщения, сохраненные до появления подсчета, досчитываем одним запросом
+    missing = [msg for msg in messages if msg.tokens_used is None]
+    for msg in missing:
+        msg.tokens_used = estimate_tokens(msg.content)
+    if missing:
+        ChatMessage.objects.bulk_update(missing, ['tokens_used'])
+
+    history = []
+    for msg in messages:
+        if msg.message_type == 'user':
+            history.append({
+                'message': msg.content,
+                'response': None,
+                'message_tokens': msg.tokens_used,
+                'response_tokens': 0,
+            })
+        elif msg.message_type == 'assistant' and history:
+            history[-1]['response'] = msg.content
+            history[-1]['response_tokens'] = msg.tokens_used
+
+    return history
@@ -0,0 +1,376 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .generation import worker_mode_enabled
+from .gpt_service import aget_gpt_service
+from .image_store import image_store
+from .redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Взять из расписания одно задание, время которого уже наступило, и выдать на него аренду.
+# KEYS[1] - расписание, KEYS[2] - выполняемые задания (score - срок аренды)
+# ARGV[1] - текущее время, ARGV[2] - срок аренды, ARGV[3] - сколько заданий может выполняться одновременно
+# Задания с истекшей арендой (исполнитель упал) сначала возвращаются в расписание.
+# ZREM гарантирует, что задание возьмет один исполнитель
+CLAIM_SCRIPT = """
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, 10)
+for _, job_id in ipairs(expired) do
+    redis.call('zrem', KEYS[2], job_id)
+    redis.call('zadd', KEYS[1], ARGV[1], job_id)
+end
+if redis.call('zcard', KEYS[2]) >= tonumber(ARGV[3]) then
+    return false
+end
+local items = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #items == 0 then
+    return false
+end
+redis.call('zrem', KEYS[1], items[1])
+redis.call('zadd', KEYS[2], ARGV[2], items[1])
+return items[1]
+"""
+
+# Статусы задания
+STATUS_QUEUED = 'queued'        # Ждет исполнителя
+STATUS_RUNNING = 'running'      # Идет запрос к провайдеру
+STATUS_SCHEDULED = 'scheduled'  # Все подходящие провайдеры на квоте - повтор после ее сброса
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Поля задания, которые отдаются клиенту
+PUBLIC_FIELDS = ('id', 'status', 'prompt', 'attempts', 'retry_at', 'result', 'error', 'message', 'quota_errors')
+
+
+class ImageJobQueue:
+    """Очередь заданий генерации изображений в Redis
+
+    HTTP запрос только ставит задание и сразу получает его id: генерация занимает до минуты
+    на провайдера и не должна держать воркер веб-сервера. Результат клиент получает опросом
+    (GET /api/generate-image/<id>/) или через WebSocket сессии чата (событие image_job).
+
+    Задания лежат в sorted set с временем запуска. Если провайдер сообщил об исчерпанной квоте,
+    время ее сброса запоминается (в задании и общее для всех заданий), провайдер не опрашивается
+    до этого времени, а задание, которому больше некого попробовать, переносится на момент сброса.
+
+    Взятое задание арендуется на lease секунд, исполнитель продлевает аренду, пока работает.
+    Если исполнитель умер, задание с истекшей арендой возвращается в расписание. Число
+    одновременно выполняемых заданий ограничено global_concurrency на все процессы.
+
+    Исполнитель - ImageJobRunner: в режиме GPT_WORKER_MODE он работает в run_gpt_worker,
+    иначе - в фоновом потоке веб-процесса.
+    """
+
+    KEY_PREFIX = 'image_jobs'
+
+    def __init__(self):
+        self.ttl = getattr(settings, 'IMAGE_JOB_TTL', 3600)
+        self.max_wait = getattr(settings, 'IMAGE_JOB_MAX_WAIT', 600)
+        self.max_failures = getattr(settings, 'IMAGE_JOB_PROVIDER_FAILURES', 2)
+        self.default_quota_wait = getattr(settings, 'IMAGE_QUOTA_DEFAULT_WAIT', 60)
+        self.retry_backoff = getattr(settings, 'IMAGE_JOB_RETRY_BACKOFF', 5)
+        self.lease = getattr(settings, 'IMAGE_JOB_LEASE', 120)
+        self.global_concurrency = getattr(settings, 'IMAGE_JOB_GLOBAL_CONCURRENCY', 8)
+        self.schedule_key = f'{self.KEY_PREFIX}:schedule'
+        self.running_key = f'{self.KEY_PREFIX}:running'
+        self.quota_key = f'{self.KEY_PREFIX}:quota'
+
+    def _job_key(self, job_id: str) -> str:
+        return f'{self.KEY_PREFIX}:job:{job_id}'
+
+    async def submit(self, prompt: str, provider: str = None, user_id: int = None, session_id: str = None) -> Dict[str, Any]:
+        """Поставить задание в очередь"""
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": STATUS_QUEUED,
+            "prompt": prompt,
+            "provider": provider,
+            "user_id": user_id,
+            "session_id": session_id,
+            "created_at": now,
+            "deadline": now + self.max_wait,
+            "attempts": 0,
+            "failures": {},     # Провайдер -> неудачные попытки (кроме квоты)
+            "quota_until": {},  # Провайдер -> когда сбросится квота
+            "backoff_until": {},  # Провайдер -> когда повторить после ошибки
+            "retry_at": None,
+            "result": None,
+            "error": None,
+            "message": None,
+            "quota_errors": [],
+        }
+        redis = get_async_redis()
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(self._job_key(job["id"]), json.dumps(job, ensure_ascii=False, default=str), ex=self.ttl)
+        pipe.zadd(self.schedule_key, {job["id"]: now})
+        await pipe.execute()
+        logger.info("[IMAGE_JOB] Задание %s поставлено в очередь: '%s...'", job['id'], prompt[:50])
+        ensure_runner()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raw = await get_async_redis().get(self._job_key(job_id))
+        return json.loads(raw) if raw else None
+
+    async def save(self, job: Dict[str, Any]):
+        await get_async_redis().set(self._job_key(job["id"]), json.dumps(job, ensure_ascii=False, default=str), ex=self.ttl)
+
+    async def claim(self) -> Optional[Dict[str, Any]]:
+        """Забрать задание, время запуска которого наступило (с арендой на lease секунд)"""
+        now = time.time()
+        job_id = await get_async_redis().eval(CLAIM_SCRIPT, 2, self.schedule_key, self.running_key,
+                                              now, now + self.lease, self.global_concurrency)
+        if not job_id:
+            return None
+        job = await self.get(job_id.decode())
+        if job is None:
+            logger.warning("[IMAGE_JOB] Задание %s истекло до запуска", job_id.decode())
+            await self.release(job_id.decode())
+        elif job["status"] == STATUS_RUNNING:
+            logger.warning("[IMAGE_JOB] Задание %s возвращено в работу: аренда предыдущего исполнителя истекла", job['id'])
+        return job
+
+    async def extend_lease(self, job_id: str):
+        """Продлить аренду задания (XX - только если его не вернули в расписание)"""
+        await get_async_redis().zadd(self.running_key, {job_id: time.time() + self.lease}, xx=True)
+
+    async def release(self, job_id: str):
+        """Снять аренду: задание завершено или перенесено в расписание"""
+        await get_async_redis().zrem(self.running_key, job_id)
+
+    async def schedule(self, job: Dict[str, Any], run_at: float):
+        """Сохранить задание и запланировать следующий запуск"""
+        job["status"] = STATUS_SCHEDULED
+        job["retry_at"] = run_at
+        await self.save(job)
+        await get_async_redis().zadd(self.schedule_key, {job["id"]: run_at})
+
+    async def quota_resets(self) -> Dict[str, float]:
+        """Известные времена сброса квот провайдеров (общие для всех заданий)"""
+        now = time.time()
+        raw = await get_async_redis().hgetall(self.quota_key)
+        resets = {name.decode(): float(value) for name, value in raw.items()}
+        return {name: until for name, until in resets.items() if until > now}
+
+    async def record_quota(self, provider: str, until: float):
+        redis = get_async_redis()
+        pipe = redis.pipeline(transaction=False)
+        pipe.hset(self.quota_key, provider, until)
+        pipe.expire(self.quota_key, self.ttl)
+        await pipe.execute()
+
+    @staticmethod
+    def public(job: Dict[str, Any]) -> Dict[str, Any]:
+        """Данные задания для клиента"""
+        return {field: job.get(field) for field in PUBLIC_FIELDS}
+
+
+class ImageJobRunner:
+    """Исполнитель заданий генерации изображений: одновременно не больше concurrency заданий"""
+
+    def __init__(self, queue: ImageJobQueue, concurrency: int = 4, poll_interval: float = 1.0):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    async def run(self):
+        logger.info("[IMAGE_JOB] Исполнитель заданий изображений запущен, параллельно: %s", self.concurrency)
+        await asyncio.gather(*(self._consume() for _ in range(self.concurrency)))
+
+    async def _consume(self):
+        while not self._stopping:
+            try:
+                job = await self.queue.claim()
+            except Exception as e:
+                logger.error("[IMAGE_JOB] Ошибка чтения очереди: %s", e)
+                job = None
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            heartbeat = asyncio.create_task(self._keep_lease(job["id"]))
+            try:
+                await self.process(job)
+            except Exception as e:
+                logger.error("[IMAGE_JOB] Ошибка выполнения задания %s: %s", job['id'], e)
+                job.update({"status": STATUS_FAILED, "error": "Внутренняя ошибка сервера",
+                            "message": "Произошла ошибка при генерации изображения. Попробуйте позже."})
+                await self._finish(job)
+            finally:
+                heartbeat.cancel()
+                await asyncio.gather(heartbeat, return_exceptions=True)
+                try:
+                    await self.queue.release(job["id"])
+                except Exception as e:
+                    logger.warning("[IMAGE_JOB] Не удалось снять аренду задания %s: %s", job['id'], e)
+
+    async def _keep_lease(self, job_id: str):
+        """Продлевать аренду, пока задание выполняется"""
+        while True:
+            await asyncio.sleep(self.queue.lease / 3)
+            try:
+                await self.queue.extend_lease(job_id)
+            except Exception as e:
+                logger.warning("[IMAGE_JOB] Не удалось продлить аренду задания %s: %s", job_id, e)
+
+    async def process(self, job: Dict[str, Any]):
+        """Пробовать провайдеров, чья квота не исчерпана и пауза после ошибки прошла; если таких нет - перенести задание"""
+        gpt_service = await aget_gpt_service()
+        providers = [job["provider"]] if job.get("provider") else gpt_service.image_providers
+        if any(name not in gpt_service.image_providers for name in providers):
+            job.update({"status": STATUS_FAILED,
+                        "error": f"Провайдер {job['provider']} не является валидным провайдером изображений",
+                        "message": f"Доступные провайдеры: {', '.join(gpt_service.image_providers)}"})
+            await self._finish(job)
+            return
+
+        # Такой же промпт у того же провайдера уже генерировали - отдаем сохраненное изображение
+        stored = await image_store.find(job["prompt"], job.get("provider"))
+        if stored:
+            logger.info("[IMAGE_JOB] Задание %s: изображение уже есть в хранилище (%s)", job['id'], stored['name'])
+            job.update({"status": STATUS_DONE, "result": {
+                **self._stored_fields(stored),
+                "image_data": None,
+                "provider_used": stored.get("provider"),
+                "response_time": 0,
+                "prompt": job["prompt"],
+                "cached": True,
+            }})
+            await self._finish(job)
+            return
+
+        job["status"] = STATUS_RUNNING
+        job["retry_at"] = None
+        await self.queue.save(job)
+        await self._notify(job)
+
+        backoff_until = job.setdefault("backoff_until", {})
+        while True:
+            now = time.time()
+            shared_resets = await self.queue.quota_resets()
+            resets = {
+                name: max(job["quota_until"].get(name, 0), shared_resets.get(name, 0), backoff_until.get(name, 0))
+                for name in providers
+            }
+            candidates = [
+                name for name in providers
+                if job["failures"].get(name, 0) < self.queue.max_failures and resets[name] <= now
+            ]
+
+            if not candidates:
+                # Ждать имеет смысл провайдеров на квоте или на паузе после ошибки
+                waiting = [resets[name] for name in providers
+                           if job["failures"].get(name, 0) < self.queue.max_failures and resets[name] > now]
+                run_at = min(waiting) if waiting else None
+                if run_at is not None and run_at <= job["deadline"]:
+                    logger.info("[IMAGE_JOB] Задание %s: провайдеры на квоте или паузе, повтор через %.0fс", job['id'], run_at - now)
+                    await self.queue.schedule(job, run_at)
+                    await self._notify(job)
+                    return
+                self._fail(job)
+                await self._finish(job)
+                return
+
+            provider = candidates[0]
+            job["attempts"] += 1
+            result = await gpt_service.generate_image_attempt(job["prompt"], provider)
+
+            if result["success"]:
+                job_result = {
+                    "image_url": result.get("image_url"),
+                    "image_data": result.get("image_data"),
+                    "provider_used": result["provider"],
+                    "response_time": result["response_time"],
+                    "prompt": result["prompt"],
+                }
+                # Скачиваем картинку к себе: клиент не зависит от хоста провайдера, повтор промпта не генерирует заново
+                stored = await image_store.store(result.get("image_url"), result.get("image_data"))
+                if stored:
+                    job_result.update(self._stored_fields(stored), original_url=result.get("image_url"), image_data=None)
+                    await image_store.remember(job["prompt"], (job.get("provider"), provider), {**stored, "provider": provider})
+                job.update({"status": STATUS_DONE, "error": None, "message": None, "result": job_result})
+                await self._finish(job)
+                return
+
+            job["error"] = result["error"]
+            if result.get("quota"):
+                until = time.time() + (result.get("retry_after") or self.queue.default_quota_wait)
+                job["quota_until"][provider] = until
+                job["quota_errors"].append(result["error"])
+                await self.queue.record_quota(provider, until)
+            else:
+                # Повтор того же провайдера - с экспоненциальной паузой, а не сразу
+                failures = job["failures"][provider] = job["failures"].get(provider, 0) + 1
+                backoff_until[provider] = time.time() + self.queue.retry_backoff * 2 ** (failures - 1)
+
+    @staticmethod
+    def _stored_fields(stored: Dict[str, Any]) -> Dict[str, Any]:
+        """Поля результата для изображения из хранилища"""
+        return {
+            "image_url": stored["url"],
+            "thumbnails": stored["thumbnails"],
+            "width": stored["width"],
+            "height": stored["height"],
+        }
+
+    def _fail(self, job: Dict[str, Any]):
+        job["status"] = STATUS_FAILED
+        if job["quota_errors"]:
+            job["error"] = "Все провайдеры изображений исчерпали квоту"
+            job["message"] = "Квота на генерацию изображений исчерпана. Пожалуйста, попробуйте позже."
+        else:
+            job["error"] = job.get("error") or "Не удалось сгенерировать изображение"
+            job["message"] = "Не удалось сгенерировать изображение. Пожалуйста, попробуйте другой запрос."
+        logger.warning("[IMAGE_JOB] Задание %s не выполнено: %s", job['id'], job['error'])
+
+    async def _finish(self, job: Dict[str, Any]):
+        if job["status"] == STATUS_DONE:
+            logger.info("[IMAGE_JOB] Задание %s выполнено провайдером %s", job['id'], job['result']['provider_used'])
+        await self.queue.save(job)
+        await self._notify(job)
+
+    async def _notify(self, job: Dict[str, Any]):
+        """Отправить состояние задания в WebSocket сессии чата, из которой оно пришло"""
+        if not job.get("session_id"):
+            return
+        try:
+            await get_channel_layer().group_send(f"chat_{job['session_id']}", {
+                "type": "image_job",
+                "job": ImageJobQueue.public(job),
+            })
+        except Exception as e:
+            logger.warning("[IMAGE_JOB] Не удалось отправить состояние задания %s: %s", job['id'], e)
+
+
+image_job_queue = ImageJobQueue()
+
+_runner_lock = threading.Lock()
+_runner_pid = None
+
+
+def ensure_runner():
+    """Запустить исполнителя в фоновом потоке веб-процесса (в режиме воркеров задания выполняет run_gpt_worker)
+
+    Поток запускается в каждом веб-процессе, но всего одновременно выполняется не больше
+    IMAGE_JOB_GLOBAL_CONCURRENCY заданий: лимит проверяется при взятии задания в Redis.
+    """
+    global _runner_pid
+    if worker_mode_enabled() or _runner_pid == os.getpid():
+        return
+    with _runner_lock:
+        if _runner_pid == os.getpid():
+            return
+        _runner_pid = os.getpid()
+        runner = ImageJobRunner(image_job_queue, concurrency=getattr(settings, 'IMAGE_JOB_CONCURRENCY', 4))
+        threading.Thread(target=asyncio.run, args=(runner.run(),), name='image-jobs', daemon=True).start()
@@ -0,0 +1,243 @@
+import asyncio
+import base64
+import hashlib
+import io
+import ipaddress
+import json
+import logging
+import os
+import re
+import socket
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import urljoin, urlsplit
+import httpcore
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from PIL import Image
+from .redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые сохраняем (формат Pillow -> расширение файла)
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp', 'GIF': 'gif'}
+
+# Имя файла в хранилище: <2 символа хэша>/<sha256>[_<размер миниатюры>].<расширение>
+STORED_NAME_RE = r'[0-9a-f]{2}/[0-9a-f]{64}(?:_\d+)?\.(?:png|jpg|webp|gif)'
+
+_DATA_URL_RE = re.compile(r'^data:image/[\w.+-]+;base64,(.+)$', re.DOTALL)
+
+# Сколько перенаправлений провайдера проходим (каждое проверяется заново)
+MAX_REDIRECTS = 5
+
+
+async def _public_addresses(host: str, port: int) -> list:
+    """IP-адреса хоста; все они должны быть публичными, иначе ValueError (защита от SSRF)"""
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"адрес {address} для {host} не публичный")
+        if str(address) not in addresses:
+            addresses.append(str(address))
+    return addresses
+
+
+class _PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Сетевой backend httpcore: TCP-соединения только с проверенными публичными адресами
+
+    Соединяемся с тем же IP, который проверили, без повторного DNS-запроса: иначе имя могло бы
+    между проверкой и соединением начать указывать во внутреннюю сеть (DNS rebinding).
+    SNI, проверка сертификата и заголовок Host по-прежнему используют имя из ссылки.
+    """
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        error = None
+        for address in await _public_addresses(host, port):
+            try:
+                return await self._backend.connect_tcp(address, port, timeout=timeout, local_address=local_address,
+                                                       socket_options=socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error or httpcore.ConnectError(f"нет адресов для {host}")
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("unix-сокеты не поддерживаются")
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class _PublicOnlyTransport(httpx.AsyncHTTPTransport):
+    """Транспорт httpx без прокси, соединения - через _PublicAddressBackend"""
+
+    def __init__(self):
+        super().__init__(trust_env=False)
+        # httpx не дает передать network_backend, поэтому пул соединений создаем сами
+        self._pool = httpcore.AsyncConnectionPool(ssl_context=httpx.create_ssl_context(),
+                                                  network_backend=_PublicAddressBackend())
+
+
+class ImageStore:
+    """Локальное хранилище сгенерированных изображений (MEDIA_ROOT/images)
+
+    Результат провайдера скачивается один раз и сохраняется под sha256 содержимого, рядом -
+    миниатюры WEBP. Файлы не меняются, поэтому отдаются views.stored_image с долгим
+    кэшированием. Для пары промпт + провайдер в Redis запоминается сохраненное изображение:
+    повторный такой же запрос получает его без обращения к провайдеру.
+    """
+
+    KEY_PREFIX = 'image_store'
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'IMAGE_STORE_ENABLED', True)
+        self.root = Path(settings.MEDIA_ROOT) / 'images'
+        self.url_prefix = f"{settings.MEDIA_URL.rstrip('/')}/images/"
+        self.max_bytes = getattr(settings, 'IMAGE_STORE_MAX_BYTES', 20 * 1024 * 1024)
+        self.thumbnail_sizes = getattr(settings, 'IMAGE_STORE_THUMBNAIL_SIZES', (256, 512))
+        self.download_timeout = getattr(settings, 'IMAGE_STORE_DOWNLOAD_TIMEOUT', 30)
+        self.reuse_ttl = getattr(settings, 'IMAGE_STORE_REUSE_TTL', 30 * 24 * 3600)
+
+    def _prompt_key(self, prompt: str, provider: Optional[str]) -> str:
+        # Регистр и лишние пробелы на результат не влияют
+        normalized = ' '.join(prompt.lower().split())
+        digest = hashlib.sha256(f"{provider or 'auto'}\n{normalized}".encode('utf-8')).hexdigest()
+        return f'{self.KEY_PREFIX}:prompt:{digest}'
+
+    def path(self, name: str) -> Path:
+        return self.root / name
+
+    async def find(self, prompt: str, provider: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Сохраненное изображение для промпта и провайдера (None - генерировать заново)"""
+        if not self.enabled:
+            return None
+        try:
+            raw = await get_async_redis().get(self._prompt_key(prompt, provider))
+        except Exception as e:
+            logger.warning("[IMAGE_STORE] Не удалось прочитать индекс промптов: %s", e)
+            return None
+        if not raw:
+            return None
+        stored = json.loads(raw)
+        # Файл могли удалить вручную - тогда генерируем заново
+        return stored if self.path(stored["name"]).exists() else None
+
+    async def remember(self, prompt: str, providers, stored: Dict[str, Any]):
+        """Запомнить изображение для промпта (под запрошенным и фактическим провайдером)"""
+        try:
+            redis = get_async_redis()
+            pipe = redis.pipeline(transaction=False)
+            for provider in set(providers):
+                pipe.set(self._prompt_key(prompt, provider), json.dumps(stored), ex=self.reuse_ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("[IMAGE_STORE] Не удалось сохранить индекс промптов: %s", e)
+
+    async def store(self, image_url: Optional[str], image_data: Any) -> Optional[Dict[str, Any]]:
+        """Скачать результат провайдера и сохранить его с миниатюрами
+
+        Returns:
+            Описание сохраненного изображения ("url", "thumbnails", "width", ...) или None,
+            если получить картинку не удалось (тогда клиент получает ссылку провайдера)
+        """
+        if not self.enabled:
+            return None
+        try:
+            content = await self._fetch(image_url, image_data)
+            if content is None:
+                return None
+            return await sync_to_async(self._save, thread_sensitive=False)(content)
+        except Exception as e:
+            logger.warning("[IMAGE_STORE] Не удалось сохранить изображение %s: %s", str(image_url)[:100], e)
+            return None
+
+    async def _fetch(self, image_url: Optional[str], image_data: Any) -> Optional[bytes]:
+        """Байты изображения: из data URL в ответе провайдера или загрузкой по ссылке"""
+        if isinstance(image_data, str):
+            match = _DATA_URL_RE.match(image_data.strip())
+            if match:
+                return base64.b64decode(match.group(1))
+        if not image_url:
+            return None
+
+        # Ссылку присылает сторонний провайдер: перенаправления проходим сами, проверяя каждую ссылку,
+        # а адрес каждого соединения проверяет _PublicAddressBackend
+        url = image_url
+        async with httpx.AsyncClient(timeout=self.download_timeout, follow_redirects=False,
+                                     transport=_PublicOnlyTransport()) as client:
+            for _ in range(MAX_REDIRECTS + 1):
+                self._check_url(url)
+                async with client.stream('GET', url) as response:
+                    if response.is_redirect:
+                        url = urljoin(url, response.headers['location'])
+                        continue
+                    response.raise_for_status()
+                    chunks = []
+                    size = 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ValueError(f"изображение больше {self.max_bytes} байт")
+                        chunks.append(chunk)
+                    return b''.join(chunks)
+        raise ValueError(f"больше {MAX_REDIRECTS} перенаправлений")
+
+    @staticmethod
+    def _check_url(url: str):
+        """Разрешить только http(s)-ссылки с именем хоста (адрес проверяется при соединении)"""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"недопустимая ссылка {url[:100]}")
+
+    def _save(self, content: bytes) -> Dict[str, Any]:
+        """Проверить изображение, записать его и миниатюры (синхронно, в отдельном потоке)"""
+        with Image.open(io.BytesIO(content)) as image:
+            image_format = image.format
+            if image_format not in FORMAT_EXTENSIONS:
+                raise ValueError(f"неподдерживаемый формат {image_format}")
+            width, height = image.size
+
+            digest = hashlib.sha256(content).hexdigest()
+            name = f"{digest[:2]}/{digest}.{FORMAT_EXTENSIONS[image_format]}"
+            self._write(name, content)
+
+            thumbnails = {}
+            for size in self.thumbnail_sizes:
+                thumb_name = f"{digest[:2]}/{digest}_{size}.webp"
+                if not self.path(thumb_name).exists():
+                    thumb = image.copy()
+                    thumb.thumbnail((size, size))
+                    if thumb.mode not in ('RGB', 'RGBA'):
+                        thumb = thumb.convert('RGBA' if 'A' in thumb.getbands() or 'transparency' in thumb.info else 'RGB')
+                    buffer = io.BytesIO()
+                    thumb.save(buffer, 'WEBP', quality=80)
+                    self._write(thumb_name, buffer.getvalue())
+                thumbnails[str(size)] = self.url_prefix + thumb_name
+
+        logger.info("[IMAGE_STORE] Сохранено изображение %s (%sx%s, %s байт)", name, width, height, len(content))
+        return {
+            "name": name,
+            "url": self.url_prefix + name,
+            "thumbnails": thumbnails,
+            "width": width,
+            "height": height,
+            "bytes": len(content),
+        }
+
+    def _write(self, name: str, content: bytes):
+        """Атомарно записать файл, если его еще нет (одинаковое содержимое - одинаковое имя)"""
+        path = self.path(name)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+
+
+image_store = ImageStore()
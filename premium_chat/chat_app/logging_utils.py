@@ -0,0 +1,101 @@
+import copy
+import logging
+import os
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener
+from django.utils.module_loading import import_string
+
+# Категория сообщения - префикс вида "[ATTEMPT] ..."
+_CATEGORY_RE = re.compile(r'^\[([A-Z_]+)\]')
+
+
+class QueuedHandler(QueueHandler):
+    """Неблокирующий обработчик логов: запись кладется в очередь, а файл/консоль пишет отдельный поток
+
+    Вызывающий код (в том числе event loop) только добавляет запись в очередь. Форматирование
+    и ввод-вывод выполняет QueueListener в своем потоке. Если очередь переполнена, запись
+    отбрасывается, чтобы запрос не ждал диск.
+
+    Поток записи запускается при первой записи в каждом процессе, а не в dictConfig:
+    после fork (gunicorn --preload, ASGI-сервер с несколькими воркерами) потока родителя
+    в дочернем процессе нет, и записи копились бы в очереди.
+
+    Настраивается в settings.LOGGING вместо исходного обработчика:
+        'class': 'chat_app.logging_utils.QueuedHandler',
+        'handler_class': 'logging.FileHandler',
+        'filename': ...,  # остальные параметры передаются во внутренний обработчик
+    """
+
+    def __init__(self, handler_class: str = 'logging.StreamHandler', queue_size: int = 10000, **handler_kwargs):
+        # Внутренний обработчик создаем первым: logging.shutdown закрывает обработчики в обратном
+        # порядке, и очередь успевает дописаться в еще открытый файл
+        self.target = import_string(handler_class)(**handler_kwargs)
+        super().__init__(queue.Queue(queue_size))
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self._pid = None  # Процесс, в котором запущен listener
+        self._stopped = False
+
+    def _start_listener(self):
+        """Новая очередь и поток записи для текущего процесса. Вызывается под self.lock"""
+        self.queue = queue.Queue(self.queue_size)
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def emit(self, record: logging.LogRecord):
+        # Handler.handle вызывает emit под self.lock, а logging пересоздает его после fork
+        if self._pid != os.getpid():
+            self._start_listener()
+        super().emit(record)
+
+    def setFormatter(self, fmt):
+        # Форматирует внутренний обработчик в потоке listener'а
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Подставить аргументы сейчас (объекты могут измениться), форматирование - в потоке записи"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # logging.shutdown() при выходе закрывает обработчик: дописываем очередь и останавливаем поток
+        if not self._stopped:
+            self._stopped = True
+            if self._pid == os.getpid():
+                self.listener.stop()
+            self.target.close()
+        super().close()
+
+
+class SamplingFilter(logging.Filter):
+    """Выборочная запись частых INFO-сообщений по категориям ([ATTEMPT], [DIRECT], ...)
+
+    rates - доля сообщений категории, которые проходят (0.0 - ни одного, 1.0 - все).
+    Сообщения уровня WARNING и выше, а также без категории проходят всегда.
+    """
+
+    def __init__(self, rates: dict = None, name: str = ''):
+        super().__init__(name)
+        self.rates = rates or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        match = _CATEGORY_RE.match(str(record.msg))
+        if not match:
+            return True
+        rate = self.rates.get(match.group(1))
+        return rate is None or random.random() < rate
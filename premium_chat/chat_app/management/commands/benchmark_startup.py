@@ -0,0 +1,84 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Выполняется в отдельном чистом процессе: импорт точки входа и URLconf (как при первом запросе),
+# затем, по желанию, создание GPTService. Результат - одна строка JSON
+PROBE_SCRIPT = """
+import json, resource, sys, time
+started = time.perf_counter()
+import importlib
+importlib.import_module(sys.argv[1])
+from django.urls import get_resolver
+get_resolver().url_patterns
+ready = time.perf_counter()
+service_time = None
+if sys.argv[2] == '1':
+    from chat_app.gpt_service import get_gpt_service
+    get_gpt_service()
+    service_time = time.perf_counter() - ready
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "import_time": ready - started,
+    "service_time": service_time,
+    "rss_mb": rss / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    "g4f_loaded": 'g4f' in sys.modules,
+}))
+"""
+
+ENTRY_POINTS = {
+    'wsgi': 'chat_project.wsgi',
+    'asgi': 'chat_project.asgi',
+}
+
+
+class Command(BaseCommand):
+    help = 'Время запуска и память веб-процесса: импорт точек входа WSGI/ASGI в чистых процессах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Сколько запусков на точку входа (берется медиана)')
+        parser.add_argument('--entry', choices=sorted(ENTRY_POINTS), action='append',
+                            help='Точка входа (по умолчанию все)')
+        parser.add_argument('--with-service', action='store_true',
+                            help='Дополнительно создать GPTService (импорт g4f) и замерить это время')
+        parser.add_argument('--json', action='store_true', help='Вывести результат в JSON')
+
+    def handle(self, *args, **options):
+        # Фоновое создание сервиса в asgi.py выключено: время GPTService замеряется отдельно (--with-service)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'chat_project.settings'),
+                   GPT_WARMUP_ON_START='False')
+        results = {}
+        for entry in options['entry'] or sorted(ENTRY_POINTS):
+            runs = [self._probe(ENTRY_POINTS[entry], options['with_service'], env) for _ in range(max(1, options['repeat']))]
+            results[entry] = {
+                "import_time": statistics.median(run["import_time"] for run in runs),
+                "service_time": statistics.median(run["service_time"] for run in runs) if options['with_service'] else None,
+                "rss_mb": statistics.median(run["rss_mb"] for run in runs),
+                "g4f_loaded": any(run["g4f_loaded"] for run in runs),
+                "runs": len(runs),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for entry, result in results.items():
+            line = (f"{entry:5} импорт {result['import_time'] * 1000:7.0f} мс | RSS {result['rss_mb']:6.1f} МБ"
+                    f" | g4f {'загружен' if result['g4f_loaded'] else 'не загружен'}")
+            if result['service_time'] is not None:
+                line += f" | GPTService {result['service_time'] * 1000:.0f} мс"
+            self.stdout.write(line)
+
+    def _probe(self, module: str, with_service: bool, env: dict) -> dict:
+        completed = subprocess.run(
+            [sys.executable, '-c', PROBE_SCRIPT, module, '1' if with_service else '0'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f"Не удалось запустить {module}:\n{completed.stderr.strip()[-2000:]}")
+        # Последняя строка - результат, выше может быть вывод логов
+        return json.loads(completed.stdout.strip().splitlines()[-1])
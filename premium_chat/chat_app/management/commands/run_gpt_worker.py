@@ -0,0 +1,30 @@
+import asyncio
+import signal
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from chat_app.generation import GenerationWorker
+from chat_app.image_jobs import ImageJobRunner, image_job_queue
+
+
+class Command(BaseCommand):
+    help = 'Воркер генерации GPT: выполняет задания из очереди Redis (режим GPT_WORKER_MODE)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=16, help='Сколько заданий выполнять одновременно')
+        parser.add_argument('--image-concurrency', type=int, default=getattr(settings, 'IMAGE_JOB_CONCURRENCY', 4),
+                            help='Сколько заданий генерации изображений выполнять одновременно (0 - не выполнять)')
+
+    def handle(self, *args, **options):
+        worker = GenerationWorker(concurrency=options['concurrency'])
+        image_runner = ImageJobRunner(image_job_queue, concurrency=options['image_concurrency'])
+        self.stdout.write(f"Воркер генерации запущен (параллельно заданий: {worker.concurrency})")
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                # Останавливаемся мягко: текущие задания дорабатывают, новые не берутся
+                loop.add_signal_handler(sig, lambda: (worker.stop(), image_runner.stop()))
+            await asyncio.gather(worker.run(), image_runner.run())
+
+        asyncio.run(main())
+        self.stdout.write(self.style.SUCCESS(f"Воркер остановлен, обработано заданий: {worker.processed}"))
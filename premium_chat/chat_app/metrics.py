@@ -0,0 +1,179 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Optional
+from django.conf import settings
+from .redis_client import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+# Стандартные границы гистограмм (секунды / количество попыток)
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120)
+ATTEMPT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 30)
+
+# Описание метрик: имя -> (тип, описание, границы гистограммы)
+METRICS = {
+    'gpt_provider_attempts_total': ('counter', 'Попытки запросов к провайдерам', None),
+    'gpt_provider_outcomes_total': ('counter', 'Исходы попыток по провайдерам (success, empty, rate_limit, ...)', None),
+    'gpt_provider_latency_seconds': ('histogram', 'Время ответа провайдера', LATENCY_BUCKETS),
+    'gpt_requests_total': ('counter', 'Запросы к GPT по итогу (success, failed, timeout, overloaded, cached, coalesced)', None),
+    'gpt_request_attempts': ('histogram', 'Попыток на один запрос до результата', ATTEMPT_BUCKETS),
+    'gpt_cache_lookups_total': ('counter', 'Обращения к кэшу ответов (hit, miss)', None),
+    'gpt_rate_limited_total': ('counter', 'Запросы, отклоненные лимитом частоты', None),
+    'gpt_in_flight': ('gauge', 'Запросы к провайдерам в работе', None),
+    'gpt_queue_depth': ('gauge', 'Запросы в очереди ожидания слота', None),
+    'gpt_job_queue_depth': ('gauge', 'Задания в очереди воркеров генерации', None),
+}
+
+
+def metric_series(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+    """Имя серии в текстовом формате Prometheus: name{a="1",b="2"}"""
+    if not labels:
+        return name
+    parts = ','.join(f'{key}="{str(value)}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{parts}}}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsRegistry:
+    """Метрики провайдеров и очередей, общие для всех процессов
+
+    Счетчики и гистограммы копятся в памяти процесса и раз в flush_interval секунд
+    сбрасываются в Redis (HINCRBYFLOAT), где складываются со значениями других
+    процессов. Gauge-метрики считаются в момент сброса и хранятся отдельно для каждого
+    процесса с коротким TTL, при выдаче /metrics они суммируются.
+    """
+
+    KEY_PREFIX = 'metrics'
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'METRICS_ENABLED', True)
+        self.flush_interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+        self.process_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._pending = defaultdict(float)  # Серия -> прирост с прошлого сброса
+        self._gauges = {}  # Имя -> функция, возвращающая {серия: значение}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1):
+        """Увеличить счетчик"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending[metric_series(name, labels)] += value
+        self._ensure_flusher()
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """Добавить наблюдение в гистограмму (кумулятивные корзины, как в Prometheus)"""
+        if not self.enabled:
+            return
+        buckets = METRICS[name][2]
+        labels = labels or {}
+        with self._lock:
+            for bound in buckets:
+                # Пустые корзины тоже записываем, чтобы у гистограммы был полный набор le
+                self._pending[metric_series(f'{name}_bucket', {**labels, 'le': _format_value(bound)})] += 1 if value <= bound else 0
+            self._pending[metric_series(f'{name}_bucket', {**labels, 'le': '+Inf'})] += 1
+            self._pending[metric_series(f'{name}_sum', labels)] += value
+            self._pending[metric_series(f'{name}_count', labels)] += 1
+        self._ensure_flusher()
+
+    def register_gauge(self, name: str, callback: Callable[[], Dict[str, float]]):
+        """Gauge текущего процесса: callback возвращает {серия: значение}"""
+        self._gauges[name] = callback
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Сбросить накопленные значения и gauge процесса в Redis"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+
+        gauges = {}
+        for name, callback in list(self._gauges.items()):
+            try:
+                gauges.update(callback())
+            except Exception as e:
+                logger.warning("[METRICS] Не удалось снять gauge %s: %s", name, e)
+
+        try:
+            pipe = get_sync_redis().pipeline(transaction=False)
+            for series, value in pending.items():
+                pipe.hincrbyfloat(f'{self.KEY_PREFIX}:counters', series, value)
+            gauge_key = f'{self.KEY_PREFIX}:gauges:{self.process_id}'
+            pipe.delete(gauge_key)
+            if gauges:
+                pipe.hset(gauge_key, mapping=gauges)
+                pipe.expire(gauge_key, int(self.flush_interval * 3))
+            pipe.execute()
+        except Exception as e:
+            # Не теряем приращения - попробуем в следующий раз
+            logger.warning("[METRICS] Не удалось сбросить метрики в Redis: %s", e)
+            with self._lock:
+                for series, value in pending.items():
+                    self._pending[series] += value
+
+    def collect(self) -> Dict[str, float]:
+        """Значения всех процессов: счетчики суммируются, gauge складываются по процессам"""
+        self.flush()
+        redis = get_sync_redis()
+        values = defaultdict(float)
+        for series, value in redis.hgetall(f'{self.KEY_PREFIX}:counters').items():
+            values[series.decode()] += float(value)
+        for key in redis.scan_iter(match=f'{self.KEY_PREFIX}:gauges:*'):
+            for series, value in redis.hgetall(key).items():
+                values[series.decode()] += float(value)
+        return values
+
+    def render(self, extra: Optional[Dict[str, float]] = None) -> str:
+        """Метрики в текстовом формате Prometheus (exposition format 0.0.4)"""
+        values = self.collect()
+        values.update(extra or {})
+
+        lines = []
+        for name, (kind, help_text, _) in METRICS.items():
+            series = sorted(
+                (s for s in values if s.split('{', 1)[0] in (name, f'{name}_bucket', f'{name}_sum', f'{name}_count')),
+                key=self._sort_key,
+            )
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{s} {_format_value(values[s])}' for s in series)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _sort_key(series: str):
+        # Корзины гистограммы - по возрастанию le, затем _sum и _count
+        base, _, labels = series.partition('{')
+        le = float('inf')
+        rest = labels
+        if 'le="' in labels:
+            value = labels.split('le="', 1)[1].split('"', 1)[0]
+            le = float('inf') if value == '+Inf' else float(value)
+            rest = labels.replace(f'le="{value}"', '').replace(',,', ',')
+        rest = rest.strip(',}')
+        suffix_order = 0 if base.endswith('_bucket') else 1 if base.endswith('_sum') else 2
+        return rest, suffix_order, le
+
+
+metrics = MetricsRegistry()
@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
+from .tokens import estimate_tokens
 
 class ChatSession(models.Model):
     """Модель для сессии чата"""
@@ -12,6 +14,11 @@ class ChatSession(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
     is_active = models.BooleanField(default=True, verbose_name="Активен")
     
+    # Сжатое содержание старой части разговора (обновляется в фоне, см. summarizer.py)
+    summary = models.TextField(blank=True, verbose_name="Краткое содержание")
+    summary_until = models.DateTimeField(null=True, blank=True, verbose_name="Содержание охватывает сообщения до")
+    summary_updated_at = models.DateTimeField(null=True, blank=True, verbose_name="Содержание обновлено")
+    
     class Meta:
         verbose_name = "Сессия чата"
         verbose_name_plural = "Сессии чатов"
@@ -39,6 +46,8 @@ class ChatMessage(models.Model):
     model_used = models.CharField(max_length=100, blank=True, verbose_name="Использованная модель")
     response_time = models.FloatField(null=True, blank=True, verbose_name="Время ответа (сек)")
     attempt_number = models.IntegerField(null=True, blank=True, verbose_name="Номер попытки")
+    # Все попытки запроса: [[провайдер, старт мс, длительность мс, исход], ...] (см. timeline.AttemptTimeline)
+    attempt_timeline = models.JSONField(default=list, blank=True, verbose_name="Хронология попыток")
     
     # Временные метки
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
@@ -56,6 +65,12 @@ class ChatMessage(models.Model):
     def __str__(self):
         content_preview = self.content[:50] + "..." if len(self.content) > 50 else self.content
         return f"{self.get_message_type_display()}: {content_preview}"
+    
+    def save(self, *args, **kwargs):
+        # Токены считаем один раз при сохранении - дальше история обрезается по tokens_used
+        if self.tokens_used is None:
+            self.tokens_used = estimate_tokens(self.content)
+        super().save(*args, **kwargs)
 
 class UserProfile(models.Model):
     """Расширенная модель профиля пользователя"""
@@ -91,6 +106,11 @@ class UserProfile(models.Model):
     
     def __str__(self):
         return f"Профиль {self.user.username}"
+    
+    @property
+    def has_active_premium(self):
+        """Премиум включен и не истек"""
+        return self.is_premium and (self.premium_until is None or self.premium_until > timezone.now())
 
 class ChatTemplate(models.Model):
     """Шаблоны для быстрых запросов"""
@@ -96,7 +96,7 @@ class NotionService:
                         "error": "Проверьте правильность введенного Internal Integration Token"
                     }
             else:
-                logger.error(f"Ошибка подключения к Notion API: {e}")
+                logger.error("Ошибка подключения к Notion API: %s", e)
                 return {
                     "success": False,
                     "message": "Ошибка соединения с Notion",
@@ -158,7 +158,7 @@ class NotionService:
                 }
                 
         except Exception as e:
-            logger.error(f"Ошибка получения страниц: {e}")
+            logger.error("Ошибка получения страниц: %s", e)
             return {
                 "success": False,
                 "error": str(e)
@@ -397,7 +397,7 @@ class NotionService:
                 return False
                 
         except Exception as e:
-            logger.error(f"Ошибка при сохранении сообщения в Notion: {e}")
+            logger.error("Ошибка при сохранении сообщения в Notion: %s", e)
             
             # Сохраняем запись об ошибке
             NotionSave.objects.create(
@@ -440,7 +440,7 @@ class NotionService:
             return response.status_code == 200
                     
         except Exception as e:
-            logger.error(f"Ошибка создания новой страницы: {e}")
+            logger.error("Ошибка создания новой страницы: %s", e)
             return False
 
 def get_notion_service(user, use_proxy: bool = True) -> Optional[NotionService]:
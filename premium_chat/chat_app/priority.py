@@ -0,0 +1,29 @@
+from .models import UserProfile
+
+# Приоритеты запросов к провайдерам, от высшего к низшему
+PRIORITY_PREMIUM = 'premium'
+PRIORITY_USER = 'user'
+PRIORITY_ANON = 'anon'
+PRIORITIES = (PRIORITY_PREMIUM, PRIORITY_USER, PRIORITY_ANON)
+
+
+def priority_rank(priority: str = None) -> int:
+    """Номер приоритета (0 - высший). Неизвестный или пустой приоритет считается обычным пользователем"""
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        return PRIORITIES.index(PRIORITY_USER)
+
+
+def get_user_priority(user) -> str:
+    """Приоритет запросов пользователя: премиум, обычный пользователь или аноним
+
+    Обращается к БД - из асинхронного кода вызывать через sync_to_async.
+    """
+    if user is None or not user.is_authenticated:
+        return PRIORITY_ANON
+
+    profile = UserProfile.objects.filter(user=user).only('is_premium', 'premium_until').first()
+    if profile and profile.has_active_premium:
+        return PRIORITY_PREMIUM
+    return PRIORITY_USER
@@ -0,0 +1,378 @@
+import logging
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Задержка по умолчанию для провайдеров без статистики (сек)
+DEFAULT_LATENCY = 5.0
+
+# Исходы попыток, которые считаются ограничением частоты запросов
+RATE_LIMIT_OUTCOMES = ('rate_limit', 'unavailable')
+
+
+class ProviderScoreboard:
+    """Живая статистика провайдеров по каждой попытке create_async
+
+    Для каждого провайдера хранится экспоненциальное скользящее среднее (EWMA)
+    задержки, доли успехов, пустых ответов и rate limit. Порядок обхода
+    провайдеров строится по ожидаемому времени до успешного ответа.
+
+    Статистика других процессов (см. provider_state.ProviderStateSync) хранится отдельно
+    и смешивается с локальной при расчете score, с весом по числу недавних попыток.
+
+    Завышенная оценка задержки со временем возвращается к стартовой (полураспад
+    latency_half_life): иначе провайдер, которого пропускают по сроку запроса,
+    никогда не получил бы новых замеров.
+    """
+
+    SHARED_FIELDS = ("latency", "success_rate", "empty_rate", "rate_limit_rate")
+
+    def __init__(self, alpha: float = 0.2, priors: Dict[str, float] = None, latency_half_life: float = 600.0):
+        self.alpha = alpha  # Вес нового наблюдения в EWMA
+        self.priors = priors or {}  # Стартовые оценки задержки (из ручного тестирования)
+        self.latency_half_life = latency_half_life  # Сек, 0 - не возвращать оценку к стартовой
+        self._stats = {}
+        self._remote = {}  # Провайдер -> взвешенная статистика других процессов
+        self._lock = threading.Lock()
+        # Вес процесса при смешивании: примерно столько последних попыток "помнит" EWMA
+        self.weight_cap = max(1, round(2 / alpha))
+
+    def _get(self, provider_name: str) -> Dict[str, Any]:
+        """Получить (или создать) статистику провайдера. Вызывать под блокировкой"""
+        stats = self._stats.get(provider_name)
+        if stats is None:
+            stats = {
+                "latency": self.priors.get(provider_name, DEFAULT_LATENCY),
+                "success_rate": 0.9,  # Оптимистичный старт, чтобы новые провайдеры тоже пробовались
+                "empty_rate": 0.0,
+                "rate_limit_rate": 0.0,
+                "attempts": 0,
+                "latency_at": time.monotonic(),  # Когда задержка последний раз обновлялась
+            }
+            self._stats[provider_name] = stats
+        return stats
+
+    def _decay(self, provider_name: str, stats: Dict[str, Any]):
+        """Вернуть завышенную задержку к стартовой оценке по времени без замеров. Вызывать под блокировкой"""
+        now = time.monotonic()
+        baseline = self.priors.get(provider_name, DEFAULT_LATENCY)
+        if self.latency_half_life > 0 and stats["latency"] > baseline:
+            idle = now - stats["latency_at"]
+            stats["latency"] = baseline + (stats["latency"] - baseline) * 0.5 ** (idle / self.latency_half_life)
+        stats["latency_at"] = now
+
+    def _ewma(self, old: float, value: float) -> float:
+        return old + self.alpha * (value - old)
+
+    def record(self, provider_name: str, outcome: str, latency: Optional[float] = None):
+        """Учесть результат попытки
+
+        Args:
+            provider_name: Имя провайдера
+            outcome: 'success', 'empty', класс ошибки из GPTService._classify_error или 'timeout'
+            latency: Длительность попытки в секундах
+        """
+        success = outcome == 'success'
+        with self._lock:
+            stats = self._get(provider_name)
+            stats["attempts"] += 1
+            stats["success_rate"] = self._ewma(stats["success_rate"], 1.0 if success else 0.0)
+            stats["empty_rate"] = self._ewma(stats["empty_rate"], 1.0 if outcome == 'empty' else 0.0)
+            stats["rate_limit_rate"] = self._ewma(stats["rate_limit_rate"], 1.0 if outcome in RATE_LIMIT_OUTCOMES else 0.0)
+
+            # Задержку учитываем для успехов и таймаутов - медленный провайдер должен уходить вниз
+            if latency is not None and outcome in ('success', 'timeout'):
+                self._decay(provider_name, stats)
+                stats["latency"] = self._ewma(stats["latency"], latency)
+
+    def _combined(self, provider_name: str) -> Dict[str, float]:
+        """Локальная статистика, смешанная со статистикой других процессов. Вызывать под блокировкой"""
+        stats = self._get(provider_name)
+        self._decay(provider_name, stats)
+        remote = self._remote.get(provider_name)
+        if not remote:
+            return stats
+        local_weight = min(stats["attempts"], self.weight_cap)
+        total = local_weight + remote["weight"]
+        return {
+            field: (stats[field] * local_weight + remote[field] * remote["weight"]) / total
+            for field in self.SHARED_FIELDS
+        }
+
+    def score(self, provider_name: str) -> float:
+        """Ожидаемое время до успешного ответа (меньше - лучше)"""
+        with self._lock:
+            stats = self._combined(provider_name)
+            return stats["latency"] / max(stats["success_rate"], 0.05)
+
+    def expected_latency(self, provider_name: str) -> float:
+        """Текущая оценка задержки провайдера (сек)"""
+        with self._lock:
+            return self._combined(provider_name)["latency"]
+
+    def export_local(self) -> Dict[str, Dict[str, float]]:
+        """Локальная статистика для публикации другим процессам (вес - число недавних попыток)"""
+        with self._lock:
+            for name, stats in self._stats.items():
+                self._decay(name, stats)
+            return {
+                name: {**{field: stats[field] for field in self.SHARED_FIELDS},
+                       "weight": min(stats["attempts"], self.weight_cap)}
+                for name, stats in self._stats.items()
+                if stats["attempts"]
+            }
+
+    def set_remote(self, snapshots: List[Dict[str, Dict[str, float]]]):
+        """Заменить статистику других процессов (список их export_local)"""
+        remote = {}
+        for snapshot in snapshots:
+            for name, stats in snapshot.items():
+                weight = stats.get("weight", 0)
+                if weight <= 0:
+                    continue
+                merged = remote.setdefault(name, {"weight": 0, **{field: 0.0 for field in self.SHARED_FIELDS}})
+                for field in self.SHARED_FIELDS:
+                    merged[field] += stats[field] * weight
+                merged["weight"] += weight
+        for merged in remote.values():
+            for field in self.SHARED_FIELDS:
+                merged[field] /= merged["weight"]
+        with self._lock:
+            self._remote = remote
+
+    def rank(self, providers: List[str]) -> List[str]:
+        """Упорядочить провайдеров по score, при равенстве сохраняя исходный порядок"""
+        order = {name: index for index, name in enumerate(providers)}
+        return sorted(providers, key=lambda name: (self.score(name), order[name]))
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Снимок статистики для API и логов"""
+        with self._lock:
+            names = set(self._stats) | set(self._remote)
+            snapshot = {}
+            for name in names:
+                stats = self._combined(name)
+                snapshot[name] = {
+                    "latency": round(stats["latency"], 2),
+                    "success_rate": round(stats["success_rate"], 3),
+                    "empty_rate": round(stats["empty_rate"], 3),
+                    "rate_limit_rate": round(stats["rate_limit_rate"], 3),
+                    "attempts": self._stats[name]["attempts"] if name in self._stats else 0,
+                    "score": round(stats["latency"] / max(stats["success_rate"], 0.05), 2),
+                }
+            return snapshot
+
+
+class CircuitBreaker:
+    """Общий для процесса circuit breaker по каждому провайдеру
+
+    Состояния:
+        closed    - провайдер работает, запросы идут как обычно
+        open      - провайдер пропускается без запроса до истечения cooldown
+        half_open - cooldown истек, разрешен ровно один пробный запрос
+
+    Размыкание и замыкание цепи публикуются другим процессам (provider_state.ProviderStateSync):
+    свои изменения забираются через export_changes, чужие применяются через apply_remote.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # Cooldown по классу ошибки (сек)
+    DEFAULT_COOLDOWNS = {
+        'rate_limit': 60,
+        'unavailable': 120,
+        'blocked': 600,
+        'timeout': 30,
+        'connection': 15,
+        'empty': 30,
+        'error': 30,
+    }
+
+    # Ошибки, после которых цепь размыкается сразу, без накопления
+    IMMEDIATE_ERRORS = ('rate_limit', 'unavailable', 'blocked')
+
+    def __init__(self, cooldowns: Dict[str, float] = None, failure_threshold: int = 3, max_cooldown: float = 1800):
+        self.cooldowns = dict(self.DEFAULT_COOLDOWNS)
+        self.cooldowns.update(cooldowns or {})
+        self.failure_threshold = failure_threshold  # Подряд идущих ошибок для размыкания
+        self.max_cooldown = max_cooldown
+        self._circuits = {}
+        self._dirty = set()  # Провайдеры, смена состояния которых еще не опубликована
+        self._lock = threading.Lock()
+
+    def _get(self, provider_name: str) -> Dict[str, Any]:
+        """Получить (или создать) состояние цепи. Вызывать под блокировкой"""
+        circuit = self._circuits.get(provider_name)
+        if circuit is None:
+            circuit = {
+                "state": self.CLOSED,
+                "failures": 0,
+                "open_until": 0.0,
+                "cooldown": 0.0,
+                "last_error": None,
+                "trial_in_flight": False,
+                "updated_at": 0.0,  # Когда состояние последний раз менялось (здесь или в другом процессе)
+            }
+            self._circuits[provider_name] = circuit
+        return circuit
+
+    def is_open(self, provider_name: str) -> bool:
+        """Проверить без резервирования пробного запроса: пропускать ли провайдера"""
+        with self._lock:
+            circuit = self._circuits.get(provider_name)
+            if circuit is None or circuit["state"] == self.CLOSED:
+                return False
+            if circuit["state"] == self.OPEN:
+                return time.time() < circuit["open_until"]
+            return circuit["trial_in_flight"]
+
+    def allow(self, provider_name: str) -> bool:
+        """Разрешить запрос к провайдеру. В half_open резервирует единственный пробный запрос"""
+        with self._lock:
+            circuit = self._circuits.get(provider_name)
+            if circuit is None or circuit["state"] == self.CLOSED:
+                return True
+
+            if circuit["state"] == self.OPEN:
+                if time.time() < circuit["open_until"]:
+                    return False
+                circuit["state"] = self.HALF_OPEN
+                circuit["trial_in_flight"] = False
+                logger.info("[CIRCUIT] %s: cooldown истек, пробный запрос (half-open)", provider_name)
+
+            if circuit["trial_in_flight"]:
+                return False
+            circuit["trial_in_flight"] = True
+            return True
+
+    def release(self, provider_name: str):
+        """Освободить пробный запрос, который был отменен без результата"""
+        with self._lock:
+            circuit = self._circuits.get(provider_name)
+            if circuit is not None and circuit["state"] == self.HALF_OPEN:
+                circuit["trial_in_flight"] = False
+
+    def record_success(self, provider_name: str):
+        """Успешный ответ замыкает цепь"""
+        with self._lock:
+            circuit = self._get(provider_name)
+            if circuit["state"] != self.CLOSED:
+                logger.info("[CIRCUIT] %s: провайдер восстановился, цепь замкнута", provider_name)
+                circuit["updated_at"] = time.time()
+                self._dirty.add(provider_name)
+            circuit.update({
+                "state": self.CLOSED,
+                "failures": 0,
+                "open_until": 0.0,
+                "cooldown": 0.0,
+                "trial_in_flight": False,
+            })
+
+    def record_failure(self, provider_name: str, error_class: str, retry_after: Optional[float] = None):
+        """Учесть ошибку провайдера и при необходимости разомкнуть цепь
+
+        Args:
+            provider_name: Имя провайдера
+            error_class: Класс ошибки из GPTService._classify_error
+            retry_after: Время ожидания, которое сообщил сам провайдер (сек)
+        """
+        if error_class not in self.cooldowns:
+            # Ошибка не говорит о здоровье провайдера (прокси, vision) - только освобождаем пробу
+            self.release(provider_name)
+            return
+
+        with self._lock:
+            circuit = self._get(provider_name)
+            circuit["failures"] += 1
+            circuit["last_error"] = error_class
+
+            if circuit["state"] == self.HALF_OPEN:
+                # Пробный запрос не прошел - размыкаем снова с удвоенным cooldown
+                cooldown = min(max(circuit["cooldown"] * 2, self.cooldowns[error_class]), self.max_cooldown)
+            elif error_class in self.IMMEDIATE_ERRORS or circuit["failures"] >= self.failure_threshold:
+                cooldown = self.cooldowns[error_class]
+            else:
+                return
+
+            if retry_after:
+                cooldown = min(max(cooldown, retry_after), self.max_cooldown)
+
+            now = time.time()
+            circuit.update({
+                "state": self.OPEN,
+                "open_until": now + cooldown,
+                "cooldown": cooldown,
+                "trial_in_flight": False,
+                "updated_at": now,
+            })
+            self._dirty.add(provider_name)
+            logger.warning("[CIRCUIT] %s: цепь разомкнута на %.0fс (%s)", provider_name, cooldown, error_class)
+
+    def export_changes(self) -> Dict[str, Dict[str, Any]]:
+        """Забрать неопубликованные смены состояния для других процессов"""
+        with self._lock:
+            changes = {}
+            for name in self._dirty:
+                circuit = self._circuits[name]
+                changes[name] = {
+                    "state": self.OPEN if circuit["state"] == self.OPEN else self.CLOSED,
+                    "open_until": circuit["open_until"],
+                    "cooldown": circuit["cooldown"],
+                    "last_error": circuit["last_error"],
+                    "updated_at": circuit["updated_at"],
+                }
+            self._dirty.clear()
+            return changes
+
+    def restore_changes(self, provider_names):
+        """Вернуть неопубликованные изменения (публикация не удалась)"""
+        with self._lock:
+            self._dirty.update(name for name in provider_names if name in self._circuits)
+
+    def apply_remote(self, provider_name: str, record: Dict[str, Any]):
+        """Применить состояние, опубликованное другим процессом, если оно новее локального"""
+        with self._lock:
+            circuit = self._get(provider_name)
+            if record.get("updated_at", 0) <= circuit["updated_at"]:
+                return
+
+            if record["state"] == self.OPEN:
+                if record["open_until"] <= time.time():
+                    return
+                if circuit["state"] != self.OPEN:
+                    logger.warning("[CIRCUIT] %s: цепь разомкнута другим процессом (%s)", provider_name, record.get('last_error'))
+                circuit.update({
+                    "state": self.OPEN,
+                    "open_until": record["open_until"],
+                    "cooldown": record["cooldown"],
+                    "last_error": record.get("last_error"),
+                    "trial_in_flight": False,
+                })
+            elif circuit["state"] != self.CLOSED:
+                logger.info("[CIRCUIT] %s: другой процесс получил успешный ответ, цепь замкнута", provider_name)
+                circuit.update({
+                    "state": self.CLOSED,
+                    "failures": 0,
+                    "open_until": 0.0,
+                    "cooldown": 0.0,
+                    "trial_in_flight": False,
+                })
+            circuit["updated_at"] = record["updated_at"]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Снимок состояний для API и логов"""
+        now = time.time()
+        with self._lock:
+            return {
+                name: {
+                    "state": circuit["state"],
+                    "failures": circuit["failures"],
+                    "last_error": circuit["last_error"],
+                    "retry_in": max(0, round(circuit["open_until"] - now, 1)) if circuit["state"] == self.OPEN else 0,
+                }
+                for name, circuit in self._circuits.items()
+            }
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from .provider_health import ProviderScoreboard, CircuitBreaker
+from .redis_client import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderStateSync:
+    """Общее для всех процессов состояние провайдеров в Redis
+
+    Горячий путь работает только с локальными ProviderScoreboard и CircuitBreaker.
+    Фоновый поток раз в interval секунд публикует локальные изменения и забирает
+    чужие: размыкание цепи одним процессом через несколько секунд видят все,
+    а рейтинг провайдеров строится по статистике всего парка процессов.
+
+    Ключи Redis:
+        gpt_provider_state:circuits  - провайдер -> последнее состояние цепи (выигрывает более новое)
+        gpt_provider_state:stats     - процесс -> его статистика провайдеров (EWMA и вес)
+        gpt_provider_state:successes - провайдер -> число успешных ответов по всем процессам
+    """
+
+    KEY_PREFIX = 'gpt_provider_state'
+
+    def __init__(self, scoreboard: ProviderScoreboard, circuit_breaker: CircuitBreaker,
+                 enabled: bool = True, interval: float = 2.0, stale_after: float = 300):
+        self.scoreboard = scoreboard
+        self.circuit_breaker = circuit_breaker
+        self.enabled = enabled
+        self.interval = interval
+        self.stale_after = stale_after  # Статистика процессов, не отвечавших дольше, не учитывается
+
+        self.successes = Counter()  # Успехи всего парка (обновляется при синхронизации)
+        self._pending_successes = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def process_id(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def ensure_started(self):
+        """Запустить поток синхронизации (повторно - после fork воркера)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='provider-state-sync', daemon=True)
+            self._thread.start()
+
+    def record_success(self, provider_name: str):
+        """Учесть успешный ответ в общем счетчике (отправится при следующей синхронизации)"""
+        with self._lock:
+            self._pending_successes[provider_name] += 1
+            self.successes[provider_name] += 1
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.warning("[SHARED_STATE] Синхронизация состояния провайдеров не удалась: %s", e)
+            time.sleep(self.interval)
+
+    def sync(self):
+        """Опубликовать локальные изменения и применить состояние других процессов"""
+        redis = get_sync_redis()
+        circuits_key = f"{self.KEY_PREFIX}:circuits"
+        stats_key = f"{self.KEY_PREFIX}:stats"
+        successes_key = f"{self.KEY_PREFIX}:successes"
+
+        changes = self.circuit_breaker.export_changes()
+        with self._lock:
+            pending, self._pending_successes = self._pending_successes, Counter()
+
+        pipe = redis.pipeline(transaction=False)
+        if changes:
+            pipe.hset(circuits_key, mapping={name: json.dumps(record) for name, record in changes.items()})
+        pipe.hset(stats_key, self.process_id, json.dumps({
+            "updated_at": time.time(),
+            "providers": self.scoreboard.export_local(),
+        }))
+        for name, count in pending.items():
+            pipe.hincrby(successes_key, name, count)
+        pipe.hgetall(circuits_key)
+        pipe.hgetall(stats_key)
+        pipe.hgetall(successes_key)
+        try:
+            *_, circuits, stats, successes = pipe.execute()
+        except Exception:
+            # Не теряем изменения - опубликуем при следующей попытке
+            self.circuit_breaker.restore_changes(changes)
+            with self._lock:
+                self._pending_successes.update(pending)
+            raise
+
+        for name, raw in circuits.items():
+            self.circuit_breaker.apply_remote(name.decode(), json.loads(raw))
+
+        now = time.time()
+        snapshots = []
+        stale = []
+        for process_id, raw in stats.items():
+            process_id = process_id.decode()
+            if process_id == self.process_id:
+                continue
+            entry = json.loads(raw)
+            if now - entry.get("updated_at", 0) > self.stale_after:
+                stale.append(process_id)
+                continue
+            snapshots.append(entry.get("providers", {}))
+        self.scoreboard.set_remote(snapshots)
+        if stale:
+            redis.hdel(stats_key, *stale)
+
+        with self._lock:
+            self.successes = Counter({name.decode(): int(count) for name, count in successes.items()})
@@ -0,0 +1,120 @@
+import logging
+import math
+import time
+from typing import Tuple
+from django.conf import settings
+from .priority import PRIORITY_ANON
+from .redis_client import get_async_redis
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Token bucket сразу для нескольких ключей: запрос проходит, только если токенов хватает
+# во всех корзинах, и тогда списывается из всех. Иначе возвращается время ожидания.
+# ARGV: now, cost, затем пары (rate в токенах/сек, burst) для каждого ключа
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    local state = redis.call('hmget', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    redis.call('hset', key, 'tokens', levels[i] - cost, 'ts', now)
+    redis.call('expire', key, math.ceil(burst / rate) + 1)
+end
+return {1, '0'}
+"""
+
+
+def get_client_ip(meta: dict) -> str:
+    """IP клиента из request.META (X-Forwarded-For учитывается только за доверенным прокси)"""
+    if getattr(settings, 'RATE_LIMIT_TRUST_PROXY', False):
+        forwarded = meta.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return meta.get('REMOTE_ADDR') or 'unknown'
+
+
+class RateLimiter:
+    """Ограничение частоты запросов к провайдерам (token bucket в Redis)
+
+    Корзины ведутся по пользователю (для анонимов - по IP) и по сессии чата, лимиты
+    зависят от приоритета (priority.PRIORITIES). Проверка идет до записи в БД и
+    обращения к провайдерам, чтобы лишние запросы отклонялись как можно дешевле.
+    Если Redis недоступен, запросы пропускаются.
+    """
+
+    KEY_PREFIX = 'rate_limit'
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+        self.limits = getattr(settings, 'RATE_LIMITS', {})
+        self.costs = getattr(settings, 'RATE_LIMIT_COSTS', {})
+
+    async def check(self, action: str, priority: str = None, user=None, ip: str = None, session_id: str = None) -> Tuple[bool, float]:
+        """Списать токены за действие
+
+        Args:
+            action: Тип действия ('chat', 'image'), от него зависит стоимость
+            priority: Приоритет пользователя, определяет лимиты
+            user: Пользователь или None для анонимов
+            ip: IP клиента (ключ корзины для анонимов)
+            session_id: ID сессии чата
+
+        Returns:
+            Кортеж (разрешено, через сколько секунд повторить)
+        """
+        limit = self.limits.get(priority) or self.limits.get(PRIORITY_ANON)
+        if not self.enabled or not limit:
+            return True, 0.0
+
+        rate = limit['per_minute'] / 60.0
+        burst = limit['burst']
+        cost = min(self.costs.get(action, 1), burst)  # Иначе запрос не прошел бы никогда
+
+        identity = f"user:{user.pk}" if user is not None and user.is_authenticated else f"ip:{ip or 'unknown'}"
+        keys = [f"{self.KEY_PREFIX}:{identity}"]
+        if session_id:
+            keys.append(f"{self.KEY_PREFIX}:session:{session_id}")
+
+        args = [time.time(), cost]
+        for _ in keys:
+            args.extend([rate, burst])
+
+        try:
+            allowed, wait = await get_async_redis().eval(TOKEN_BUCKET_SCRIPT, len(keys), *keys, *args)
+        except Exception as e:
+            logger.warning("[RATE_LIMIT] Redis недоступен, запрос пропущен без проверки: %s", e)
+            return True, 0.0
+
+        if int(allowed):
+            return True, 0.0
+
+        retry_after = float(wait)
+        metrics.inc('gpt_rate_limited_total', {'action': action, 'priority': priority or PRIORITY_ANON})
+        logger.warning("[RATE_LIMIT] %s (%s): лимит '%s' исчерпан, повтор через %.1fс", identity, priority, action, retry_after)
+        return False, retry_after
+
+    @staticmethod
+    def retry_after_header(retry_after: float) -> str:
+        """Значение заголовка Retry-After (целые секунды, не меньше 1)"""
+        return str(max(1, math.ceil(retry_after)))
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,28 @@
+import asyncio
+import weakref
+import redis.asyncio as aioredis
+from django.conf import settings
+from django_redis import get_redis_connection
+
+# Асинхронный клиент привязан к event loop, поэтому держим по одному на каждый loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis_url() -> str:
+    """Адрес Redis, который уже используется для кэша Django"""
+    return settings.CACHES['default']['LOCATION']
+
+
+def get_async_redis() -> aioredis.Redis:
+    """Асинхронный клиент Redis для текущего event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = aioredis.Redis.from_url(get_redis_url())
+        _async_clients[loop] = client
+    return client
+
+
+def get_sync_redis():
+    """Синхронный клиент Redis из пула django_redis"""
+    return get_redis_connection('default')
@@ -0,0 +1,78 @@
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResolutionTable:
+    """Таблица имен провайдеров и моделей -> объектов g4f (строится один раз при старте)
+
+    Попытка запроса берет провайдера и модель одним обращением к словарю, без
+    hasattr/getattr по модулям g4f. Имена провайдеров из конфигурации, которых нет
+    в установленной версии g4f, выводятся в лог при создании таблицы.
+    """
+
+    def __init__(self, provider_names: Iterable[str], expected_missing: Iterable[str] = ()):
+        import g4f  # Тяжелый импорт - только когда сервис действительно создается
+        self.providers = {}  # Имя -> класс провайдера g4f
+        self.models = self._build_models()  # Строка модели -> объект g4f.models.Model
+        self.default_model = g4f.models.default
+
+        missing = []
+        for name in dict.fromkeys(provider_names):
+            provider = self._lookup(name)
+            if provider is None:
+                missing.append(name)
+            else:
+                self.providers[name] = provider
+        self.missing_providers = missing
+        self._missing = set(missing)
+
+        expected_missing = set(expected_missing)
+        unexpected = [name for name in missing if name not in expected_missing]
+        if unexpected:
+            logger.warning("[RESOLVE] Провайдеры из конфигурации не найдены в g4f.Provider: %s", unexpected)
+        if len(missing) > len(unexpected):
+            logger.info("[RESOLVE] Не найдены в g4f.Provider (заблокированные): %s", [n for n in missing if n in expected_missing])
+        logger.info("[RESOLVE] Провайдеров: %s, моделей: %s", len(self.providers), len(self.models))
+
+    @staticmethod
+    def _build_models() -> Dict[str, Any]:
+        """Все модели g4f.models под всеми допустимыми написаниями (gpt_4o, gpt-4o, имя модели)"""
+        import g4f
+        models = {}
+        for attr, model in vars(g4f.models).items():
+            if isinstance(model, g4f.models.Model):
+                models.setdefault(attr, model)
+        # Дефисы вместо подчеркиваний и собственные имена моделей - только если не заняты атрибутами
+        for attr, model in list(models.items()):
+            models.setdefault(attr.replace('_', '-'), model)
+            if model.name:
+                models.setdefault(model.name, model)
+        return models
+
+    @staticmethod
+    def _lookup(name: str):
+        """Найти провайдера в g4f.Provider (ленивая загрузка g4f может бросить не только AttributeError)"""
+        import g4f
+        try:
+            return getattr(g4f.Provider, name, None)
+        except Exception as e:
+            logger.warning("[RESOLVE] Ошибка загрузки провайдера %s: %s", name, e)
+            return None
+
+    def provider(self, name: str):
+        """Класс провайдера g4f или None"""
+        provider = self.providers.get(name)
+        if provider is None and name not in self._missing:
+            # Провайдер не из конфигурации (передан в запросе) - ищем и запоминаем найденный
+            provider = self._lookup(name)
+            if provider is not None:
+                self.providers[name] = provider
+        return provider
+
+    def model(self, name: Optional[str]):
+        """Объект модели g4f; неизвестное имя передается в g4f строкой, пустое - модель по умолчанию"""
+        if not name:
+            return self.default_model
+        return self.models.get(name, name)
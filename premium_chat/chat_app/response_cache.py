@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Dict, Any, Optional
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from .redis_client import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Кэш ответов GPT в Redis (через django_redis) для одинаковых запросов
+
+    Ключ - хэш нормализованной истории разговора, модели и явно выбранных провайдеров. Записи живут ttl секунд,
+    а индекс в sorted set хранит время последнего обращения: при превышении
+    max_entries вытесняются самые давно использованные записи (LRU).
+    """
+
+    KEY_PREFIX = 'gpt_response'
+
+    def __init__(self, enabled: bool = True, ttl: int = 3600, max_entries: int = 10000):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_key = f'{self.KEY_PREFIX}:lru'
+        self.stats_key = f'{self.KEY_PREFIX}:stats'
+
+        # Локальные счетчики процесса (общие счетчики лежат в Redis)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, chat_history: list, model: Any, providers: list = None, preferred_provider: str = None) -> Optional[str]:
+        """Построить ключ кэша. Для мультимедийных сообщений (vision) возвращает None
+
+        Явно выбранные провайдеры входят в ключ: ответ другого провайдера такому запросу не подходит.
+        """
+        normalized = []
+        for message in chat_history:
+            content = message.get("content")
+            if not isinstance(content, str):
+                return None
+            # Регистр не трогаем, но лишние пробелы и переносы на смысл не влияют
+            normalized.append([message.get("role"), " ".join(content.split())])
+
+        key_data = {"model": str(model), "messages": normalized}
+        if providers:
+            key_data["providers"] = list(providers)
+        if preferred_provider:
+            key_data["preferred_provider"] = preferred_provider
+        payload = json.dumps(key_data, ensure_ascii=False)
+        return f'{self.KEY_PREFIX}:{hashlib.sha256(payload.encode("utf-8")).hexdigest()}'
+
+    def _redis(self):
+        return get_sync_redis()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Получить ответ из кэша и обновить его позицию в LRU"""
+        try:
+            result = cache.get(key)
+            redis = self._redis()
+            pipe = redis.pipeline()
+            if result is not None:
+                pipe.zadd(cache.make_key(self.index_key), {key: time.time()})
+            pipe.hincrby(cache.make_key(self.stats_key), 'hits' if result is not None else 'misses', 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("[CACHE] Ошибка чтения кэша: %s", e)
+            result = None
+
+        if result is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return result
+
+    def set(self, key: str, result: Dict[str, Any]):
+        """Сохранить успешный ответ и вытеснить лишние записи по LRU"""
+        try:
+            cache.set(key, result, timeout=self.ttl)
+            redis = self._redis()
+            index_key = cache.make_key(self.index_key)
+            pipe = redis.pipeline()
+            pipe.zadd(index_key, {key: time.time()})
+            # Записи старше ttl уже истекли в Redis - убираем их из индекса
+            pipe.zremrangebyscore(index_key, 0, time.time() - self.ttl)
+            pipe.zcard(index_key)
+            size = pipe.execute()[-1]
+
+            if size > self.max_entries:
+                evicted = [
+                    member.decode() if isinstance(member, bytes) else member
+                    for member, _ in redis.zpopmin(index_key, size - self.max_entries)
+                ]
+                cache.delete_many(evicted)
+                logger.info("[CACHE] Вытеснено %s давно не использованных ответов", len(evicted))
+        except Exception as e:
+            logger.warning("[CACHE] Ошибка записи в кэш: %s", e)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+    async def aset(self, key: str, result: Dict[str, Any]):
+        await sync_to_async(self.set, thread_sensitive=False)(key, result)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий: локальные для процесса и общие из Redis"""
+        stats = {
+            "enabled": self.enabled,
+            "process_hits": self.hits,
+            "process_misses": self.misses,
+        }
+        try:
+            shared = self._redis().hgetall(cache.make_key(self.stats_key))
+            hits = int(shared.get(b'hits', 0))
+            misses = int(shared.get(b'misses', 0))
+            stats.update({
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            })
+        except Exception as e:
+            logger.warning("[CACHE] Не удалось прочитать счетчики кэша: %s", e)
+        return stats
+
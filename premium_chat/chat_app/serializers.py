@@ -26,9 +26,9 @@ class ChatSessionSerializer(serializers.ModelSerializer):
         model = ChatSession
         fields = [
             'id', 'user', 'session_id', 'title', 'created_at', 'updated_at',
-            'is_active', 'messages', 'message_count'
+            'is_active', 'messages', 'message_count', 'summary', 'summary_updated_at'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'summary', 'summary_updated_at']
 
 class ChatSessionListSerializer(serializers.ModelSerializer):
     """Упрощенный сериализатор для списка сессий"""
@@ -113,6 +113,8 @@ class ChatRequestSerializer(serializers.Serializer):
     include_history = serializers.BooleanField(default=True)
     max_history = serializers.IntegerField(default=50, min_value=1, max_value=100)
     image_data = serializers.CharField(required=False, help_text="Base64 encoded image data")
+    use_cache = serializers.BooleanField(default=True, help_text="Разрешить ответ из кэша для одинаковых запросов")
+    timeout = serializers.FloatField(required=False, min_value=5, max_value=300, help_text="Общий срок ожидания ответа (сек)")
 
 class ChatResponseSerializer(serializers.Serializer):
     """Сериализатор для ответа чата"""
@@ -137,4 +139,9 @@ class ProviderInfoSerializer(serializers.Serializer):
     working_providers = serializers.IntegerField()
     backup_providers = serializers.IntegerField()
     provider_stats = serializers.DictField()
+    provider_scores = serializers.DictField(required=False)
+    circuits = serializers.DictField(required=False)
+    cache = serializers.DictField(required=False)
+    coalesced_requests = serializers.IntegerField(required=False)
+    load = serializers.DictField(required=False)
     all = serializers.ListField(child=serializers.CharField())
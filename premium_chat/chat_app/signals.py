@@ -14,7 +14,7 @@ def chat_session_created(sender, instance, created, **kwargs):
     Сигнал, срабатывающий при создании новой сессии чата.
     """
     if created:
-        logger.info(f"Создана новая сессия чата: {instance.session_id}")
+        logger.info("[SIGNAL] Создана новая сессия чата: %s", instance.session_id)
 
 
 @receiver(post_save, sender=ChatMessage)
@@ -23,7 +23,7 @@ def chat_message_created(sender, instance, created, **kwargs):
     Сигнал, срабатывающий при создании нового сообщения.
     """
     if created:
-        logger.info(f"Создано новое сообщение в сессии {instance.session.session_id}")
+        logger.info("[SIGNAL] Создано новое сообщение в сессии %s", instance.session.session_id)
         
         # Обновляем время последнего обновления сессии
         instance.session.save()
@@ -34,7 +34,7 @@ def chat_session_deleted(sender, instance, **kwargs):
     """
     Сигнал, срабатывающий перед удалением сессии чата.
     """
-    logger.info(f"Удаляется сессия чата: {instance.session_id}")
+    logger.info("Удаляется сессия чата: %s", instance.session_id)
 
 
 @receiver(pre_delete, sender=ChatMessage)
@@ -42,4 +42,4 @@ def chat_message_deleted(sender, instance, **kwargs):
     """
     Сигнал, срабатывающий перед удалением сообщения.
     """
-    logger.info(f"Удаляется сообщение из сессии {instance.session.session_id}")
+    logger.info("Удаляется сообщение из сессии %s", instance.session.session_id)
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from typing import Dict, Any, Optional, Tuple
+from .redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Снимаем блокировку только если она все еще наша (ее могли перехватить после истечения TTL)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Flight:
+    """Запрос-лидер: единственный, кто реально обращается к провайдерам по ключу"""
+
+    def __init__(self, owner: 'SingleFlight', key: str, future: asyncio.Future, token: Optional[str]):
+        self.owner = owner
+        self.key = key
+        self.future = future
+        self.token = token  # Токен блокировки в Redis (None, если Redis недоступен)
+        self.finished = False
+
+    async def finish(self, result: Dict[str, Any]):
+        """Раздать результат ожидающим запросам в этом и других процессах"""
+        if not self.finished:
+            self.finished = True
+            await self.owner._finish(self, result)
+
+    async def abort(self):
+        """Лидер не получил результат (отмена, ошибка) - ожидающие выполнят запрос сами"""
+        if not self.finished:
+            self.finished = True
+            await self.owner._finish(self, None)
+
+
+class SingleFlight:
+    """Объединение одинаковых запросов, выполняющихся одновременно
+
+    Внутри процесса ожидающие запросы ждут asyncio.Future лидера. Между процессами
+    лидер держит блокировку в Redis, а результат публикует в канал и кладет
+    в короткоживущий ключ для тех, кто подписался позже публикации.
+    """
+
+    KEY_PREFIX = 'gpt_singleflight'
+
+    def __init__(self, enabled: bool = True, lock_ttl: int = 180, wait_timeout: float = 180, result_ttl: int = 30):
+        self.enabled = enabled
+        self.lock_ttl = lock_ttl  # Страховка на случай падения лидера
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self._local = {}  # (event loop, ключ) -> Future лидера
+        self._lock = threading.Lock()
+
+        self.coalesced = 0  # Сколько запросов получили чужой результат
+
+    def _keys(self, key: str) -> Tuple[str, str, str]:
+        return (
+            f'{self.KEY_PREFIX}:lock:{key}',
+            f'{self.KEY_PREFIX}:result:{key}',
+            f'{self.KEY_PREFIX}:channel:{key}',
+        )
+
+    async def join(self, key: str, timeout: float = None) -> Tuple[Optional[Flight], Optional[Dict[str, Any]]]:
+        """Присоединиться к запросу по ключу
+
+        timeout - сколько секунд осталось до срока запроса: дольше результат лидера не ждем
+        (и в любом случае не дольше wait_timeout и lock_ttl).
+
+        Returns:
+            (Flight, None) - мы лидер: выполнить запрос и вызвать finish()/abort()
+            (None, result) - результат получен от лидера
+            (None, None)   - лидер не справился, запрос нужно выполнить самостоятельно
+        """
+        if not self.enabled:
+            return None, None
+
+        loop = asyncio.get_running_loop()
+        local_key = (loop, key)
+
+        with self._lock:
+            future = self._local.get(local_key)
+            if future is None:
+                future = loop.create_future()
+                self._local[local_key] = future
+                leader = True
+            else:
+                leader = False
+
+        wait = min(self.wait_timeout, self.lock_ttl)
+        if timeout is not None:
+            wait = min(wait, max(timeout, 0))
+
+        if not leader:
+            logger.info("[SINGLEFLIGHT] Такой же запрос уже выполняется в этом процессе, ждем его результат")
+            await asyncio.wait([future], timeout=wait)
+            if not future.done():
+                logger.info("[SINGLEFLIGHT] Лидер не успел к сроку запроса")
+                return None, None
+            return None, self._mark_coalesced(None if future.cancelled() else future.result())
+
+        token = uuid.uuid4().hex
+        try:
+            lock_key, _, _ = self._keys(key)
+            acquired = await get_async_redis().set(lock_key, token, nx=True, ex=self.lock_ttl)
+        except Exception as e:
+            logger.warning("[SINGLEFLIGHT] Redis недоступен, объединяем запросы только внутри процесса: %s", e)
+            return Flight(self, key, future, None), None
+
+        if acquired:
+            return Flight(self, key, future, token), None
+
+        # Лидер в другом процессе: ждем его результат, а локальные дубли ждут нас
+        logger.info("[SINGLEFLIGHT] Такой же запрос выполняется в другом процессе, ждем результат")
+        result = await self._wait_remote(key, wait)
+        self._resolve_local(local_key, future, result)
+        return None, self._mark_coalesced(result)
+
+    async def _wait_remote(self, key: str, wait: float) -> Optional[Dict[str, Any]]:
+        """Дождаться результата лидера из другого процесса через Redis (не дольше wait секунд)"""
+        lock_key, result_key, channel = self._keys(key)
+        loop = asyncio.get_running_loop()
+        try:
+            redis = get_async_redis()
+            pubsub = redis.pubsub()
+            await pubsub.subscribe(channel)
+            try:
+                # Результат мог появиться до подписки
+                raw = await redis.get(result_key)
+                deadline = loop.time() + wait
+                while raw is None and loop.time() < deadline:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(1.0, max(deadline - loop.time(), 0)))
+                    if message:
+                        raw = message['data']
+                    elif not await redis.exists(lock_key):
+                        # Лидер завершился без публикации (или мы пропустили сообщение)
+                        raw = await redis.get(result_key)
+                        break
+            finally:
+                await pubsub.reset()
+        except Exception as e:
+            logger.warning("[SINGLEFLIGHT] Ошибка ожидания результата лидера: %s", e)
+            return None
+
+        if not raw:
+            return None
+        result = json.loads(raw)
+        return result or None
+
+    async def _finish(self, flight: Flight, result: Optional[Dict[str, Any]]):
+        """Отдать результат лидера ожидающим и снять блокировку"""
+        loop = asyncio.get_running_loop()
+        self._resolve_local((loop, flight.key), flight.future, result)
+
+        if flight.token is None:
+            return
+
+        lock_key, result_key, channel = self._keys(flight.key)
+        try:
+            redis = get_async_redis()
+            payload = json.dumps(result, ensure_ascii=False, default=str)
+            pipe = redis.pipeline(transaction=False)
+            if result is not None:
+                pipe.set(result_key, payload, ex=self.result_ttl)
+            # Пустой результат (null) тоже публикуем, чтобы ожидающие не ждали до таймаута
+            pipe.publish(channel, payload)
+            pipe.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, flight.token)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("[SINGLEFLIGHT] Не удалось опубликовать результат: %s", e)
+
+    def _resolve_local(self, local_key, future: asyncio.Future, result: Optional[Dict[str, Any]]):
+        with self._lock:
+            if self._local.get(local_key) is future:
+                del self._local[local_key]
+        if not future.done():
+            if result is None:
+                future.cancel()
+            else:
+                future.set_result(result)
+
+    def _mark_coalesced(self, result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if result is None:
+            logger.info("[SINGLEFLIGHT] Лидер не получил ответ, выполняем запрос самостоятельно")
+            return None
+        self.coalesced += 1
+        result = dict(result)
+        result["coalesced"] = True
+        return result
@@ -0,0 +1,126 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import ChatSession
+from .gpt_service import get_gpt_service
+from .tokens import estimate_tokens
+from .priority import PRIORITY_ANON
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Ниже краткое содержание начала разговора и следующие за ним сообщения. "
+    "Обнови краткое содержание так, чтобы оно охватывало весь разговор: сохрани факты, "
+    "имена, договоренности, код и вопросы пользователя, которые еще важны. "
+    "Пиши на языке разговора, не длиннее {max_words} слов, без вступлений - только само содержание."
+)
+
+
+class ConversationSummarizer:
+    """Фоновое сжатие старой части разговора в ChatSession.summary
+
+    Последние keep_recent сообщений всегда уходят в запрос как есть, а все, что
+    старше, постепенно сворачивается в краткое содержание. Обновление идет
+    порциями (не меньше min_batch сообщений) в отдельном потоке быстрыми
+    провайдерами и не задерживает ответ пользователю.
+    """
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'GPT_SUMMARY_ENABLED', True)
+        self.keep_recent = getattr(settings, 'GPT_SUMMARY_KEEP_RECENT', 20)
+        self.min_batch = getattr(settings, 'GPT_SUMMARY_MIN_BATCH', 10)
+        self.batch_tokens = getattr(settings, 'GPT_SUMMARY_BATCH_TOKENS', 4000)
+        self.max_words = getattr(settings, 'GPT_SUMMARY_MAX_WORDS', 300)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+        self._pending = set()  # Сессии, для которых обновление уже запланировано
+        self._lock = threading.Lock()
+
+    def schedule(self, session: ChatSession):
+        """Запланировать обновление краткого содержания сессии (не блокирует)"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if session.pk in self._pending:
+                return
+            self._pending.add(session.pk)
+        self._executor.submit(self._run, session.pk)
+
+    def _run(self, session_pk):
+        try:
+            # Каждая порция сдвигает summary_until, поэтому цикл конечен
+            while self.refresh(session_pk):
+                pass
+        except Exception as e:
+            logger.error("[SUMMARY] Ошибка обновления краткого содержания сессии %s: %s", session_pk, e)
+        finally:
+            with self._lock:
+                self._pending.discard(session_pk)
+            close_old_connections()
+
+    def refresh(self, session_pk) -> bool:
+        """Свернуть накопившиеся старые сообщения в краткое содержание
+
+        Returns:
+            True, если краткое содержание обновлено
+        """
+        session = ChatSession.objects.get(pk=session_pk)
+        messages = session.messages.filter(message_type__in=['user', 'assistant'])
+        if session.summary_until:
+            messages = messages.filter(created_at__gt=session.summary_until)
+        messages = list(messages.order_by('created_at'))
+
+        # Последние keep_recent сообщений не трогаем - они идут в запрос целиком
+        candidates = messages[:-self.keep_recent] if self.keep_recent else messages
+        if len(candidates) < self.min_batch:
+            return False
+
+        batch = []
+        used = 0
+        for msg in candidates:
+            tokens = msg.tokens_used if msg.tokens_used is not None else estimate_tokens(msg.content)
+            if batch and used + tokens > self.batch_tokens:
+                break
+            batch.append(msg)
+            used += tokens
+
+        # Пара вопрос-ответ не должна разрываться между содержанием и историей
+        if batch[-1].message_type == 'user' and len(batch) < len(candidates):
+            batch.pop()
+        if not batch:
+            return False
+
+        transcript = "\n\n".join(
+            f"{'Пользователь' if msg.message_type == 'user' else 'Ассистент'}: {msg.raw_content or msg.content}"
+            for msg in batch
+        )
+        prompt = (
+            f"{SUMMARY_PROMPT.format(max_words=self.max_words)}\n\n"
+            f"Краткое содержание:\n{session.summary or '(пока нет)'}\n\n"
+            f"Новые сообщения:\n{transcript}"
+        )
+
+        logger.info("[SUMMARY] Сессия %s: сворачиваем %s сообщений (~%s токенов)", session.session_id, len(batch), used)
+        # Фоновая работа идет с низшим приоритетом и не отнимает слоты у запросов пользователей
+        gpt_service = get_gpt_service()
+        result = gpt_service.get_response_sync(prompt, providers=gpt_service.fast_providers, use_cache=False, priority=PRIORITY_ANON)
+        summary = (result.get('raw_response') or '').strip()
+        if not result.get('success') or not summary:
+            logger.warning("[SUMMARY] Сессия %s: не удалось получить краткое содержание", session.session_id)
+            return False
+
+        # update(), а не save(): не трогаем updated_at и поля, которые мог изменить запрос
+        ChatSession.objects.filter(pk=session.pk).update(
+            summary=summary,
+            summary_until=batch[-1].created_at,
+            summary_updated_at=timezone.now(),
+        )
+        logger.info("[SUMMARY] Сессия %s: краткое содержание обновлено (%s символов)", session.session_id, len(summary))
+        return True
+
+
+summarizer = ConversationSummarizer()
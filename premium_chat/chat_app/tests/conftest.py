@@ -0,0 +1,25 @@
+import types
+import pytest
+
+
+class FakeClock:
+    """Управляемое время для модулей, которые вызывают time.time() / time.monotonic()"""
+
+    def __init__(self, monkeypatch, start: float = 1000.0):
+        self.value = start
+        self._monkeypatch = monkeypatch
+
+    def install(self, *modules):
+        """Подменить атрибут time в модулях: время идет только через advance()"""
+        fake_time = types.SimpleNamespace(time=lambda: self.value, monotonic=lambda: self.value)
+        for module in modules:
+            self._monkeypatch.setattr(module, 'time', fake_time)
+        return self
+
+    def advance(self, seconds: float):
+        self.value += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return FakeClock(monkeypatch)
@@ -0,0 +1,85 @@
+import pytest
+from chat_app import provider_health
+from chat_app.provider_health import CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(clock):
+    clock.install(provider_health)
+
+
+def test_rate_limit_opens_immediately():
+    breaker = CircuitBreaker(cooldowns={'rate_limit': 60})
+    breaker.record_failure('p', 'rate_limit')
+
+    assert breaker.is_open('p')
+    assert not breaker.allow('p')
+    assert breaker.snapshot()['p']['state'] == CircuitBreaker.OPEN
+
+
+def test_soft_errors_open_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3)
+    breaker.record_failure('p', 'timeout')
+    breaker.record_failure('p', 'timeout')
+    assert not breaker.is_open('p')
+
+    breaker.record_failure('p', 'timeout')
+    assert breaker.is_open('p')
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure('p', 'timeout')
+    breaker.record_success('p')
+    breaker.record_failure('p', 'timeout')
+    assert not breaker.is_open('p')
+
+
+def test_half_open_allows_single_trial(clock):
+    breaker = CircuitBreaker(cooldowns={'rate_limit': 60})
+    breaker.record_failure('p', 'rate_limit')
+    clock.advance(61)
+
+    assert breaker.allow('p')
+    assert not breaker.allow('p')  # Второй запрос ждет исхода пробного
+    assert breaker.is_open('p')
+
+    breaker.release('p')  # Пробный запрос отменен без результата
+    assert breaker.allow('p')
+
+    breaker.record_success('p')
+    assert breaker.allow('p') and breaker.allow('p')
+    assert breaker.snapshot()['p']['state'] == CircuitBreaker.CLOSED
+
+
+def test_failed_trial_doubles_cooldown(clock):
+    breaker = CircuitBreaker(cooldowns={'rate_limit': 60}, max_cooldown=100)
+    breaker.record_failure('p', 'rate_limit')
+    clock.advance(61)
+    assert breaker.allow('p')
+
+    breaker.record_failure('p', 'rate_limit')
+    clock.advance(99)
+    assert not breaker.allow('p')  # cooldown 60 * 2, ограничен max_cooldown=100
+    clock.advance(2)
+    assert breaker.allow('p')
+
+
+def test_provider_retry_after_extends_cooldown(clock):
+    breaker = CircuitBreaker(cooldowns={'rate_limit': 60})
+    breaker.record_failure('p', 'rate_limit', retry_after=300)
+    clock.advance(299)
+    assert not breaker.allow('p')
+    clock.advance(2)
+    assert breaker.allow('p')
+
+
+def test_unrelated_error_only_releases_trial(clock):
+    breaker = CircuitBreaker(cooldowns={'rate_limit': 60})
+    breaker.record_failure('p', 'rate_limit')
+    clock.advance(61)
+    assert breaker.allow('p')
+
+    breaker.record_failure('p', 'proxy')  # Не говорит о здоровье провайдера
+    assert breaker.allow('p')
+    assert breaker.snapshot()['p']['state'] == CircuitBreaker.HALF_OPEN
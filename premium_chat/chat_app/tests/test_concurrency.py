@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import pytest
+from chat_app.concurrency import ConcurrencyLimiter, LimiterOverloaded
+from chat_app.priority import PRIORITY_ANON, PRIORITY_PREMIUM, PRIORITY_USER
+
+
+async def _settle():
+    """Дать ожидающим задачам дойти до очереди лимитера"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def _slots(limiter, key='p'):
+    return limiter.snapshot()["slots"].get(key, {"active": 0, "waiting": 0})
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, queue_timeout=5)
+        await limiter.acquire('p')
+        waiter = asyncio.create_task(limiter.acquire('p'))
+        await _settle()
+        assert _slots(limiter)["waiting"] == 1
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert _slots(limiter) == {"active": 1, "waiting": 0, "waiting_by_priority": {}, "limit": 1}
+
+        limiter.release('p')
+        assert _slots(limiter)["active"] == 0
+        await asyncio.wait_for(limiter.acquire('p'), 0.1)  # Слот свободен сразу
+
+    asyncio.run(scenario())
+
+
+def test_slot_granted_to_cancelled_waiter_passes_to_next():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, queue_timeout=5)
+        await limiter.acquire('p')
+        first = asyncio.create_task(limiter.acquire('p'))
+        second = asyncio.create_task(limiter.acquire('p'))
+        await _settle()
+
+        # Слот передан первому, но тот отменен раньше, чем успел проснуться
+        limiter.release('p')
+        first.cancel()
+        [outcome] = await asyncio.gather(first, return_exceptions=True)
+        if not isinstance(outcome, BaseException):
+            # asyncio.wait_for до Python 3.12 может вернуть результат вместо отмены - слот у first
+            limiter.release('p')
+
+        await asyncio.wait_for(second, 0.5)
+        assert _slots(limiter)["active"] == 1
+        assert _slots(limiter)["waiting"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_slot_context_released_on_cancellation():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1)
+
+        async def hold():
+            async with limiter.slot('p'):
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(hold())
+        await _settle()
+        assert _slots(limiter)["active"] == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert _slots(limiter)["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_wait_timeout_raises_overloaded_and_cleans_queue():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, queue_timeout=0.05)
+        await limiter.acquire('p')
+        with pytest.raises(LimiterOverloaded):
+            await limiter.acquire('p')
+        assert _slots(limiter)["waiting"] == 0
+        assert limiter.rejected == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_evicts_newest_lower_priority_waiter():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=2, queue_timeout=5)
+        await limiter.acquire('p', priority=PRIORITY_PREMIUM)
+        older = asyncio.create_task(limiter.acquire('p', priority=PRIORITY_ANON))
+        await _settle()
+        newer = asyncio.create_task(limiter.acquire('p', priority=PRIORITY_ANON))
+        await _settle()
+
+        premium = asyncio.create_task(limiter.acquire('p', priority=PRIORITY_PREMIUM))
+        await _settle()
+
+        with pytest.raises(LimiterOverloaded):
+            await newer
+        assert not older.done()
+        assert limiter.rejected_by_priority == {PRIORITY_ANON: 1}
+
+        # Освободившийся слот получает premium, затем оставшийся anon
+        limiter.release('p')
+        await asyncio.wait_for(premium, 0.5)
+        assert not older.done()
+        limiter.release('p')
+        await asyncio.wait_for(older, 0.5)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_without_lower_priority_rejects_newcomer():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=1, queue_timeout=5)
+        await limiter.acquire('p')
+        waiting = asyncio.create_task(limiter.acquire('p', priority=PRIORITY_USER))
+        await _settle()
+
+        with pytest.raises(LimiterOverloaded):
+            await limiter.acquire('p', priority=PRIORITY_USER)
+        assert not waiting.done()
+
+        limiter.release('p')
+        await asyncio.wait_for(waiting, 0.5)
+
+    asyncio.run(scenario())
+
+
+def test_release_wakes_waiter_on_another_event_loop():
+    limiter = ConcurrencyLimiter(limit=1, queue_timeout=5)
+    holder_ready = threading.Event()
+    waiter_queued = threading.Event()
+    release_now = threading.Event()
+    result = {}
+
+    async def hold():
+        await limiter.acquire('p')
+        holder_ready.set()
+        await asyncio.get_running_loop().run_in_executor(None, release_now.wait, 5)
+        limiter.release('p')
+
+    async def wait():
+        task = asyncio.create_task(limiter.acquire('p'))
+        await _settle()
+        waiter_queued.set()
+        await asyncio.wait_for(task, 5)
+        result["acquired_in"] = threading.get_ident()
+
+    holder = threading.Thread(target=asyncio.run, args=(hold(),))
+    holder.start()
+    assert holder_ready.wait(5)
+    waiter = threading.Thread(target=asyncio.run, args=(wait(),))
+    waiter.start()
+    assert waiter_queued.wait(5)
+
+    release_now.set()
+    holder.join(5)
+    waiter.join(5)
+
+    assert result["acquired_in"] == waiter.ident
+    assert _slots(limiter)["active"] == 1
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import pytest
+from chat_app import gpt_service, provider_health
+from chat_app.gpt_service import GPTService
+from chat_app.timeline import AttemptTimeline
+
+
+@pytest.fixture
+def service(clock):
+    clock.install(provider_health)
+    service = GPTService()
+    service.response_cache.enabled = False
+    return service
+
+
+@pytest.fixture
+def provider(service):
+    """Настроенный провайдер, который есть в установленной g4f"""
+    for name in service.get_all_providers():
+        if service._get_provider_by_name(name):
+            return name
+    pytest.skip('в установленной g4f нет ни одного настроенного провайдера')
+
+
+def _half_open(service, provider, clock):
+    service.circuit_breaker.record_failure(provider, 'rate_limit')
+    clock.advance(service.circuit_breaker.cooldowns['rate_limit'] + 1)
+
+
+def test_closing_stream_mid_response_releases_half_open_trial(service, provider, clock, monkeypatch):
+    async def endless(request_kwargs):
+        while True:
+            yield 'chunk '
+            await asyncio.sleep(0)
+
+    monkeypatch.setattr(service, '_stream_provider', endless)
+    _half_open(service, provider, clock)
+    timeline = AttemptTimeline()
+
+    async def scenario():
+        events = service._stream_providers('hi', [], [provider], None, [], timeline=timeline)
+        assert (await events.__anext__())["type"] == "chunk"
+        await events.aclose()  # Клиент ушел посреди ответа
+
+    asyncio.run(scenario())
+
+    assert [entry[3] for entry in timeline.entries] == ['cancelled']
+    assert service.provider_limiter.snapshot()["slots"].get(provider, {"active": 0})["active"] == 0
+    # Пробный запрос не завис: следующий запрос снова может стать пробным
+    assert service.circuit_breaker.allow(provider)
+    assert not service.circuit_breaker.allow(provider)
+
+
+@pytest.fixture
+def racing(service, monkeypatch):
+    """Провайдер 'fast' отвечает сразу, 'slow' висит до отмены"""
+    cancelled = []
+
+    async def call_provider(provider_name, *args):
+        if provider_name == 'fast':
+            await asyncio.sleep(0.01)
+            return {"response": "ok", "provider_used": provider_name}, None
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(provider_name)
+            raise
+
+    monkeypatch.setattr(service, '_call_provider', call_provider)
+    service.race_hedge_delay = 0
+    return cancelled
+
+
+def test_race_winner_cancels_other_attempts(service, racing):
+    timeline = AttemptTimeline()
+    result, failures = asyncio.run(service._race_providers(['slow', 'fast'], [], None, timeline=timeline))
+
+    assert result["provider_used"] == 'fast'
+    assert failures == []
+    assert racing == ['slow']
+    assert sorted(entry[3] for entry in timeline.entries) == ['cancelled', 'success']
+
+
+def test_cancelled_race_cancels_all_attempts(service, racing):
+    async def scenario():
+        race = asyncio.create_task(service._race_providers(['slow', 'slow-2'], [], None))
+        await asyncio.sleep(0.01)
+        race.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await race
+
+    asyncio.run(scenario())
+    assert sorted(racing) == ['slow', 'slow-2']
+
+
+def test_aget_builds_service_outside_event_loop(monkeypatch):
+    built_in = []
+    monkeypatch.setattr(gpt_service, '_gpt_service', None)
+    monkeypatch.setattr(gpt_service, 'GPTService', lambda: built_in.append(threading.get_ident()) or 'service')
+
+    async def scenario():
+        return await gpt_service.aget_gpt_service(), threading.get_ident()
+
+    service, loop_thread = asyncio.run(scenario())
+    assert service == 'service'
+    assert built_in and built_in[0] != loop_thread
+    assert asyncio.run(gpt_service.aget_gpt_service()) == 'service'  # Дальше - готовый экземпляр
+    assert len(built_in) == 1
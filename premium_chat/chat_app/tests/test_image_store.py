@@ -0,0 +1,90 @@
+import asyncio
+import io
+import pytest
+from PIL import Image
+from chat_app import image_store
+from chat_app.image_store import ImageStore
+
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 4), 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def store(tmp_path, settings):
+    settings.MEDIA_ROOT = tmp_path
+    return ImageStore()
+
+
+@pytest.fixture
+def public_host(monkeypatch):
+    """Имя images.example считается публичным, но указывает на локальный тестовый сервер"""
+    resolve = image_store._public_addresses
+
+    async def fake_public_addresses(host, port):
+        if host == 'images.example':
+            return ['127.0.0.1']
+        return await resolve(host, port)
+
+    monkeypatch.setattr(image_store, '_public_addresses', fake_public_addresses)
+
+
+async def _serve(responses, seen_hosts):
+    """HTTP-сервер на 127.0.0.1: путь -> (статус, заголовки, тело)"""
+    async def handle(reader, writer):
+        request = (await reader.readuntil(b'\r\n\r\n')).decode()
+        path = request.split(' ')[1]
+        seen_hosts.extend(line.split(':', 1)[1].strip() for line in request.split('\r\n') if line.lower().startswith('host:'))
+        status, headers, body = responses[path]
+        head = f'HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n'
+        head += ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        writer.write(head.encode() + b'\r\n' + body)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/image.png',
+    'http://10.0.0.5/image.png',
+    'http://192.168.1.1/image.png',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://[::1]/image.png',
+    'file:///etc/passwd',
+])
+def test_private_targets_are_rejected(store, url):
+    with pytest.raises(ValueError):
+        asyncio.run(store._fetch(url, None))
+
+
+def test_connection_is_pinned_to_checked_address(store, public_host):
+    seen_hosts = []
+
+    async def scenario():
+        server = await _serve({'/image.png': ('200 OK', {'Content-Type': 'image/png'}, _png())}, seen_hosts)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await store._fetch(f'http://images.example:{port}/image.png', None)
+
+    assert asyncio.run(scenario()) == _png()
+    assert seen_hosts and seen_hosts[0].startswith('images.example')
+
+
+def test_redirect_to_private_address_is_rejected(store, public_host):
+    seen_hosts = []
+
+    async def scenario():
+        responses = {}
+        server = await _serve(responses, seen_hosts)
+        port = server.sockets[0].getsockname()[1]
+        responses['/image.png'] = ('302 Found', {'Location': f'http://127.0.0.1:{port}/secret'}, b'')
+        responses['/secret'] = ('200 OK', {}, b'secret')
+        async with server:
+            with pytest.raises(ValueError):
+                await store._fetch(f'http://images.example:{port}/image.png', None)
+
+    asyncio.run(scenario())
+    assert len(seen_hosts) == 1  # До /secret запрос не дошел
@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from chat_app import rate_limit
+from chat_app.priority import PRIORITY_ANON
+from chat_app.rate_limit import RateLimiter
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def limiter(monkeypatch, clock):
+    clock.install(rate_limit)
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(rate_limit, 'get_async_redis', lambda: fakeredis.FakeAsyncRedis(server=server))
+    limiter = RateLimiter()
+    limiter.enabled = True
+    limiter.limits = {PRIORITY_ANON: {'per_minute': 60, 'burst': 3}}  # 1 токен в секунду
+    limiter.costs = {'chat': 1, 'image': 5}
+    return limiter
+
+
+def _check(limiter, action='chat', ip='1.1.1.1', session_id=None):
+    return asyncio.run(limiter.check(action, PRIORITY_ANON, None, ip, session_id))
+
+
+def test_burst_then_retry_after(limiter):
+    assert [_check(limiter)[0] for _ in range(3)] == [True, True, True]
+
+    allowed, retry_after = _check(limiter)
+    assert not allowed
+    assert retry_after == pytest.approx(1.0)
+
+
+def test_tokens_refill_over_time(limiter, clock):
+    for _ in range(3):
+        _check(limiter)
+    clock.advance(2.5)
+    assert [_check(limiter)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_buckets_are_per_ip(limiter):
+    for _ in range(3):
+        _check(limiter, ip='1.1.1.1')
+    assert not _check(limiter, ip='1.1.1.1')[0]
+    assert _check(limiter, ip='2.2.2.2')[0]
+
+
+def test_rejection_by_one_bucket_charges_none(limiter):
+    # Корзина сессии пуста, корзина IP - нет: запрос отклонен, токены IP не списаны
+    for index in range(3):
+        _check(limiter, ip=f'10.0.0.{index}', session_id='s')
+    assert not _check(limiter, ip='1.1.1.1', session_id='s')[0]
+    assert [_check(limiter, ip='1.1.1.1')[0] for _ in range(3)] == [True, True, True]
+
+
+def test_cost_above_burst_is_capped(limiter):
+    # Стоимость 5 при burst 3 списывается как 3, иначе запрос не прошел бы никогда
+    assert _check(limiter, action='image')[0]
+    allowed, retry_after = _check(limiter, action='image')
+    assert not allowed
+    assert retry_after == pytest.approx(3.0)
+
+
+def test_redis_unavailable_allows_request(limiter, monkeypatch):
+    class BrokenRedis:
+        async def eval(self, *args):
+            raise ConnectionError('redis down')
+
+    monkeypatch.setattr(rate_limit, 'get_async_redis', lambda: BrokenRedis())
+    assert _check(limiter) == (True, 0.0)
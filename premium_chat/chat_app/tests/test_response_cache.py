@@ -0,0 +1,24 @@
+from chat_app.response_cache import ResponseCache
+
+HISTORY = [{"role": "user", "content": "Привет"}]
+
+
+def test_key_ignores_whitespace():
+    cache = ResponseCache()
+    assert cache.make_key(HISTORY, 'gpt-4o') == cache.make_key([{"role": "user", "content": " Привет\n"}], 'gpt-4o')
+
+
+def test_pinned_providers_get_their_own_key():
+    cache = ResponseCache()
+    auto = cache.make_key(HISTORY, 'gpt-4o')
+    pinned = cache.make_key(HISTORY, 'gpt-4o', providers=['Blackbox'])
+    preferred = cache.make_key(HISTORY, 'gpt-4o', preferred_provider='Blackbox')
+
+    assert len({auto, pinned, preferred}) == 3
+    assert pinned != cache.make_key(HISTORY, 'gpt-4o', providers=['DDG'])
+    assert auto == cache.make_key(HISTORY, 'gpt-4o', providers=[], preferred_provider=None)
+
+
+def test_multimodal_history_is_not_cached():
+    cache = ResponseCache()
+    assert cache.make_key([{"role": "user", "content": [{"type": "text", "text": "?"}]}], 'gpt-4o') is None
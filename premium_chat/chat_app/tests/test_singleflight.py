@@ -0,0 +1,90 @@
+import asyncio
+import time
+import pytest
+from chat_app import singleflight
+from chat_app.singleflight import SingleFlight
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(singleflight, 'get_async_redis', lambda: fakeredis.FakeAsyncRedis(server=server))
+    return server
+
+
+def test_follower_gets_leader_result(redis_server):
+    async def scenario():
+        flights = SingleFlight()
+        leader, shared = await flights.join('k')
+        assert leader is not None and shared is None
+
+        follower = asyncio.create_task(flights.join('k'))
+        await asyncio.sleep(0)
+        assert not follower.done()
+
+        await leader.finish({"success": True, "response": "ok"})
+        assert await follower == (None, {"success": True, "response": "ok", "coalesced": True})
+        assert flights.coalesced == 1
+
+        # Ключ освобожден: следующий такой же запрос снова лидер
+        again, _ = await flights.join('k')
+        assert again is not None
+        await again.abort()
+
+    asyncio.run(scenario())
+
+
+def test_follower_runs_itself_when_leader_aborts(redis_server):
+    async def scenario():
+        flights = SingleFlight()
+        leader, _ = await flights.join('k')
+        follower = asyncio.create_task(flights.join('k'))
+        await asyncio.sleep(0)
+
+        await leader.abort()
+        assert await follower == (None, None)
+        assert flights.coalesced == 0
+
+    asyncio.run(scenario())
+
+
+def test_follower_wait_is_bounded_by_request_deadline(redis_server):
+    async def scenario():
+        flights = SingleFlight(wait_timeout=180)
+        leader, _ = await flights.join('k')
+        started = time.monotonic()
+        assert await flights.join('k', timeout=0.1) == (None, None)
+        assert time.monotonic() - started < 1
+        await leader.abort()
+
+    asyncio.run(scenario())
+
+
+def test_remote_wait_is_bounded_by_request_deadline(redis_server):
+    async def scenario():
+        # Блокировку держит лидер в другом процессе и не отвечает
+        await fakeredis.FakeAsyncRedis(server=redis_server).set('gpt_singleflight:lock:k', 'other', ex=180)
+        flights = SingleFlight(wait_timeout=180)
+        started = time.monotonic()
+        assert await flights.join('k', timeout=0.3) == (None, None)
+        assert time.monotonic() - started < 2
+
+    asyncio.run(scenario())
+
+
+def test_remote_leader_result_is_shared(redis_server):
+    async def scenario():
+        other_process = SingleFlight()
+        leader, _ = await other_process.join('k')
+
+        flights = SingleFlight()
+        follower = asyncio.create_task(flights.join('k', timeout=5))
+        await asyncio.sleep(0.1)
+        await leader.finish({"success": True, "response": "ok"})
+
+        _, shared = await asyncio.wait_for(follower, 5)
+        assert shared["response"] == "ok" and shared["coalesced"]
+
+    asyncio.run(scenario())
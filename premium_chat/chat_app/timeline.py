@@ -0,0 +1,26 @@
+import time
+from typing import List
+
+
+class AttemptTimeline:
+    """Хронология попыток одного запроса к провайдерам
+
+    Каждая попытка хранится компактным массивом [провайдер, старт, длительность, исход]:
+    старт - смещение от начала запроса в мс, длительность - в мс, исход - класс
+    ошибки ('success', 'empty', 'rate_limit', 'busy', 'cancelled', ...).
+    Сохраняется в ChatMessage.attempt_timeline.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.entries: List[list] = []
+
+    def record(self, provider_name: str, attempt_started: float, outcome: str):
+        """Добавить попытку (attempt_started - time.monotonic() в момент начала попытки)"""
+        now = time.monotonic()
+        self.entries.append([
+            provider_name,
+            int((attempt_started - self.started) * 1000),
+            int((now - attempt_started) * 1000),
+            outcome or 'error',
+        ])
@@ -0,0 +1,32 @@
+import re
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+_WORD_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка количества токенов в тексте без токенизатора
+
+    BPE-токенизаторы режут латиницу примерно по 4 символа, а кириллицу заметно мельче
+    (около 2 символов на токен), знаки препинания обычно идут отдельными токенами.
+    Для бюджета истории важна стабильная оценка сверху, а не точное значение.
+    """
+    if not text:
+        return 0
+
+    tokens = 0
+    for piece in _WORD_RE.findall(str(text)):
+        if len(piece) == 1:
+            tokens += 1
+        elif piece.isascii():
+            tokens += (len(piece) + 3) // 4
+        else:
+            tokens += (len(piece) + 1) // 2
+    return tokens
+
+
+def message_tokens(text: str) -> int:
+    """Токены одного сообщения в запросе вместе со служебными"""
+    return estimate_tokens(text) + MESSAGE_OVERHEAD
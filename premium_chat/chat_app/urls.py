@@ -17,10 +17,13 @@ urlpatterns = [
     path('api/', include(router.urls)),
     
     # Основные API эндпоинты
-    path('api/chat/', views.chat_message, name='chat_message'),
-    path('api/generate-image/', views.generate_image, name='generate_image'),
+    path('api/chat/', views.ChatMessageView.as_view(), name='chat_message'),
+    path('api/chat/stream/', views.ChatStreamView.as_view(), name='chat_stream'),
+    path('api/generate-image/', views.GenerateImageView.as_view(), name='generate_image'),
+    path('api/generate-image/<str:job_id>/', views.GenerateImageStatusView.as_view(), name='generate_image_status'),
     path('api/providers/', views.provider_info, name='provider_info'),
     path('api/providers/change/', views.change_provider, name='change_provider'),
+    path('metrics', views.metrics_view, name='metrics'),
     
     # Пользовательские функции
     path('api/user/stats/', views.user_statistics, name='user_statistics'),
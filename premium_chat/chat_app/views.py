@@ -2,18 +2,24 @@ from rest_framework import generics, status, viewsets
 from rest_framework.decorators import api_view, action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from django.views.decorators.csrf import csrf_exempt
+from django.middleware.csrf import CsrfViewMiddleware
 from django.utils.decorators import method_decorator
 from django.shortcuts import render, get_object_or_404, redirect
 from django.db.models import Q, Count, Avg
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse, Http404, HttpResponseNotModified
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
+from django.urls import reverse
+from asgiref.sync import sync_to_async
 import uuid
 import json
+import mimetypes
 import asyncio
 import logging
 import requests
@@ -29,8 +35,15 @@ from .serializers import (
     UserStatisticsSerializer, ChatRequestSerializer, ChatResponseSerializer,
     ProviderInfoSerializer
 )
-from .gpt_service import gpt_service
-from django.conf import settings
+from .gpt_service import get_gpt_service
+from .history import load_conversation_history
+from .summarizer import summarizer
+from .generation import run_generation, get_generation_result, job_queue_depths
+from .metrics import metrics
+from .priority import get_user_priority
+from .rate_limit import rate_limiter, get_client_ip
+from .image_jobs import image_job_queue, ImageJobQueue
+from .image_store import image_store
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +57,7 @@ class IndexView(TemplateView):
             session_id = str(uuid.uuid4())
             request.session['session_id'] = session_id
             request.session.save()
-            logger.info(f"Created new session: {session_id}")
+            logger.info("Created new session: %s", session_id)
         
         return super().get(request, *args, **kwargs)
 
@@ -52,169 +65,433 @@ class IndexView(TemplateView):
 def provider_info(request):
     """Получить информацию о провайдерах GPT"""
     try:
-        info = gpt_service.get_provider_info()
+        info = get_gpt_service().get_provider_info()
         serializer = ProviderInfoSerializer(info)
         return Response(serializer.data)
     except Exception as e:
-        logger.error(f"Ошибка при получении информации о провайдерах: {str(e)}")
+        logger.error("Ошибка при получении информации о провайдерах: %s", str(e))
         return Response({
             'error': 'Ошибка при получении информации о провайдерах',
             'details': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['POST'])
-@csrf_exempt
-def chat_message(request):
-    """Отправить сообщение в чат и получить ответ от GPT"""
+def metrics_view(request):
+    """Метрики провайдеров и очередей в текстовом формате Prometheus (все процессы вместе)"""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
     try:
-        serializer = ChatRequestSerializer(data=request.data)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        data = serializer.validated_data
-        message = data['message']
-        session_id = data.get('session_id')
-        model = data.get('model', 'gpt-3.5-turbo')
-        provider = data.get('provider')
-        providers = data.get('providers', [])  # Новый параметр - список провайдеров
-        include_history = data.get('include_history', True)
-        max_history = data.get('max_history', 50)
-        image_data = data.get('image_data')  # Данные изображения в base64
-        
-        # Получаем или создаем сессию
-        if session_id:
-            try:
-                session = ChatSession.objects.get(session_id=session_id)
-            except ChatSession.DoesNotExist:
-                session = ChatSession.objects.create(
-                    session_id=session_id,
-                    user=request.user if request.user.is_authenticated else None
-                )
-        else:
-            session_id = str(uuid.uuid4())
-            session = ChatSession.objects.create(
-                session_id=session_id,
-                user=request.user if request.user.is_authenticated else None,
-                title=message[:50] + "..." if len(message) > 50 else message
-            )
-        
-        # Сохраняем пользовательское сообщение
-        user_message = ChatMessage.objects.create(
+        body = metrics.render(extra=job_queue_depths())
+    except Exception as e:
+        logger.error("[METRICS] Ошибка при сборе метрик: %s", str(e))
+        return HttpResponse(f'# metrics unavailable: {e}\n', status=503, content_type='text/plain')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class JsonRequestError(ValueError):
+    """Тело запроса не подходит API: ответ status с текстом error"""
+    
+    def __init__(self, error: str, status_code: int = status.HTTP_400_BAD_REQUEST):
+        super().__init__(error)
+        self.error = error
+        self.status_code = status_code
+    
+    def response(self) -> JsonResponse:
+        return JsonResponse({'success': False, 'error': self.error}, status=self.status_code)
+
+
+def _parse_request_data(request) -> dict:
+    """Тело запроса - только JSON-объект (как JSONParser в DRF); формы не принимаются"""
+    if request.content_type != 'application/json':
+        raise JsonRequestError('Ожидается Content-Type: application/json', status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        raise JsonRequestError('Некорректный JSON')
+    if not isinstance(payload, dict):
+        raise JsonRequestError('Тело запроса должно быть JSON-объектом')
+    return payload
+
+
+class _CSRFCheck(CsrfViewMiddleware):
+    def _reject(self, request, reason):
+        # Возвращаем причину отказа вместо ответа 403
+        return reason
+
+
+@sync_to_async
+def _authenticate_request(request):
+    """Пользователь запроса так же, как в DRF по умолчанию: сессия или HTTP Basic
+    
+    Для сессии проверяется CSRF (как SessionAuthentication): иначе чужой сайт мог бы
+    отправить запрос формой от имени вошедшего пользователя и тратить его квоту.
+    Анонимные запросы и Basic auth CSRF не проверяются - браузер не подставляет их сам.
+    
+    Returns:
+        (пользователь или None, None) или (None, JsonResponse 401/403)
+    """
+    if request.user.is_authenticated:
+        check = _CSRFCheck(lambda req: None)
+        check.process_request(request)  # Заполняет CSRF cookie из запроса
+        reason = check.process_view(request, None, (), {})
+        if reason:
+            return None, JsonResponse({'success': False, 'error': f'CSRF Failed: {reason}'},
+                                      status=status.HTTP_403_FORBIDDEN)
+        return request.user, None
+    
+    try:
+        result = BasicAuthentication().authenticate(request)
+    except AuthenticationFailed as e:
+        return None, JsonResponse({'success': False, 'error': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED,
+                                  headers={'WWW-Authenticate': 'Basic realm="api"'})
+    return (result[0] if result else None), None
+
+
+class ApiView(View):
+    """Асинхронный JSON view с аутентификацией как у APIView в DRF
+    
+    Как и APIView, view исключен из общей проверки CsrfViewMiddleware: CSRF проверяет
+    _authenticate_request, и только для пользователей, вошедших через сессию.
+    """
+    
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+
+@sync_to_async
+def _update_chat_statistics(user, message, response):
+    """Обновить счетчики профиля и статистику пользователя после ответа"""
+    profile, created = UserProfile.objects.get_or_create(user=user)
+    profile.total_messages += 2  # пользователь + ассистент
+    profile.save()
+    
+    stats, created = UserStatistics.objects.get_or_create(user=user)
+    stats.messages_today += 2
+    stats.total_characters += len(message) + len(response)
+    stats.save()
+
+
+async def _check_rate_limit(request, action, user, priority, session_id=None):
+    """Проверить лимит частоты запросов. Возвращает ответ 429 или None, если запрос можно выполнять"""
+    allowed, retry_after = await rate_limiter.check(action, priority, user, get_client_ip(request.META), session_id)
+    if allowed:
+        return None
+    response = JsonResponse({
+        'success': False,
+        'error': 'Слишком много запросов. Попробуйте позже.',
+        'retry_after': round(retry_after, 1),
+    }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = rate_limiter.retry_after_header(retry_after)
+    return response
+
+
+async def _prepare_chat_request(request):
+    """Разобрать запрос к чату: проверить данные, найти сессию, сохранить сообщение, загрузить историю
+    
+    Returns:
+        (контекст запроса, None) или (None, JsonResponse с ошибкой валидации или лимита запросов)
+    """
+    try:
+        payload = _parse_request_data(request)
+    except JsonRequestError as e:
+        return None, e.response()
+    
+    user, auth_error = await _authenticate_request(request)
+    if auth_error:
+        return None, auth_error
+    
+    serializer = ChatRequestSerializer(data=payload)
+    if not serializer.is_valid():
+        return None, JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    data = serializer.validated_data
+    message = data['message']
+    session_id = data.get('session_id')
+    model = data.get('model', 'gpt-3.5-turbo')
+    provider = data.get('provider')
+    providers = data.get('providers', [])  # Новый параметр - список провайдеров
+    include_history = data.get('include_history', True)
+    max_history = data.get('max_history', 50)
+    image_data = data.get('image_data')  # Данные изображения в base64
+    
+    priority = await sync_to_async(get_user_priority)(user)
+    
+    # Лимит проверяем до записи в БД и обращения к провайдерам
+    rate_limited = await _check_rate_limit(request, 'chat', user, priority, session_id)
+    if rate_limited:
+        return None, rate_limited
+    
+    # Получаем или создаем сессию
+    if session_id:
+        session = await ChatSession.objects.filter(session_id=session_id).afirst()
+        if session is None:
+            session = await ChatSession.objects.acreate(session_id=session_id, user=user)
+    else:
+        session_id = str(uuid.uuid4())
+        session = await ChatSession.objects.acreate(
+            session_id=session_id,
+            user=user,
+            title=message[:50] + "..." if len(message) > 50 else message
+        )
+    
+    # Сохраняем пользовательское сообщение
+    user_message = await ChatMessage.objects.acreate(
+        session=session,
+        message_type='user',
+        content=message
+    )
+    
+    # Получаем историю разговора если нужно
+    conversation_history = []
+    if include_history:
+        # Последние max_history пар без текущего сообщения (оно передается отдельно)
+        conversation_history = await sync_to_async(load_conversation_history)(session, max_history, exclude_id=user_message.id)
+    
+    # Получаем ответ от GPT
+    if providers:
+        logger.info("[CHAT] Отправляем сообщение в GPT: %.100s... | Модель: %s | Провайдеры: %s | Текущий: %s | Изображение: %s",
+                    message, model, providers, provider, 'Да' if image_data else 'Нет')
+    elif provider and provider != 'null':
+        logger.info("[CHAT] Отправляем сообщение в GPT: %.100s... | Модель: %s | Провайдер: %s | Изображение: %s",
+                    message, model, provider, 'Да' if image_data else 'Нет')
+    else:
+        logger.info("[CHAT] Отправляем сообщение в GPT: %.100s... | Режим: Авто (циклический выбор) | Изображение: %s",
+                    message, 'Да' if image_data else 'Нет')
+    
+    # Передаем модель, список провайдеров и изображение
+    # Если есть изображение - принудительно используем vision модель и ПРОВЕРЕННЫЕ провайдеры
+    if image_data:
+        model_to_use = 'gpt-4-vision-preview'
+        # ПРОВЕРЕННЫЕ провайдеры с поддержкой изображений (результат тестирования)
+        vision_providers = [
+            'Free2GPT',           # 1.2с - самый быстрый!
+            'Qwen_Qwen_2_5',      # 2.9с - надежный
+            'Qwen_Qwen_2_72B',    # 5.2с - мощный  
+            'Qwen_Qwen_2_5_Max'   # 5.5с - максимальный
+        ]
+        providers_to_use = vision_providers
+        logger.info("🖼️ ИЗОБРАЖЕНИЕ ОБНАРУЖЕНО! Используем ПРОВЕРЕННЫЕ vision провайдеры: %s | Провайдеры: %s", model_to_use, providers_to_use)
+    else:
+        model_to_use = model if model and model != 'null' else None
+        providers_to_use = providers if providers else None
+    
+    return {
+        'user': user,
+        'session': session,
+        'message': message,
+        'model': model,
+        'conversation_history': conversation_history,
+        # Аргументы для gpt_service.get_response_async / stream_response
+        'gpt_kwargs': {
+            'message': message,
+            'conversation_history': conversation_history,
+            'model': model_to_use,
+            'providers': providers_to_use,
+            'image_data': image_data,
+            'use_cache': data.get('use_cache', True),  # False - всегда запрашивать новый ответ
+            'summary': session.summary if include_history else None,
+            'timeout': data.get('timeout'),  # Общий срок на все попытки (None - GPT_REQUEST_TIMEOUT)
+            'priority': priority,  # Очередь и доля слотов у провайдеров
+            # Перебор начинается с выбранного в запросе провайдера, иначе - с последнего удачного в сессии
+            'session_id': session.session_id,
+            'user_id': user.pk if user is not None else None,
+            'preferred_provider': provider if provider and provider != 'null' else None,
+        },
+    }, None
+
+
+async def _complete_chat_request(context, gpt_response):
+    """Сохранить результат GPT и сформировать ответ API
+    
+    Returns:
+        (данные ответа, HTTP статус, дополнительные заголовки)
+    """
+    session = context['session']
+    message = context['message']
+    model = context['model']
+    
+    if gpt_response.get('success'):
+        # Сохраняем ответ ассистента
+        assistant_message = await ChatMessage.objects.acreate(
             session=session,
-            message_type='user',
-            content=message
+            message_type='assistant',
+            content=gpt_response['response'],
+            raw_content=gpt_response.get('raw_response', ''),
+            provider_used=gpt_response.get('provider_used', ''),
+            model_used=gpt_response.get('model_used', model),
+            response_time=gpt_response.get('response_time'),
+            attempt_number=gpt_response.get('attempt_number'),
+            attempt_timeline=gpt_response.get('attempt_timeline', [])
         )
         
-        # Получаем историю разговора если нужно
-        conversation_history = []
-        if include_history:
-            history_messages = session.messages.order_by('created_at')[:max_history * 2]
-            for msg in history_messages:
-                if msg.message_type == 'user':
-                    conversation_history.append({
-                        'message': msg.content,
-                        'response': None
-                    })
-                elif msg.message_type == 'assistant' and conversation_history:
-                    conversation_history[-1]['response'] = msg.content
-        
-        # Меняем провайдера если указан
-        if provider and provider != 'null':
-            gpt_service.change_provider(provider)
-        
-        # Получаем ответ от GPT
-        if providers:
-            logger.info(f"Отправляем сообщение в GPT: {message[:100]}... | Модель: {model} | Провайдеры: {providers} | Текущий: {provider} | Изображение: {'Да' if image_data else 'Нет'}")
-        elif provider and provider != 'null':
-            logger.info(f"Отправляем сообщение в GPT: {message[:100]}... | Модель: {model} | Провайдер: {provider} | Изображение: {'Да' if image_data else 'Нет'}")
-        else:
-            logger.info(f"Отправляем сообщение в GPT: {message[:100]}... | Режим: Авто (циклический выбор) | Изображение: {'Да' if image_data else 'Нет'}")
-        
-        # Передаем модель, список провайдеров и изображение
-        # Если есть изображение - принудительно используем vision модель и ПРОВЕРЕННЫЕ провайдеры
-        if image_data:
-            model_to_use = 'gpt-4-vision-preview'
-            # ПРОВЕРЕННЫЕ провайдеры с поддержкой изображений (результат тестирования)
-            vision_providers = [
-                'Free2GPT',           # 1.2с - самый быстрый!
-                'Qwen_Qwen_2_5',      # 2.9с - надежный
-                'Qwen_Qwen_2_72B',    # 5.2с - мощный  
-                'Qwen_Qwen_2_5_Max'   # 5.5с - максимальный
-            ]
-            providers_to_use = vision_providers
-            logger.info(f"🖼️ ИЗОБРАЖЕНИЕ ОБНАРУЖЕНО! Используем ПРОВЕРЕННЫЕ vision провайдеры: {model_to_use} | Провайдеры: {providers_to_use}")
-        else:
-            model_to_use = model if model and model != 'null' else None
-            providers_to_use = providers if providers else None
-        
-        gpt_response = gpt_service.get_response_sync(message, conversation_history, model_to_use, providers_to_use, image_data)
-        
-        if gpt_response.get('success'):
-            # Сохраняем ответ ассистента
-            assistant_message = ChatMessage.objects.create(
-                session=session,
-                message_type='assistant',
-                content=gpt_response['response'],
-                raw_content=gpt_response.get('raw_response', ''),
-                provider_used=gpt_response.get('provider_used', ''),
-                model_used=gpt_response.get('model_used', model),
-                response_time=gpt_response.get('response_time'),
-                attempt_number=gpt_response.get('attempt_number')
-            )
+        # Сворачиваем старую часть разговора в фоне, ответ пользователю не ждет
+        summarizer.schedule(session)
+        
+        # Обновляем статистику пользователя
+        if context['user'] is not None:
+            await _update_chat_statistics(context['user'], message, gpt_response['response'])
+        
+        # Формируем ответ
+        response_data = ChatResponseSerializer({
+            'success': True,
+            'response': gpt_response['response'],
+            'raw_response': gpt_response.get('raw_response', ''),
+            'model_used': gpt_response.get('model_used', model),
+            'provider_used': gpt_response.get('provider_used', ''),
+            'attempt_number': gpt_response.get('attempt_number', 1),
+            'response_time': gpt_response.get('response_time', 0),
+            'message_length': len(message),
+            'history_length': len(context['conversation_history']),
+            'session_id': session.session_id,
+            'message_id': assistant_message.id
+        }).data
+        
+        logger.info("[CHAT] Успешный ответ от %s", gpt_response.get('provider_used', 'unknown'))
+        return response_data, status.HTTP_200_OK, None
+    
+    if gpt_response.get('timed_out'):
+        logger.warning("Запрос не уложился в срок: попыток %s", gpt_response.get('total_attempts', 0))
+        return {
+            'success': False,
+            'error': gpt_response['error'],
+            'response': gpt_response['response'],
+            'session_id': session.session_id,
+            'total_attempts': gpt_response.get('total_attempts', 0)
+        }, status.HTTP_504_GATEWAY_TIMEOUT, None
+    
+    if gpt_response.get('overloaded'):
+        # Очередь переполнена - просим клиента повторить позже, в историю не пишем
+        logger.warning("Запрос отклонен: сервис перегружен")
+        return {
+            'success': False,
+            'error': gpt_response['error'],
+            'response': gpt_response['response'],
+            'session_id': session.session_id,
+        }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '5'}
+    
+    # Сохраняем ошибку
+    await ChatMessage.objects.acreate(
+        session=session,
+        message_type='system',
+        content=f"Ошибка: {gpt_response.get('error', 'Неизвестная ошибка')}",
+        raw_content=str(gpt_response),
+        attempt_timeline=gpt_response.get('attempt_timeline', [])
+    )
+    
+    logger.error("Ошибка GPT: %s", gpt_response.get('error'))
+    return {
+        'success': False,
+        'error': gpt_response.get('error', 'Ошибка при получении ответа'),
+        'response': gpt_response.get('response', 'Извините, произошла ошибка. Попробуйте еще раз.'),
+        'session_id': session.session_id,
+        'total_attempts': gpt_response.get('total_attempts', 0)
+    }, status.HTTP_500_INTERNAL_SERVER_ERROR, None
+
+
+def _sse(event: str, data) -> str:
+    """Одно событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class ChatMessageView(ApiView):
+    """Отправить сообщение в чат и получить ответ от GPT
+    
+    Асинхронный view: ожидание провайдеров идет прямо в event loop ASGI-сервера,
+    поэтому воркер не блокируется на время перебора провайдеров.
+    """
+    
+    async def post(self, request):
+        try:
+            context, error_response = await _prepare_chat_request(request)
+            if error_response:
+                return error_response
             
-            # Обновляем статистику пользователя
-            if request.user.is_authenticated:
-                profile, created = UserProfile.objects.get_or_create(user=request.user)
-                profile.total_messages += 2  # пользователь + ассистент
-                profile.save()
+            gpt_response = await get_generation_result(context['gpt_kwargs'])
+            response_data, status_code, headers = await _complete_chat_request(context, gpt_response)
+            return JsonResponse(response_data, status=status_code, headers=headers)
                 
-                stats, created = UserStatistics.objects.get_or_create(user=request.user)
-                stats.messages_today += 2
-                stats.total_characters += len(message) + len(gpt_response['response'])
-                stats.save()
-            
-            # Формируем ответ
-            response_data = ChatResponseSerializer({
-                'success': True,
-                'response': gpt_response['response'],
-                'raw_response': gpt_response.get('raw_response', ''),
-                'model_used': gpt_response.get('model_used', model),
-                'provider_used': gpt_response.get('provider_used', ''),
-                'attempt_number': gpt_response.get('attempt_number', 1),
-                'response_time': gpt_response.get('response_time', 0),
-                'message_length': len(message),
-                'history_length': len(conversation_history),
-                'session_id': session.session_id,
-                'message_id': assistant_message.id
-            }).data
-            
-            logger.info(f"Успешный ответ от {gpt_response.get('provider_used', 'unknown')}")
-            return Response(response_data)
-        else:
-            # Сохраняем ошибку
-            error_message = ChatMessage.objects.create(
-                session=session,
-                message_type='system',
-                content=f"Ошибка: {gpt_response.get('error', 'Неизвестная ошибка')}",
-                raw_content=str(gpt_response)
-            )
-            
-            logger.error(f"Ошибка GPT: {gpt_response.get('error')}")
-            return Response({
+        except Exception as e:
+            logger.error("Критическая ошибка в chat_message: %s", str(e))
+            return JsonResponse({
                 'success': False,
-                'error': gpt_response.get('error', 'Ошибка при получении ответа'),
-                'response': gpt_response.get('response', 'Извините, произошла ошибка. Попробуйте еще раз.'),
-                'session_id': session.session_id,
-                'total_attempts': gpt_response.get('total_attempts', 0)
+                'error': 'Критическая ошибка сервера',
+                'details': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-    except Exception as e:
-        logger.error(f"Критическая ошибка в chat_message: {str(e)}")
-        return Response({
-            'success': False,
-            'error': 'Критическая ошибка сервера',
-            'details': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ChatStreamView(ApiView):
+    """Потоковый вариант /api/chat/ через Server-Sent Events
+    
+    Принимает те же параметры, что и /api/chat/. События:
+        meta  - {"session_id"} сразу после приема запроса
+        chunk - {"content"} очередной фрагмент ответа
+        reset - провайдер оборвал ответ, показанный текст нужно сбросить
+        done  - итог в формате /api/chat/ (session_id, message_id, provider_used, response_time...)
+    Пока ответа нет, раз в SSE_HEARTBEAT_INTERVAL секунд отправляется комментарий-пинг,
+    чтобы прокси не закрывали простаивающее соединение.
+    """
+    
+    async def post(self, request):
+        try:
+            context, error_response = await _prepare_chat_request(request)
+        except Exception as e:
+            logger.error("Критическая ошибка в chat_stream: %s", str(e))
+            return JsonResponse({
+                'success': False,
+                'error': 'Критическая ошибка сервера',
+                'details': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        if error_response:
+            return error_response
+        
+        response = StreamingHttpResponse(self.events(context), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # Отключаем буферизацию в nginx
+        return response
+    
+    async def events(self, context):
+        heartbeat = getattr(settings, 'SSE_HEARTBEAT_INTERVAL', 15)
+        yield _sse('meta', {'session_id': context['session'].session_id})
+        
+        stream = run_generation(context['gpt_kwargs'])
+        next_event = asyncio.ensure_future(stream.__anext__())
+        try:
+            while True:
+                done, _ = await asyncio.wait({next_event}, timeout=heartbeat)
+                if not done:
+                    yield ': ping\n\n'
+                    continue
+                
+                try:
+                    event = next_event.result()
+                except StopAsyncIteration:
+                    break
+                
+                if event['type'] == 'chunk':
+                    yield _sse('chunk', {'content': event['content']})
+                elif event['type'] == 'reset':
+                    yield _sse('reset', {})
+                elif event['type'] == 'done':
+                    response_data, status_code, _ = await _complete_chat_request(context, event['result'])
+                    yield _sse('done', dict(response_data, status=status_code))
+                    break
+                
+                next_event = asyncio.ensure_future(stream.__anext__())
+        except Exception as e:
+            logger.error("Критическая ошибка в chat_stream: %s", str(e))
+            yield _sse('done', {
+                'success': False,
+                'error': 'Критическая ошибка сервера',
+                'details': str(e),
+                'status': status.HTTP_500_INTERNAL_SERVER_ERROR,
+            })
+        finally:
+            # Клиент отключился или поток закончился - останавливаем запрос к провайдеру
+            if not next_event.done():
+                next_event.cancel()
+                await asyncio.gather(next_event, return_exceptions=True)
+            await stream.aclose()
+
 
 class ChatSessionViewSet(viewsets.ModelViewSet):
     """ViewSet для управления сессиями чата"""
@@ -314,7 +591,7 @@ def user_statistics(request):
         
         return Response(data)
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {str(e)}")
+        logger.error("Ошибка при получении статистики: %s", str(e))
         return Response({'error': 'Ошибка при получении статистики'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
@@ -379,7 +656,7 @@ def export_chat(request):
             return Response({'error': 'Неподдерживаемый формат'}, status=status.HTTP_400_BAD_REQUEST)
             
     except Exception as e:
-        logger.error(f"Ошибка при экспорте чата: {str(e)}")
+        logger.error("Ошибка при экспорте чата: %s", str(e))
         return Response({'error': 'Ошибка при экспорте'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
@@ -398,7 +675,7 @@ def clear_all_chats(request):
         
         return Response({'success': True, 'message': 'Все чаты удалены'})
     except Exception as e:
-        logger.error(f"Ошибка при очистке чатов: {str(e)}")
+        logger.error("Ошибка при очистке чатов: %s", str(e))
         return Response({'error': 'Ошибка при очистке чатов'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
@@ -409,82 +686,119 @@ def change_provider(request):
         if not provider_name:
             return Response({'error': 'Не указан провайдер'}, status=status.HTTP_400_BAD_REQUEST)
         
-        success = gpt_service.change_provider(provider_name)
+        # Провайдер назначается только сессии и пользователю из запроса, глобальный выбор не меняется
+        session_id = request.data.get('session_id') or request.session.get('session_id')
+        user_id = request.user.pk if request.user.is_authenticated else None
+        success = get_gpt_service().change_provider(provider_name, session_id, user_id)
         if success:
             return Response({
                 'success': True,
-                'current_provider': gpt_service.get_current_provider(),
+                'current_provider': provider_name,
                 'message': f'Провайдер изменен на {provider_name}'
             })
         else:
             return Response({'error': 'Провайдер не найден'}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
-        logger.error(f"Ошибка при смене провайдера: {str(e)}")
+        logger.error("Ошибка при смене провайдера: %s", str(e))
         return Response({'error': 'Ошибка при смене провайдера'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['POST'])
-@csrf_exempt
-def generate_image(request):
-    """Генерировать изображение из текстового описания"""
-    try:
-        prompt = request.data.get('prompt')
-        provider = request.data.get('provider')  # Опциональный параметр
-        
-        if not prompt:
-            return Response({
-                'success': False,
-                'error': 'Не указано описание изображения'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Ограничиваем длину промпта
-        if len(prompt) > 500:
-            return Response({
-                'success': False,
-                'error': 'Описание изображения слишком длинное (максимум 500 символов)'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        logger.info(f"[IMAGE_API] Запрос на генерацию изображения: '{prompt[:50]}...'")
-        
-        # Запускаем генерацию асинхронно
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+class GenerateImageView(ApiView):
+    """Поставить генерацию изображения в очередь (асинхронный view)
+    
+    Ответ приходит сразу (202) с id задания: результат - опросом GenerateImageStatusView
+    или событием image_job в WebSocket сессии чата, если передан session_id.
+    """
+    
+    async def post(self, request):
         try:
-            result = loop.run_until_complete(gpt_service.generate_image(prompt, provider))
-        finally:
-            loop.close()
-        
-        if result['success']:
-            logger.info(f"[IMAGE_API] SUCCESS! Изображение сгенерировано провайдером {result['provider']}")
+            try:
+                payload = _parse_request_data(request)
+            except JsonRequestError as e:
+                return e.response()
             
-            # Сохраняем в базу данных (опционально)
-            # Здесь можно добавить сохранение в ChatMessage или отдельную модель
+            user, auth_error = await _authenticate_request(request)
+            if auth_error:
+                return auth_error
             
-            return Response({
+            prompt = payload.get('prompt')
+            provider = payload.get('provider')  # Опциональный параметр
+            session_id = payload.get('session_id')  # Куда отправить результат по WebSocket
+            
+            if not prompt:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Не указано описание изображения'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            # Ограничиваем длину промпта
+            if len(prompt) > 500:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Описание изображения слишком длинное (максимум 500 символов)'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            priority = await sync_to_async(get_user_priority)(user)
+            rate_limited = await _check_rate_limit(request, 'image', user, priority)
+            if rate_limited:
+                return rate_limited
+            
+            logger.info("[IMAGE_API] Запрос на генерацию изображения: '%s...'", prompt[:50])
+            
+            job = await image_job_queue.submit(prompt, provider, user.pk if user is not None else None, session_id)
+            
+            return JsonResponse({
                 'success': True,
-                'image_url': result.get('image_url'),
-                'image_data': result.get('image_data'),
-                'provider_used': result['provider'],
-                'response_time': result['response_time'],
-                'prompt': result['prompt']
-            })
-        else:
-            logger.warning(f"[IMAGE_API] ERROR! Не удалось сгенерировать изображение: {result.get('error', 'Неизвестная ошибка')}")
+                'job_id': job['id'],
+                'status': job['status'],
+                'status_url': reverse('generate_image_status', args=[job['id']]),
+                'max_wait': image_job_queue.max_wait,  # Дольше клиенту опрашивать задание нет смысла (сек)
+            }, status=status.HTTP_202_ACCEPTED)
             
-            return Response({
+        except Exception as e:
+            logger.error("[IMAGE_API] Критическая ошибка при постановке генерации изображения: %s", str(e))
+            return JsonResponse({
                 'success': False,
-                'error': result.get('error', 'Не удалось сгенерировать изображение'),
-                'message': result.get('message', 'Попробуйте другое описание или повторите позже'),
-                'quota_errors': result.get('quota_errors', []),
-                'providers_tried': result.get('providers_tried', [])
+                'error': 'Критическая ошибка сервера',
+                'message': 'Произошла ошибка при генерации изображения. Попробуйте позже.'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
-    except Exception as e:
-        logger.error(f"[IMAGE_API] Критическая ошибка при генерации изображения: {str(e)}")
-        return Response({
-            'success': False,
-            'error': 'Критическая ошибка сервера',
-            'message': 'Произошла ошибка при генерации изображения. Попробуйте позже.'
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class GenerateImageStatusView(ApiView):
+    """Состояние задания генерации изображения (queued, running, scheduled, done, failed)"""
+    
+    async def get(self, request, job_id):
+        try:
+            user, auth_error = await _authenticate_request(request)
+            if auth_error:
+                return auth_error
+            job = await image_job_queue.get(job_id)
+            # Задание пользователя видит только он сам
+            if job is None or (job.get('user_id') is not None and (user is None or user.pk != job['user_id'])):
+                return JsonResponse({'success': False, 'error': 'Задание не найдено'}, status=status.HTTP_404_NOT_FOUND)
+            
+            return JsonResponse({'success': job['status'] != 'failed', 'job': ImageJobQueue.public(job)})
+        except Exception as e:
+            logger.error("[IMAGE_API] Ошибка при получении задания %s: %s", job_id, str(e))
+            return JsonResponse({
+                'success': False,
+                'error': 'Ошибка при получении состояния генерации'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def stored_image(request, name):
+    """Изображение из ImageStore: имя - хэш содержимого, поэтому ответ кэшируется навсегда"""
+    path = image_store.path(name)
+    if not path.is_file():
+        raise Http404('Изображение не найдено')
+    
+    etag = f'"{path.stem}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(path.open('rb'), content_type=mimetypes.guess_type(path.name)[0])
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 # Google OAuth Views
@@ -511,7 +825,7 @@ def google_auth_init(request):
         })
         
     except Exception as e:
-        logger.error(f"Google Auth Init Error: {str(e)}")
+        logger.error("Google Auth Init Error: %s", str(e))
         return Response({
             'success': False,
             'error': 'Ошибка инициализации Google OAuth'
@@ -543,7 +857,7 @@ def google_auth_callback(request):
         token_json = token_response.json()
         
         if 'access_token' not in token_json:
-            logger.error(f"Google Token Error: {token_json}")
+            logger.error("Google Token Error: %s", token_json)
             return JsonResponse({
                 'success': False,
                 'error': 'Не удалось получить токен доступа'
@@ -601,7 +915,7 @@ def google_auth_callback(request):
         return redirect('/?google_auth=success')
         
     except Exception as e:
-        logger.error(f"Google Auth Callback Error: {str(e)}")
+        logger.error("Google Auth Callback Error: %s", str(e))
         return redirect('/?google_auth=error')
 
 
@@ -619,7 +933,7 @@ def google_logout(request):
         })
         
     except Exception as e:
-        logger.error(f"Google Logout Error: {str(e)}")
+        logger.error("Google Logout Error: %s", str(e))
         return Response({
             'success': False,
             'error': 'Ошибка при выходе из аккаунта'
@@ -659,7 +973,7 @@ def user_auth_status(request):
             })
             
     except Exception as e:
-        logger.error(f"User Auth Status Error: {str(e)}")
+        logger.error("User Auth Status Error: %s", str(e))
         return Response({
             'authenticated': False,
             'error': str(e)
@@ -686,7 +1000,7 @@ def delete_all_chats(request):
             chat.messages.all().delete()  # Удаляем все сообщения
         user_chats.delete()  # Удаляем все чаты
         
-        logger.info(f"Deleted {chats_count} chats for session {session_id}")
+        logger.info("Deleted %s chats for session %s", chats_count, session_id)
         
         return Response({
             'success': True,
@@ -695,7 +1009,7 @@ def delete_all_chats(request):
         })
         
     except Exception as e:
-        logger.error(f"Delete all chats error: {str(e)}")
+        logger.error("Delete all chats error: %s", str(e))
         return Response({
             'success': False,
             'error': str(e)
@@ -740,7 +1054,7 @@ def delete_account(request):
         # Очищаем сессию
         request.session.flush()
         
-        logger.info(f"Deleted account for session {session_id}, email: {user_email}")
+        logger.info("Deleted account for session %s, email: %s", session_id, user_email)
         
         return Response({
             'success': True,
@@ -750,7 +1064,7 @@ def delete_account(request):
         })
         
     except Exception as e:
-        logger.error(f"Delete account error: {str(e)}")
+        logger.error("Delete account error: %s", str(e))
         return Response({
             'success': False,
             'error': str(e)
@@ -777,7 +1091,7 @@ def test_notion_connection(request):
         return Response(result)
         
     except Exception as e:
-        logger.error(f"Notion connection test error: {str(e)}")
+        logger.error("Notion connection test error: %s", str(e))
         return Response({
             'success': False,
             'error': f'Ошибка тестирования: {str(e)}'
@@ -841,7 +1155,7 @@ def save_notion_settings(request):
         })
         
     except Exception as e:
-        logger.error(f"Save Notion settings error: {str(e)}")
+        logger.error("Save Notion settings error: %s", str(e))
         return Response({
             'success': False,
             'error': f'Ошибка сохранения: {str(e)}'
@@ -878,7 +1192,7 @@ def get_notion_settings(request):
             })
         
     except Exception as e:
-        logger.error(f"Get Notion settings error: {str(e)}")
+        logger.error("Get Notion settings error: %s", str(e))
         return Response({
             'is_enabled': False,
             'has_api_key': False,
@@ -948,7 +1262,7 @@ def save_to_notion(request):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
     except Exception as e:
-        logger.error(f"Save to Notion error: {str(e)}")
+        logger.error("Save to Notion error: %s", str(e))
         return Response({
             'success': False,
             'error': f'Ошибка сохранения: {str(e)}'
@@ -973,7 +1287,7 @@ def get_notion_pages(request):
         return Response(result)
         
     except Exception as e:
-        logger.error(f"Get Notion pages error: {str(e)}")
+        logger.error("Get Notion pages error: %s", str(e))
         return Response({
             'success': False,
             'error': f'Ошибка получения страниц: {str(e)}'
@@ -1023,7 +1337,7 @@ def select_notion_page(request):
             }, status=status.HTTP_404_NOT_FOUND)
         
     except Exception as e:
-        logger.error(f"Select Notion page error: {str(e)}")
+        logger.error("Select Notion page error: %s", str(e))
         return Response({
             'success': False,
             'error': f'Ошибка выбора страницы: {str(e)}'
@@ -1128,7 +1442,7 @@ def save_message_to_notion_view(request):
                 })
                 
         except Exception as e:
-            logger.error(f"Error saving message to Notion: {str(e)}")
+            logger.error("Error saving message to Notion: %s", str(e))
             return JsonResponse({
                 'success': False,
                 'error': f'Ошибка сохранения: {str(e)}'
@@ -1140,7 +1454,7 @@ def save_message_to_notion_view(request):
             'error': 'Некорректный JSON'
         })
     except Exception as e:
-        logger.error(f"Save message to Notion error: {str(e)}")
+        logger.error("Save message to Notion error: %s", str(e))
         return JsonResponse({
             'success': False,
             'error': f'Ошибка сервера: {str(e)}'
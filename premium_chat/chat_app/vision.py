@@ -0,0 +1,90 @@
+import base64
+import binascii
+import hashlib
+import io
+import logging
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+
+class VisionPreprocessor:
+    """Подготовка изображений для vision запросов
+
+    Фото с телефона весят несколько мегабайт и в base64 уходили бы в каждую попытку.
+    Изображение один раз декодируется, поворачивается по EXIF, уменьшается до max_side
+    по большей стороне и пережимается в JPEG без метаданных. Результат кэшируется
+    в Redis по sha256 исходных байтов: повторная загрузка той же картинки не обрабатывается заново.
+    """
+
+    KEY_PREFIX = 'vision_image'
+
+    def __init__(self, enabled: bool = True, max_side: int = 1536, quality: int = 85, cache_ttl: int = 3600):
+        self.enabled = enabled
+        self.max_side = max_side
+        self.quality = quality
+        self.cache_ttl = cache_ttl
+
+    def prepare(self, image_data: str) -> str:
+        """Вернуть data URL уменьшенного JPEG (при ошибке - исходные данные без изменений)"""
+        if not self.enabled or not image_data:
+            return image_data
+
+        # data:image/png;base64,... или просто base64
+        encoded = image_data.split(',', 1)[1] if image_data.startswith('data:') else image_data
+        try:
+            raw = base64.b64decode(encoded, validate=False)
+        except (binascii.Error, ValueError) as e:
+            logger.warning("[VISION] Не удалось декодировать изображение, отправляем как есть: %s", e)
+            return image_data
+
+        key = f'{self.KEY_PREFIX}:{hashlib.sha256(raw).hexdigest()}'
+        try:
+            cached = cache.get(key)
+        except Exception as e:
+            logger.warning("[VISION] Ошибка чтения кэша изображений: %s", e)
+            cached = None
+        if cached:
+            logger.info("[VISION] Изображение уже обработано ранее (%s байт -> %s символов)", len(raw), len(cached))
+            return cached
+
+        try:
+            processed = self._process(raw)
+        except Exception as e:
+            logger.warning("[VISION] Не удалось обработать изображение, отправляем как есть: %s", e)
+            return image_data
+
+        result = f"data:image/jpeg;base64,{base64.b64encode(processed).decode('ascii')}"
+        try:
+            cache.set(key, result, timeout=self.cache_ttl)
+        except Exception as e:
+            logger.warning("[VISION] Ошибка записи в кэш изображений: %s", e)
+        logger.info("[VISION] Изображение подготовлено: %s -> %s байт", len(raw), len(processed))
+        return result
+
+    async def aprepare(self, image_data: str) -> str:
+        # Декодирование и пережатие - работа для CPU, event loop не блокируем
+        return await sync_to_async(self.prepare, thread_sensitive=False)(image_data)
+
+    def _process(self, raw: bytes) -> bytes:
+        """Повернуть по EXIF, уменьшить и сохранить JPEG без метаданных"""
+        with Image.open(io.BytesIO(raw)) as image:
+            # Большие JPEG декодируем сразу в уменьшенном масштабе (DCT scaling)
+            image.draft('RGB', (self.max_side, self.max_side))
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # Прозрачность JPEG не поддерживает - кладем на белый фон
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+
+            buffer = io.BytesIO()
+            # EXIF, ICC и прочие метаданные не передаются: save без exif/icc_profile
+            image.save(buffer, 'JPEG', quality=self.quality, optimize=True)
+            return buffer.getvalue()
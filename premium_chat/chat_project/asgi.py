@@ -10,7 +10,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
 # is populated before importing code that may import ORM models.
 django_asgi_app = get_asgi_application()
 
+from django.conf import settings
 from chat_app.routing import websocket_urlpatterns
+from chat_app.gpt_service import warm_gpt_service
+
+# Веб-процесс: создаем GPTService в фоне сразу, чтобы первый запрос не ждал импорта g4f
+if getattr(settings, 'GPT_WARMUP_ON_START', True):
+    warm_gpt_service()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -9,6 +9,7 @@ DEBUG = config('DEBUG', default=True, cast=bool)
 ALLOWED_HOSTS = ['*']  # Временно разрешаем все хосты для мобильного доступа
 
 INSTALLED_APPS = [
+    'daphne',  # runserver обслуживает ASGI (потоковые ответы, async views, WebSocket); должен стоять первым
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -147,11 +148,39 @@ REST_FRAMEWORK = {
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_CREDENTIALS = True
+# Другие источники (фронтенд на отдельном домене), которым можно отправлять запросы с CSRF-токеном
+CSRF_TRUSTED_ORIGINS = config('CSRF_TRUSTED_ORIGINS', default='', cast=Csv())
 
 # Logging
+# Доля записываемых INFO-сообщений по категориям ([ATTEMPT], [DIRECT], ...) - частые строки
+# горячего пути пишутся выборочно. WARNING и выше пишутся всегда
+LOG_SAMPLE_RATES = {
+    'START': 0.1,
+    'HISTORY': 0.1,
+    'MODEL': 0.1,
+    'IMAGE': 0.1,
+    'PROVIDERS': 0.1,
+    'SAFETY': 0.01,
+    'FINAL': 0.1,
+    'DIRECT': 0.01,
+    'PROXY': 0.01,
+    'ATTEMPT': 0.2,
+    'RACE': 0.2,
+    'SUCCESS': 0.2,
+    'STREAM': 0.1,
+    'SIGNAL': 0.01,
+    'CHAT': 0.1,
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'chat_app.logging_utils.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
     'formatters': {
         'verbose': {
             'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
@@ -162,17 +191,22 @@ LOGGING = {
             'style': '{',
         },
     },
+    # Запись в файл и консоль идет в отдельном потоке через очередь - event loop не ждет ввода-вывода
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'chat_app.logging_utils.QueuedHandler',
+            'handler_class': 'logging.FileHandler',
             'filename': BASE_DIR / 'logs' / 'premium_chat.log',
             'formatter': 'verbose',
+            'filters': ['sampling'],
         },
         'console': {
             'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
+            'class': 'chat_app.logging_utils.QueuedHandler',
+            'handler_class': 'logging.StreamHandler',
             'formatter': 'simple',
+            'filters': ['sampling'],
         },
     },
     'root': {
@@ -202,6 +236,131 @@ X_FRAME_OPTIONS = 'DENY'
 LOGS_DIR = BASE_DIR / 'logs'
 LOGS_DIR.mkdir(exist_ok=True)
 
+# GPT provider racing
+GPT_RACE_ENABLED = config('GPT_RACE_ENABLED', default=True, cast=bool)
+GPT_RACE_WIDTH = config('GPT_RACE_WIDTH', default=2, cast=int)  # Сколько провайдеров стартуют в гонке
+GPT_RACE_HEDGE_DELAY = config('GPT_RACE_HEDGE_DELAY', default=1.5, cast=float)  # Задержка перед стартом следующего (сек)
+GPT_SCOREBOARD_ALPHA = config('GPT_SCOREBOARD_ALPHA', default=0.2, cast=float)  # Вес нового замера в EWMA
+GPT_LATENCY_HALF_LIFE = config('GPT_LATENCY_HALF_LIFE', default=600, cast=float)  # Завышенная задержка без замеров возвращается к стартовой (сек)
+GPT_SLOW_PROBE_INTERVAL = config('GPT_SLOW_PROBE_INTERVAL', default=60, cast=float)  # Пробный запрос к "слишком медленному" провайдеру не чаще (сек)
+
+# Provider circuit breaker (cooldown в секундах по классу ошибки)
+GPT_CIRCUIT_FAILURE_THRESHOLD = config('GPT_CIRCUIT_FAILURE_THRESHOLD', default=3, cast=int)
+GPT_CIRCUIT_COOLDOWNS = {
+    'rate_limit': 60,
+    'unavailable': 120,
+    'blocked': 600,
+    'timeout': 30,
+}
+
+# Общее состояние провайдеров для всех процессов (Redis)
+GPT_SHARED_STATE_ENABLED = config('GPT_SHARED_STATE_ENABLED', default=True, cast=bool)
+GPT_SHARED_STATE_INTERVAL = config('GPT_SHARED_STATE_INTERVAL', default=2, cast=float)  # Период синхронизации (сек)
+GPT_SHARED_STATE_STALE_AFTER = config('GPT_SHARED_STATE_STALE_AFTER', default=300, cast=int)  # Статистика молчащих процессов не учитывается (сек)
+
+# Привязка сессии к последнему удачному провайдеру (Redis)
+GPT_AFFINITY_ENABLED = config('GPT_AFFINITY_ENABLED', default=True, cast=bool)
+GPT_AFFINITY_TTL = config('GPT_AFFINITY_TTL', default=604800, cast=int)  # Сколько помнить провайдера сессии (сек)
+
+# GPT response cache (Redis, default cache alias)
+GPT_CACHE_ENABLED = config('GPT_CACHE_ENABLED', default=True, cast=bool)
+GPT_CACHE_TTL = config('GPT_CACHE_TTL', default=3600, cast=int)  # Время жизни ответа (сек)
+GPT_CACHE_MAX_ENTRIES = config('GPT_CACHE_MAX_ENTRIES', default=10000, cast=int)  # Лимит записей, дальше вытеснение LRU
+
+# Бюджет токенов истории разговора по моделям (текущее сообщение входит в бюджет)
+GPT_HISTORY_TOKEN_BUDGETS = {
+    'default': config('GPT_HISTORY_TOKEN_BUDGET', default=3000, cast=int),
+    'gpt-3.5-turbo': 3000,
+    'gpt-4': 6000,
+    'gpt-4o': 8000,
+    'gpt-4o-mini': 8000,
+}
+
+# Краткое содержание длинных разговоров (обновляется в фоне быстрыми провайдерами)
+GPT_SUMMARY_ENABLED = config('GPT_SUMMARY_ENABLED', default=True, cast=bool)
+GPT_SUMMARY_KEEP_RECENT = config('GPT_SUMMARY_KEEP_RECENT', default=20, cast=int)  # Последние сообщения, которые не сворачиваются
+GPT_SUMMARY_MIN_BATCH = config('GPT_SUMMARY_MIN_BATCH', default=10, cast=int)  # Минимум сообщений для обновления
+GPT_SUMMARY_BATCH_TOKENS = config('GPT_SUMMARY_BATCH_TOKENS', default=4000, cast=int)  # Лимит токенов одной порции
+GPT_SUMMARY_MAX_WORDS = config('GPT_SUMMARY_MAX_WORDS', default=300, cast=int)
+
+# Сроки ответа: на весь запрос (все попытки провайдеров вместе) и на одну попытку (сек)
+GPT_REQUEST_TIMEOUT = config('GPT_REQUEST_TIMEOUT', default=60, cast=float)
+GPT_REQUEST_TIMEOUT_MAX = config('GPT_REQUEST_TIMEOUT_MAX', default=300, cast=float)  # Верхняя граница для timeout из API
+GPT_ATTEMPT_TIMEOUT = config('GPT_ATTEMPT_TIMEOUT', default=120, cast=float)
+
+# Ограничение нагрузки на провайдеров: запросы сверх лимита ждут в ограниченной очереди
+GPT_MAX_IN_FLIGHT = config('GPT_MAX_IN_FLIGHT', default=32, cast=int)  # Запросов к провайдерам одновременно на процесс
+GPT_QUEUE_SIZE = config('GPT_QUEUE_SIZE', default=100, cast=int)  # Дальше запросы сразу отклоняются (503)
+GPT_QUEUE_TIMEOUT = config('GPT_QUEUE_TIMEOUT', default=10, cast=float)  # Сколько запрос может ждать в очереди (сек)
+GPT_PROVIDER_CONCURRENCY = config('GPT_PROVIDER_CONCURRENCY', default=4, cast=int)  # Одновременных вызовов одного провайдера
+GPT_PROVIDER_CONCURRENCY_LIMITS = {}  # Индивидуальные лимиты, например {'Chatai': 8}
+GPT_PROVIDER_QUEUE_SIZE = config('GPT_PROVIDER_QUEUE_SIZE', default=8, cast=int)
+GPT_PROVIDER_QUEUE_TIMEOUT = config('GPT_PROVIDER_QUEUE_TIMEOUT', default=2, cast=float)  # Дольше не ждем - идем к следующему провайдеру
+
+# Приоритеты запросов (premium / user / anon): какую долю слотов и очереди может занять приоритет.
+# Премиум запросы обслуживаются первыми и вытесняют из полной очереди анонимные
+GPT_PRIORITY_SHARES = {
+    'premium': 1.0,
+    'user': 0.8,
+    'anon': 0.5,
+}
+
+# Объединение одинаковых запросов, выполняющихся одновременно (блокировка и канал результата в Redis)
+GPT_SINGLEFLIGHT_ENABLED = config('GPT_SINGLEFLIGHT_ENABLED', default=True, cast=bool)
+GPT_SINGLEFLIGHT_LOCK_TTL = config('GPT_SINGLEFLIGHT_LOCK_TTL', default=180, cast=int)  # Страховка, если лидер упал (сек)
+GPT_SINGLEFLIGHT_WAIT_TIMEOUT = config('GPT_SINGLEFLIGHT_WAIT_TIMEOUT', default=180, cast=float)  # Сколько ждать чужой результат (сек)
+
+# Лимиты частоты запросов (token bucket в Redis) по приоритетам: per_minute - пополнение
+# корзины в минуту, burst - емкость. Корзины ведутся по пользователю (анонимы - по IP) и по сессии
+RATE_LIMIT_ENABLED = config('RATE_LIMIT_ENABLED', default=True, cast=bool)
+RATE_LIMITS = {
+    'anon': {'per_minute': 10, 'burst': 5},
+    'user': {'per_minute': 30, 'burst': 15},
+    'premium': {'per_minute': 120, 'burst': 40},
+}
+RATE_LIMIT_COSTS = {'chat': 1, 'image': 5}  # Сколько токенов стоит действие
+RATE_LIMIT_TRUST_PROXY = config('RATE_LIMIT_TRUST_PROXY', default=False, cast=bool)  # Брать IP из X-Forwarded-For
+
+# Отдельные воркеры генерации: web и WebSocket ставят задания в очередь Redis,
+# а процессы `manage.py run_gpt_worker` выполняют их и отвечают через channel layer
+GPT_WORKER_MODE = config('GPT_WORKER_MODE', default=False, cast=bool)
+GPT_JOB_QUEUE_MAX = config('GPT_JOB_QUEUE_MAX', default=1000, cast=int)  # Дальше новые задания отклоняются (503)
+GPT_JOB_QUEUE_TIMEOUT = config('GPT_JOB_QUEUE_TIMEOUT', default=30, cast=float)  # Сколько задание может ждать воркера (сек)
+# Создавать GPTService (импорт g4f, проверка имен провайдеров) в фоне сразу при старте ASGI-процесса,
+# а не на первом запросе. manage.py-команды и WSGI сервис по-прежнему не создают
+GPT_WARMUP_ON_START = config('GPT_WARMUP_ON_START', default=True, cast=bool)
+
+# Очередь генерации изображений (результат - опросом или через WebSocket)
+IMAGE_JOB_CONCURRENCY = config('IMAGE_JOB_CONCURRENCY', default=4, cast=int)  # Заданий одновременно на процесс
+IMAGE_JOB_TTL = config('IMAGE_JOB_TTL', default=3600, cast=int)  # Сколько хранится задание и его результат (сек)
+IMAGE_JOB_MAX_WAIT = config('IMAGE_JOB_MAX_WAIT', default=600, cast=int)  # Дольше сброса квоты не ждем (сек)
+IMAGE_JOB_PROVIDER_FAILURES = config('IMAGE_JOB_PROVIDER_FAILURES', default=2, cast=int)  # Ошибок провайдера на задание (кроме квоты)
+IMAGE_JOB_RETRY_BACKOFF = config('IMAGE_JOB_RETRY_BACKOFF', default=5, cast=float)  # Пауза перед повтором провайдера после ошибки, удваивается (сек)
+IMAGE_JOB_LEASE = config('IMAGE_JOB_LEASE', default=120, cast=int)  # Аренда задания: после падения исполнителя задание вернется в очередь (сек)
+IMAGE_JOB_GLOBAL_CONCURRENCY = config('IMAGE_JOB_GLOBAL_CONCURRENCY', default=8, cast=int)  # Заданий одновременно на все процессы
+IMAGE_QUOTA_DEFAULT_WAIT = config('IMAGE_QUOTA_DEFAULT_WAIT', default=60, cast=int)  # Если провайдер не сообщил время сброса квоты (сек)
+
+# Подготовка изображений для vision запросов (уменьшение, JPEG без метаданных, кэш по хэшу)
+VISION_PREPROCESS_ENABLED = config('VISION_PREPROCESS_ENABLED', default=True, cast=bool)
+VISION_IMAGE_MAX_SIDE = config('VISION_IMAGE_MAX_SIDE', default=1536, cast=int)  # Большая сторона, px
+VISION_IMAGE_QUALITY = config('VISION_IMAGE_QUALITY', default=85, cast=int)  # Качество JPEG
+VISION_IMAGE_CACHE_TTL = config('VISION_IMAGE_CACHE_TTL', default=3600, cast=int)  # Кэш обработанных изображений (сек)
+
+# Хранилище сгенерированных изображений (MEDIA_ROOT/images, имя файла - sha256 содержимого)
+IMAGE_STORE_ENABLED = config('IMAGE_STORE_ENABLED', default=True, cast=bool)
+IMAGE_STORE_MAX_BYTES = config('IMAGE_STORE_MAX_BYTES', default=20 * 1024 * 1024, cast=int)  # Больше не скачиваем
+IMAGE_STORE_THUMBNAIL_SIZES = (256, 512)  # Миниатюры WEBP (по большей стороне, px)
+IMAGE_STORE_DOWNLOAD_TIMEOUT = config('IMAGE_STORE_DOWNLOAD_TIMEOUT', default=30, cast=float)  # Загрузка с хоста провайдера (сек)
+IMAGE_STORE_REUSE_TTL = config('IMAGE_STORE_REUSE_TTL', default=30 * 24 * 3600, cast=int)  # Сколько помнить изображение для промпта (сек)
+
+# Метрики в формате Prometheus (/metrics): счетчики процессов суммируются в Redis
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=10, cast=float)  # Как часто процесс сбрасывает метрики (сек)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # Если задан, /metrics требует Authorization: Bearer <токен>
+
+# Server-Sent Events (/api/chat/stream/): интервал пинга, пока провайдер молчит (сек)
+SSE_HEARTBEAT_INTERVAL = config('SSE_HEARTBEAT_INTERVAL', default=15, cast=float)
+
 # Google OAuth Configuration
 GOOGLE_CLIENT_ID = config('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = config('GOOGLE_CLIENT_SECRET')
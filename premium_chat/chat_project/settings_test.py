@@ -0,0 +1,31 @@
+"""Настройки для тестов (pytest): без PostgreSQL, Redis и ключей Google OAuth"""
+import os
+
+for name in ('GOOGLE_CLIENT_ID', 'GOOGLE_CLIENT_SECRET', 'GOOGLE_REDIRECT_URI', 'GOOGLE_TOKEN_URL', 'GOOGLE_USER_INFO_URL'):
+    os.environ.setdefault(name, 'test')
+
+from .settings import *  # noqa: E402,F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+# Фоновые потоки синхронизации с Redis в тестах не нужны
+GPT_SHARED_STATE_ENABLED = False
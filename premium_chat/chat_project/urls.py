@@ -1,10 +1,14 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from chat_app.views import stored_image
+from chat_app.image_store import STORED_NAME_RE
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # Сгенерированные изображения (ImageStore) - с долгим кэшированием, в том числе без DEBUG
+    re_path(rf"^{settings.MEDIA_URL.strip('/')}/images/(?P<name>{STORED_NAME_RE})$", stored_image, name='stored_image'),
     path('api/', include('chat_app.urls')),
     path('', include('chat_app.urls')),
 ]
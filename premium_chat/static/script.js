@@ -2095,6 +2095,7 @@ class PremiumChatApp {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-CSRFToken': window.csrfToken || ''
                 },
                 body: JSON.stringify(requestParams),
                 signal: controller.signal
@@ -2386,6 +2387,7 @@ class PremiumChatApp {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-CSRFToken': window.csrfToken || ''
                 },
                 body: JSON.stringify(requestParams),
                 signal: controller.signal
@@ -2685,7 +2687,12 @@ class PremiumChatApp {
                 })
             });
 
-            const data = await response.json();
+            let data = await response.json();
+
+            // Генерация идет в очереди на сервере - дожидаемся результата задания
+            if (data.job_id) {
+                data = await this.waitForImageJob(data.job_id, data.max_wait);
+            }
 
             if (data.success) {
                 // Генерация успешна - используем URL изображения
@@ -2740,6 +2747,30 @@ class PremiumChatApp {
         }
     }
 
+    async waitForImageJob(jobId, maxWait = 600) {
+        // Опрашиваем задание, пока оно не завершится (при исчерпанной квоте сервер сам повторит позже),
+        // но не дольше срока задания на сервере. Интервал опроса растет от 1 до 10 секунд
+        const deadline = Date.now() + (maxWait + 30) * 1000;
+        let interval = 1000;
+        while (Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, interval));
+            interval = Math.min(interval * 1.5, 10000);
+            const response = await this.safeFetch(`${this.apiBaseUrl}/generate-image/${jobId}/`);
+            const { job, error } = await response.json();
+
+            if (!job) {
+                return { success: false, error: error, message: 'Задание генерации изображения не найдено.' };
+            }
+            if (job.status === 'done') {
+                return { success: true, ...job.result };
+            }
+            if (job.status === 'failed') {
+                return { success: false, error: job.error, message: job.message };
+            }
+        }
+        return { success: false, error: 'timeout', message: 'Генерация изображения заняла слишком много времени. Попробуйте позже.' };
+    }
+
     showImageGenerationIndicator() {
         // Показываем специальный индикатор для генерации изображений
         const messagesContainer = document.getElementById('messagesContainer');